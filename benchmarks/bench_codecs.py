@@ -0,0 +1,77 @@
+"""
+Compare takeout/takein throughput and compression ratio of all codecs.
+
+    python benchmarks/bench_codecs.py --files 5000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from synthetic import make_home
+
+from uberspace_takeout import codecs
+from uberspace_takeout.storage import TarStorage
+
+
+def bench(home, raw_size, spec, workdir):
+    codec, level = codecs.parse_compression(spec)
+    path = os.path.join(workdir, "bench.tar" + codec.extension)
+
+    start = time.perf_counter()
+    with TarStorage(path, "takeout", codec.name, level) as s:
+        s.store_directory(home, "home/")
+    takeout_time = time.perf_counter() - start
+
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    with TarStorage(path, "takein") as s:
+        s.unstore_directory("home/", os.path.join(workdir, "restored-" + codec.name))
+    takein_time = time.perf_counter() - start
+
+    os.remove(path)
+
+    return {
+        "codec": spec,
+        "ratio": raw_size / size,
+        "takeout_mbs": raw_size / takeout_time / 1e6,
+        "takein_mbs": raw_size / takein_time / 1e6,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=2000)
+    p.add_argument(
+        "--codec",
+        action="append",
+        help="codec[:level] to benchmark, defaults to all available ones",
+    )
+    args = p.parse_args()
+
+    specs = args.codec or [n for n, c in codecs.CODECS.items() if c.available]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        home = os.path.join(workdir, "home")
+        raw_size = make_home(home, args.files)
+        print("synthetic home: {} files, {:.1f} MB".format(args.files, raw_size / 1e6))
+        print()
+        print(
+            "{:<10} {:>8} {:>14} {:>13}".format(
+                "codec", "ratio", "takeout MB/s", "takein MB/s"
+            )
+        )
+
+        for spec in specs:
+            r = bench(home, raw_size, spec, workdir)
+            print(
+                "{codec:<10} {ratio:>8.2f} {takeout_mbs:>14.1f} {takein_mbs:>13.1f}".format(
+                    **r
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Show how takeout scales with the number of compression processes (--jobs).
+
+    python benchmarks/bench_parallel.py --files 5000 --codec bz2 --max-jobs 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from synthetic import make_home
+
+from uberspace_takeout import codecs
+from uberspace_takeout.storage import TarStorage
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=2000)
+    p.add_argument("--codec", default="bz2", help="codec[:level]")
+    p.add_argument("--max-jobs", type=int, default=os.cpu_count())
+    args = p.parse_args()
+
+    codec, level = codecs.parse_compression(args.codec)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        home = os.path.join(workdir, "home")
+        raw_size = make_home(home, args.files)
+        path = os.path.join(workdir, "bench.tar" + codec.extension)
+        print("synthetic home: {} files, {:.1f} MB".format(args.files, raw_size / 1e6))
+        print()
+        print("{:>4} {:>10} {:>8} {:>8}".format("jobs", "MB/s", "speedup", "ratio"))
+
+        baseline = None
+        for jobs in range(1, args.max_jobs + 1):
+            start = time.perf_counter()
+            with TarStorage(path, "takeout", codec.name, level, jobs) as s:
+                s.store_directory(home, "home/")
+            duration = time.perf_counter() - start
+
+            baseline = baseline or duration
+            print(
+                "{:>4} {:>10.1f} {:>8.2f} {:>8.2f}".format(
+                    jobs,
+                    raw_size / duration / 1e6,
+                    baseline / duration,
+                    raw_size / os.path.getsize(path),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Measure how long the CLI takes to start: `items`, `takeout --help` and a
+takeout which skips every item, each in a fresh interpreter. --dns-delay makes
+socket.getfqdn() take that long, like a broken resolver does, which none of
+these should wait for.
+
+    python benchmarks/bench_startup.py --repeat 10 --dns-delay 2
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from uberspace_takeout import Takeout
+
+# runs the CLI with a slow getfqdn()
+WRAPPER = """
+import runpy, socket, sys, time
+delay = float(sys.argv.pop(1))
+def getfqdn(name=""):
+    time.sleep(delay)
+    return "slow.example.com"
+socket.getfqdn = getfqdn
+sys.argv[0] = "uberspace-takeout"
+runpy.run_module("uberspace_takeout", run_name="__main__")
+"""
+
+
+def commands(workdir):
+    root = os.path.join(workdir, "root")
+    os.makedirs(os.path.join(root, "etc"), exist_ok=True)
+    with open(os.path.join(root, "etc", "centos-release"), "w") as f:
+        f.write("CentOS Linux release 7.9.2009 (Core)\n")
+    cassette = os.path.join(workdir, "cassette.jsonl")
+    open(cassette, "w").close()
+
+    skip = []
+    for item in Takeout.takeout_menu:
+        skip += ["--skip-item", item.__name__]
+
+    return {
+        "items": ["items"],
+        "takeout --help": ["takeout", "--help"],
+        "no-op takeout": [
+            "takeout",
+            "--root",
+            root,
+            "--tar-file",
+            os.path.join(workdir, "noop.tar"),
+            "--compression",
+            "none",
+            "--replay-commands",
+            cassette,
+            "--no-progress",
+        ]
+        + skip,
+    }
+
+
+def measure(args, dns_delay, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", WRAPPER, str(dns_delay)] + args,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--repeat", type=int, default=5, help="report the median")
+    p.add_argument(
+        "--dns-delay",
+        type=float,
+        default=0,
+        help="seconds socket.getfqdn() takes, e.g. with a broken resolver",
+    )
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, cli_args in commands(workdir).items():
+            seconds = measure(cli_args, args.dns_delay, args.repeat)
+            print("{:<20} {:>8.3f}s".format(name, seconds))
+
+
+if __name__ == "__main__":
+    main()
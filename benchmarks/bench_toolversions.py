@@ -0,0 +1,82 @@
+"""
+Compare fetching tool versions one `uberspace tools version show` call after
+the other with ToolVersions.takeout(), which runs them concurrently. Uses a stub
+`uberspace` script, which sleeps for --delay seconds to simulate the start-up
+time of the real cli.
+
+    python benchmarks/bench_toolversions.py --tools 6 --delay 0.3
+"""
+
+import argparse
+import os
+import re
+import stat
+import tempfile
+import time
+
+from uberspace_takeout import commands
+from uberspace_takeout.items.u7 import ToolVersions
+from uberspace_takeout.storage import LocalMoveStorage
+
+STUB = """#!/bin/sh
+sleep {delay}
+if [ "$3" = "list" ]; then
+{list}
+else
+    echo "Using '$4' version: '1.2'"
+fi
+"""
+
+
+def make_stub(directory, tools, delay):
+    path = os.path.join(directory, "uberspace")
+    listing = "\n".join("    echo '- tool{}'".format(i) for i in range(tools))
+
+    with open(path, "w") as f:
+        f.write(STUB.format(delay=delay, list=listing))
+
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def sequential(item):
+    # the way ToolVersions.takeout() used to work
+    tools = item.run_uberspace("tools", "version", "list")
+
+    for tool in tools:
+        tool = tool.lstrip("- ")
+        out = item.run_uberspace("tools", "version", "show", tool)
+        version = re.search(r"'([0-9\.]+)'", out[0]).groups()[0]
+        item.storage.store_text(version, "conf/tool-version/" + tool)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--tools", type=int, default=6)
+    p.add_argument("--delay", type=float, default=0.3)
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        make_stub(workdir, args.tools, args.delay)
+        os.environ["PATH"] = workdir + ":" + os.environ["PATH"]
+        commands.configure(max_concurrent=8)
+
+        print("{} tools, {}s per uberspace call".format(args.tools, args.delay))
+        print()
+
+        for name, run in [
+            ("sequential", sequential),
+            ("concurrent", ToolVersions.takeout),
+        ]:
+            destination = os.path.join(workdir, name)
+            with LocalMoveStorage(destination, "takeout") as storage:
+                item = ToolVersions("bench", "localhost", storage)
+
+                start = time.perf_counter()
+                run(item)
+                duration = time.perf_counter() - start
+
+            print("{:>12} {:>8.2f}s".format(name, duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Compare storing a directory tree using tarfile.TarFile.add(), plus the extra
+lstat() the manifest used to need for every file, with the TreeWalker
+TarStorage uses now. Counts the stat/listdir calls and user/group lookups of
+both, since that is where the time goes on large trees (strace would show the
+same, but isn't available everywhere).
+
+    python benchmarks/bench_walker.py --files 500000
+"""
+
+import argparse
+import contextlib
+import grp
+import os
+import pwd
+import tarfile
+import tempfile
+import time
+from collections import Counter
+
+from uberspace_takeout.manifest import Manifest
+from uberspace_takeout.walk import TreeWalker
+
+
+def make_tree(root, files, per_directory=100):
+    for i in range(files):
+        directory = os.path.join(
+            root,
+            "d{}".format(i // (per_directory * per_directory)),
+            "d{}".format(i // per_directory),
+        )
+        if i % per_directory == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f{}".format(i)), "w") as f:
+            f.write("x")
+
+
+class _CountingEntry:
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, follow_symlinks=True):
+        self._counts["DirEntry.stat"] += 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+
+class _CountingScandir:
+    def __init__(self, scandir, counts, path):
+        counts["scandir"] += 1
+        self._iterator = scandir(path)
+        self._counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._iterator.close()
+
+    def __iter__(self):
+        return (_CountingEntry(e, self._counts) for e in self._iterator)
+
+
+@contextlib.contextmanager
+def counting(counts):
+    originals = [
+        (os, "lstat"),
+        (os, "stat"),
+        (os, "listdir"),
+        (pwd, "getpwuid"),
+        (grp, "getgrgid"),
+    ]
+    saved = [(module, name, getattr(module, name)) for module, name in originals]
+
+    def wrap(name, function):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    scandir = os.scandir
+    for module, name, function in saved:
+        setattr(module, name, wrap(name, function))
+    os.scandir = lambda path: _CountingScandir(scandir, counts, path)
+
+    try:
+        yield
+    finally:
+        for module, name, function in saved:
+            setattr(module, name, function)
+        os.scandir = scandir
+
+
+def with_add(root, tar):
+    def track(tarinfo):
+        relative = tarinfo.name[len("home") :].lstrip("/")
+        path = os.path.join(root, relative) if relative else root
+        Manifest.entry(path, os.lstat(path))
+        return tarinfo
+
+    tar.add(root, "home", filter=track)
+
+
+def with_walker(root, tar):
+    for path, tarinfo, stat_result in TreeWalker(tar.inodes).walk(root, "home"):
+        Manifest.entry(path, stat_result)
+        if tarinfo.isreg():
+            with open(path, "rb") as f:
+                tar.addfile(tarinfo, f)
+        else:
+            tar.addfile(tarinfo)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=20000)
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        root = os.path.join(workdir, "home")
+        make_tree(root, args.files)
+        print("{} files".format(args.files))
+        print()
+
+        for name, store in [("tar.add", with_add), ("walker", with_walker)]:
+            counts = Counter()
+            with open(os.devnull, "wb") as devnull:
+                with tarfile.open(fileobj=devnull, mode="w") as tar:
+                    with counting(counts):
+                        start = time.perf_counter()
+                        store(root, tar)
+                        duration = time.perf_counter() - start
+
+            print("{:>12} {:>8.2f}s".format(name, duration))
+            for call, count in sorted(counts.items()):
+                print("{:>30} {:>10}".format(call, count))
+
+
+if __name__ == "__main__":
+    main()
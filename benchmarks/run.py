@@ -0,0 +1,243 @@
+"""
+Benchmark suite: takeout and takein throughput of TarStorage and
+LocalMoveStorage (moving and copying) on synthetic hosts shaped in different ways (see
+synthetic.SHAPES), using Takeout's root prefix. Results can be saved as a
+baseline, which later runs are compared to, failing if anything got slower
+by more than --threshold.
+
+    python benchmarks/run.py --scale 0.01 --save baseline.json
+    python benchmarks/run.py --scale 0.01 --compare baseline.json
+
+--scale 1 is the full size, e.g. a Maildir with a million files.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from synthetic import make_root
+from synthetic import SHAPES
+
+from uberspace_takeout.items.base import PathItem
+from uberspace_takeout.items.common import Homedir
+from uberspace_takeout.items.common import Www
+from uberspace_takeout.storage import LocalMoveStorage
+from uberspace_takeout.storage import TarStorage
+
+USERNAME = "bench"
+HOSTNAME = "bench.uber.space"
+
+
+def path_items(storage, root):
+    return [i(USERNAME, HOSTNAME, storage, root) for i in (Homedir, Www)]
+
+
+def takeout(storage, root):
+    for item in path_items(storage, root):
+        item.takeout()
+
+
+def takein(storage, root):
+    PathItem.takein_all(storage, path_items(storage, root))
+
+
+def count_files(root):
+    return sum(len(files) for _, _, files in os.walk(root))
+
+
+def tar_round_trip(workdir, root, args):
+    path = os.path.join(workdir, "bench.tar")
+    target = os.path.join(workdir, "target")
+
+    start = time.perf_counter()
+    with TarStorage(path, "takeout", args.compression, jobs=args.jobs) as s:
+        takeout(s, root)
+    takeout_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with TarStorage(path, "takein", jobs=args.jobs) as s:
+        takein(s, target)
+    takein_seconds = time.perf_counter() - start
+
+    os.remove(path)
+    shutil.rmtree(target)
+    return takeout_seconds, takein_seconds
+
+
+def move_round_trip(workdir, root, args):
+    # moves the host's files into the storage and back again
+    destination = os.path.join(workdir, "moved")
+
+    start = time.perf_counter()
+    with LocalMoveStorage(destination, "takeout") as s:
+        takeout(s, root)
+    takeout_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with LocalMoveStorage(destination, "takein") as s:
+        takein(s, root)
+    takein_seconds = time.perf_counter() - start
+
+    shutil.rmtree(destination)
+    return takeout_seconds, takein_seconds
+
+
+def copy_round_trip(workdir, root, args):
+    # copies the host's files into the storage and from there to a new root
+    destination = os.path.join(workdir, "copied")
+    target = os.path.join(workdir, "target")
+
+    start = time.perf_counter()
+    with LocalMoveStorage(destination, "takeout", copy=True, jobs=args.jobs) as s:
+        takeout(s, root)
+    takeout_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with LocalMoveStorage(destination, "takein", copy=True, jobs=args.jobs) as s:
+        takein(s, target)
+    takein_seconds = time.perf_counter() - start
+
+    print("  copied: " + json.dumps(s.stats()))
+    shutil.rmtree(destination)
+    shutil.rmtree(target)
+    return takeout_seconds, takein_seconds
+
+
+STORAGES = {
+    "TarStorage": tar_round_trip,
+    "LocalMoveStorage": move_round_trip,
+    "LocalMoveStorage-copy": copy_round_trip,
+}
+
+
+def run(args):
+    results = {}
+
+    for shape in args.shapes:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            root = os.path.join(workdir, "root")
+            size = make_root(root, USERNAME, shape, args.scale)
+            files = count_files(root)
+            print("{}: {} files, {:.1f} MB".format(shape, files, size / 1e6))
+
+            for storage in args.storages:
+                durations = [
+                    STORAGES[storage](workdir, root, args) for _ in range(args.repeat)
+                ]
+                for action, seconds in zip(("takeout", "takein"), zip(*durations)):
+                    seconds = min(seconds)
+                    results["{}/{}/{}".format(shape, storage, action)] = {
+                        "seconds": round(seconds, 6),
+                        "files_per_second": round(files / seconds, 1),
+                        "mb_per_second": round(size / 1e6 / seconds, 2),
+                    }
+
+    return results
+
+
+def print_results(results, baseline=None):
+    print()
+    print(
+        "{:<40} {:>9} {:>10} {:>9} {:>9}".format(
+            "benchmark", "seconds", "files/s", "MB/s", "change"
+        )
+    )
+    for name, result in results.items():
+        change = ""
+        if baseline and baseline.get(name, {}).get("seconds"):
+            change = "{:+.0%}".format(result["seconds"] / baseline[name]["seconds"] - 1)
+        print(
+            "{:<40} {:>9.3f} {:>10.0f} {:>9.1f} {:>9}".format(
+                name,
+                result["seconds"],
+                result["files_per_second"],
+                result["mb_per_second"],
+                change,
+            )
+        )
+
+
+def regressions(results, baseline, threshold, noise=0.01):
+    # differences below noise seconds are ignored, e.g. for LocalMoveStorage,
+    # which just renames two directories.
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline
+        and result["seconds"] > baseline[name]["seconds"] * (1 + threshold)
+        and result["seconds"] - baseline[name]["seconds"] > noise
+    ]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--shapes", type=lambda s: s.split(","), default=list(SHAPES), metavar="A,B"
+    )
+    p.add_argument(
+        "--storages",
+        type=lambda s: s.split(","),
+        default=list(STORAGES),
+        metavar="A,B",
+    )
+    p.add_argument("--scale", type=float, default=0.01)
+    p.add_argument("--compression", default="gzip")
+    p.add_argument("--jobs", type=int, default=1)
+    p.add_argument("--repeat", type=int, default=3, help="report the fastest run")
+    p.add_argument("--workdir", help="where to create the synthetic hosts")
+    p.add_argument("--save", metavar="PATH", help="save the results as a baseline")
+    p.add_argument("--compare", metavar="PATH", help="compare to this baseline")
+    p.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fail --compare if anything got slower than this (0.2 = 20%%)",
+    )
+    args = p.parse_args()
+
+    settings = {
+        "scale": args.scale,
+        "compression": args.compression,
+        "jobs": args.jobs,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved["settings"] != settings:
+            print("warning: baseline was made with {}".format(saved["settings"]))
+        baseline = saved["results"]
+
+    results = run(args)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "settings": settings,
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if baseline:
+        slower = regressions(results, baseline, args.threshold)
+        if slower:
+            print()
+            print("slower than the baseline: " + ", ".join(slower))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
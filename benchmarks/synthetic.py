@@ -0,0 +1,155 @@
+"""
+Generate synthetic home directories to benchmark takeout/takein on.
+"""
+
+import os
+import random
+
+WORDS = (
+    "uberspace takeout homedir mail domain php node ruby mysql password cron "
+    "apache error log access spamfilter version www html index blog wordpress"
+).split()
+
+
+def _text(rnd, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).encode("utf-8")[:size]
+
+
+def make_home(root, files=2000, seed=0):
+    """
+    Create a mix of small text files, mails and incompressible binaries below
+    root. Returns the total number of bytes written.
+    """
+    rnd = random.Random(seed)
+    total = 0
+
+    for i in range(files):
+        kind = i % 10
+        if kind < 5:
+            path = os.path.join(root, "Maildir", "cur", "mail-{}".format(i))
+            data = _text(rnd, rnd.randint(1000, 8000))
+        elif kind < 8:
+            path = os.path.join(
+                root, "html", "dir{}".format(i % 20), "file{}.php".format(i)
+            )
+            data = _text(rnd, rnd.randint(2000, 30000))
+        else:
+            path = os.path.join(root, "media", "image{}.jpg".format(i))
+            data = os.urandom(rnd.randint(20000, 200000))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        total += len(data)
+
+    return total
+
+
+def make_maildir(root, files, seed=0):
+    # lots of tiny files in a few directories, like a Maildir
+    rnd = random.Random(seed)
+    total = 0
+
+    for folder in ("cur", "new", "tmp"):
+        os.makedirs(os.path.join(root, "Maildir", folder), exist_ok=True)
+
+    for i in range(files):
+        folder = "cur" if i % 10 else "new"
+        path = os.path.join(root, "Maildir", folder, "{}.M{}.host:2,S".format(i, i))
+        data = _text(rnd, rnd.randint(200, 2000))
+        with open(path, "wb") as f:
+            f.write(data)
+        total += len(data)
+
+    return total
+
+
+def make_media(root, files, size):
+    # a few huge, incompressible files
+    total = 0
+    chunk = 1024 * 1024
+
+    os.makedirs(os.path.join(root, "media"), exist_ok=True)
+    for i in range(files):
+        with open(os.path.join(root, "media", "video{}.mp4".format(i)), "wb") as f:
+            for offset in range(0, size, chunk):
+                f.write(os.urandom(min(chunk, size - offset)))
+        total += size
+
+    return total
+
+
+def make_node_modules(root, packages, depth=6, seed=0):
+    # deeply nested packages with a handful of small files each
+    rnd = random.Random(seed)
+    total = 0
+
+    for i in range(packages):
+        path = os.path.join(root, "app")
+        for level in range(1 + i % depth):
+            path = os.path.join(path, "node_modules", "pkg{}-{}".format(level, i))
+
+        os.makedirs(os.path.join(path, "lib"), exist_ok=True)
+        for name in ("package.json", "index.js", "lib/util.js", "README.md"):
+            data = _text(rnd, rnd.randint(100, 4000))
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(data)
+            total += len(data)
+
+    return total
+
+
+def make_symlinks(root, links):
+    # many symlinks, e.g. from deployments switching releases
+    os.makedirs(os.path.join(root, "releases", "current"), exist_ok=True)
+    with open(os.path.join(root, "releases", "current", "target"), "w") as f:
+        f.write("target")
+
+    os.makedirs(os.path.join(root, "links"), exist_ok=True)
+    for i in range(links):
+        os.symlink(
+            "../releases/current/target",
+            os.path.join(root, "links", "link{}".format(i)),
+        )
+
+    return 0
+
+
+# name => function(home, scale), creating that shape of home directory. scale 1
+# is the full size, e.g. a Maildir with a million files.
+SHAPES = {
+    "mixed": lambda home, scale: make_home(home, max(1, int(200000 * scale))),
+    "maildir": lambda home, scale: make_maildir(home, max(1, int(1000000 * scale))),
+    "media": lambda home, scale: make_media(
+        home, 3, max(1024 * 1024, int(1024 * 1024 * 1024 * scale))
+    ),
+    "node_modules": lambda home, scale: make_node_modules(
+        home, max(1, int(50000 * scale))
+    ),
+    "symlinks": lambda home, scale: make_symlinks(home, max(1, int(100000 * scale))),
+}
+
+
+def make_root(root, username, shape, scale=1.0):
+    """
+    Create a synthetic host below root, see Takeout(root=...): an Uberspace 7
+    with the home directory of username shaped like shape, and a small
+    document root. Returns the total number of bytes written.
+    """
+    os.makedirs(os.path.join(root, "etc"), exist_ok=True)
+    with open(os.path.join(root, "etc", "centos-release"), "w") as f:
+        f.write("CentOS Linux release 7.9.2009 (Core)\n")
+
+    home = os.path.join(root, "home", username)
+    www = os.path.join(root, "var", "www", "virtual", username)
+    os.makedirs(home, exist_ok=True)
+    total = SHAPES[shape](home, scale)
+    total += make_home(www, 100, seed=1)
+
+    return total
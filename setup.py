@@ -18,7 +18,11 @@ setup(
     author_email="hallo@uberspace.de",
     url="https://github.com/uberspace/takeout",
     packages=["uberspace_takeout", "uberspace_takeout.items",],
-    extras_require={"test": ["pyfakefs>=3.6", "pytest-mock",],},
+    extras_require={
+        "test": ["pyfakefs>=3.6", "pytest-mock",],
+        "zstd": ["zstandard"],
+        "lz4": ["lz4"],
+    },
     entry_points={
         "console_scripts": ["uberspace-takeout=uberspace_takeout.__main__:main"],
     },
@@ -0,0 +1,186 @@
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from uberspace_takeout import batch
+from uberspace_takeout.batch import Batch
+from uberspace_takeout.exc import TakeoutError
+from uberspace_takeout.host import HostContext
+from uberspace_takeout.items.base import TakeoutItem
+
+
+@pytest.fixture
+def host(tmp_path, mocker):
+    host = tmp_path / "host"
+    shutil.copytree(
+        str(Path(__file__).parent / "uberspaces" / "u6" / "isabell"),
+        str(host),
+        symlinks=True,
+    )
+    # a second, bigger user
+    shutil.copytree(str(host / "home/isabell"), str(host / "home/bob"), symlinks=True)
+    (host / "home/bob/big").write_bytes(b"x" * 100000)
+    shutil.copytree(
+        str(host / "var/www/virtual/isabell"), str(host / "var/www/virtual/bob")
+    )
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    # forked workers inherit these
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+    return host
+
+
+def test_read_users(tmp_path):
+    (tmp_path / "users").write_text("# users\nisabell\n\nbob  bob.tar.gz\n")
+    assert batch.read_users(str(tmp_path / "users")) == [
+        ("isabell", None),
+        ("bob", "bob.tar.gz"),
+    ]
+
+
+def test_batch_roundtrip(tmp_path, host):
+    archives = tmp_path / "archives"
+    archives.mkdir()
+
+    b = Batch(
+        "takeout",
+        [("isabell", None), ("bob", None)],
+        archives,
+        HostContext(host, "andromeda.uberspace.de"),
+        processes=2,
+        extension=".tar.gz",
+        compression="gzip",
+    )
+    summary = b.run()
+    json.dumps(summary)
+
+    # biggest first
+    assert [j.username for j in sorted(b.jobs, key=lambda j: -j.size)] == [
+        "bob",
+        "isabell",
+    ]
+    assert summary["failed"] == []
+    for user in summary["users"]:
+        assert user["ok"] and user["attempts"] == 1
+        assert user["archive"].endswith(".tar.gz")
+        assert "takeout: Homedirectory" in open(user["log"]).read()
+
+    new_host = tmp_path / "new_host"
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+    summary = Batch(
+        "takein",
+        [("isabell", None), ("bob", None), ("nobody", None)],
+        archives,
+        HostContext(new_host, "andromeda.uberspace.de"),
+    ).run()
+
+    assert summary["failed"] == ["nobody"]
+    assert (new_host / "home/bob/big").read_bytes() == b"x" * 100000
+    assert (new_host / "var/www/virtual/isabell/html/index.html").exists()
+
+
+def test_batch_default_archive(tmp_path, host):
+    for name in (
+        "takeout_isabell_2019.tar.gz",
+        "takeout_isabell_2020.tar.gz",
+        "takeout_isabell_2020.tar.gz.checkpoint",
+        "takeout_bob_2021.tar.gz",
+    ):
+        (tmp_path / name).write_text("")
+
+    b = Batch(
+        "takein",
+        [("isabell", None)],
+        tmp_path,
+        HostContext(host, "andromeda.uberspace.de"),
+    )
+
+    # the newer one failed halfway through
+    assert b.jobs[0].archive == str(tmp_path / "takeout_isabell_2019.tar.gz")
+
+
+def test_batch_retries(tmp_path, host):
+    summary = Batch(
+        "takeout",
+        [("isabell", None), ("missing", None)],
+        tmp_path,
+        HostContext(host, "andromeda.uberspace.de"),
+        retries=2,
+    ).run()
+
+    isabell, missing = summary["users"]
+    assert isabell["ok"] and isabell["attempts"] == 1
+    assert not missing["ok"] and missing["attempts"] == 3
+    assert missing["exception"]
+    assert summary["failed"] == ["missing"]
+
+
+def test_batch_no_retry_item_errors(tmp_path, host, mocker):
+    mocker.patch(
+        "uberspace_takeout.items.u6.WebDomains.takeout",
+        side_effect=TakeoutError("no such user"),
+    )
+
+    summary = Batch(
+        "takeout",
+        [("isabell", None)],
+        tmp_path,
+        HostContext(host, "andromeda.uberspace.de"),
+        retries=2,
+    ).run()
+
+    (isabell,) = summary["users"]
+    assert not isabell["ok"] and isabell["attempts"] == 1
+    assert not isabell["exception"]
+    assert summary["failed"] == ["isabell"]
+
+
+def test_batch_record_commands(tmp_path, host):
+    with pytest.raises(Exception) as ex:
+        Batch(
+            "takeout",
+            [("isabell", None)],
+            tmp_path,
+            HostContext(host, "andromeda.uberspace.de"),
+            command_options={"record": str(tmp_path / "cassette.jsonl")},
+        )
+
+    assert "can't be recorded" in str(ex.value)
+
+
+def test_batch_chunk_store(tmp_path, host):
+    archives = tmp_path / "archives"
+    archives.mkdir()
+
+    summary = Batch(
+        "takeout",
+        [("isabell", None), ("bob", None)],
+        archives,
+        HostContext(host, "andromeda.uberspace.de"),
+        processes=1,
+        extension=".chunks",
+        chunk_store=archives / "chunks",
+    ).run()
+
+    assert summary["failed"] == []
+    assert all(u["archive"].endswith(".chunks") for u in summary["users"])
+    # bob has a copy of isabell's home and document root, and big on top
+    dedup = summary["dedup"]
+    assert dedup["new_bytes"] < dedup["bytes"]
+    assert dedup["dedup_ratio"] > 1
+
+    new_host = tmp_path / "new_host"
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+    summary = Batch(
+        "takein",
+        [("bob", None)],
+        archives,
+        HostContext(new_host, "andromeda.uberspace.de"),
+    ).run()
+    assert summary["failed"] == []
+    assert (new_host / "home/bob/big").read_bytes() == b"x" * 100000
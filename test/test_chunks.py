@@ -0,0 +1,197 @@
+import io
+import os
+import random
+import shutil
+from pathlib import Path
+
+import pytest
+
+from uberspace_takeout import chunks
+from uberspace_takeout import Takeout
+from uberspace_takeout.chunks import ChunkStore
+from uberspace_takeout.items.base import TakeoutItem
+from uberspace_takeout.storage import archive_class
+from uberspace_takeout.storage import ChunkStorage
+from uberspace_takeout.storage import TarStorage
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+
+def split(data):
+    return list(chunks.split(io.BytesIO(data)))
+
+
+def test_split():
+    data = random_bytes(3 * 1024 * 1024)
+    parts = split(data)
+
+    assert b"".join(parts) == data
+    assert len(parts) > 3
+    assert all(chunks.MIN_SIZE <= len(p) <= chunks.MAX_SIZE for p in parts[:-1])
+    assert split(data) == parts
+    assert split(b"") == []
+    assert split(b"small") == [b"small"]
+
+
+def test_split_shifted():
+    data = random_bytes(3 * 1024 * 1024)
+    parts = split(data)
+
+    # inserting a few bytes at the start only changes the first chunk
+    shifted = split(b"inserted" + data)
+    assert shifted[1:] == parts[1:]
+
+
+def test_store(tmp_path):
+    store = ChunkStore(tmp_path, "gzip")
+    data = b"hello " * 1000
+
+    digest = store.put(data)
+    assert store.put(data) == digest
+    assert store.get(digest) == data
+    assert len(list(tmp_path.glob("*/*"))) == 1
+
+    report = store.report()
+    assert report["chunks"] == 2
+    assert report["new_chunks"] == 1
+    assert report["duplicate_bytes"] == len(data)
+    assert report["dedup_ratio"] == 2
+    assert report["stored_bytes"] < len(data)
+
+    # random data is stored as it is
+    noise = random_bytes(1000)
+    assert os.path.getsize(store._path(store.put(noise))) == len(noise) + 1
+
+
+def test_store_corrupted(tmp_path):
+    store = ChunkStore(tmp_path, "none")
+    digest = store.put(b"some data")
+
+    with open(store._path(digest), "r+b") as f:
+        f.seek(1)
+        f.write(b"S")
+    with pytest.raises(Exception) as ex:
+        store.get(digest)
+    assert "corrupted" in str(ex.value)
+
+    os.unlink(store._path(digest))
+    with pytest.raises(Exception) as ex:
+        store.get(digest)
+    assert "missing" in str(ex.value)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "dir" / "sub").mkdir(parents=True)
+    (tree / "dir" / "big").write_bytes(random_bytes(2 * 1024 * 1024))
+    (tree / "dir" / "sub" / "copy").write_bytes(random_bytes(2 * 1024 * 1024))
+    (tree / "empty").write_bytes(b"")
+    (tree / "link").symlink_to("dir/big")
+    os.link(str(tree / "dir" / "big"), str(tree / "hardlink"))
+    os.chmod(str(tree / "dir" / "sub"), 0o750)
+    os.utime(str(tree / "dir"), (1000000, 1000000))
+    return tree
+
+
+def test_chunk_storage(tmp_path, tree):
+    archive = tmp_path / "test.chunks"
+    with ChunkStorage(archive, "takeout", tmp_path / "store") as stor:
+        stor.store_text("some text", "conf/text")
+        stor.store_file(str(tree), "home")
+        stats = stor.stats()
+
+    # the copy of big is only stored once
+    assert stats["duplicate_bytes"] == 2 * 1024 * 1024
+    assert ChunkStorage.is_archive(archive)
+    assert archive_class(archive) is ChunkStorage
+    assert archive_class(tmp_path / "test.tar") is TarStorage
+
+    restored = tmp_path / "restored"
+    with ChunkStorage(archive, "takein") as stor:
+        assert stor.unstore_text("conf/text") == "some text"
+        assert sorted(stor.list_files("home")) == [
+            "dir",
+            "empty",
+            "hardlink",
+            "link",
+        ]
+        assert stor.list_paths("home/dir/sub") == ["home/dir/sub", "home/dir/sub/copy"]
+        with stor.open_file("home/dir/big") as f:
+            assert f.read() == (tree / "dir" / "big").read_bytes()
+        stor.unstore_file("home", str(restored))
+
+    for name in ("dir/big", "dir/sub/copy", "empty", "hardlink"):
+        assert (restored / name).read_bytes() == (tree / name).read_bytes()
+    assert os.readlink(str(restored / "link")) == "dir/big"
+    assert os.path.samefile(str(restored / "hardlink"), str(restored / "dir/big"))
+    assert os.stat(str(restored / "dir" / "sub")).st_mode & 0o777 == 0o750
+    assert os.stat(str(restored / "dir")).st_mtime == 1000000
+
+
+def test_chunk_storage_incomplete(tmp_path, tree):
+    archive = tmp_path / "test.chunks"
+    with pytest.raises(RuntimeError):
+        with ChunkStorage(archive, "takeout") as stor:
+            stor.store_file(str(tree), "home")
+            raise RuntimeError()
+
+    with pytest.raises(Exception) as ex:
+        ChunkStorage(archive, "takein").__enter__()
+    assert "incomplete" in str(ex.value)
+
+
+def test_chunk_storage_escape(tmp_path, tree):
+    archive = tmp_path / "test.chunks"
+    with ChunkStorage(archive, "takeout") as stor:
+        stor.store_file(str(tree), "home")
+    lines = archive.read_text().splitlines()
+    lines.insert(1, '{"path": "home/../../evil", "type": "text", "text": ""}')
+    archive.write_text("\n".join(lines) + "\n")
+
+    with pytest.raises(Exception) as ex:
+        ChunkStorage(archive, "takein").__enter__()
+    assert "illegal path" in str(ex.value)
+
+
+def test_takeout_shared_store(tmp_path, mocker):
+    host = tmp_path / "host"
+    new_host = tmp_path / "new_host"
+    shutil.copytree(
+        str(Path(__file__).parent / "uberspaces" / "u6" / "isabell"),
+        str(host),
+        symlinks=True,
+    )
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+    (host / "home/isabell/big").write_bytes(random_bytes(1024 * 1024))
+    shutil.copytree(str(host / "home/isabell"), str(host / "home/bob"), symlinks=True)
+    shutil.copytree(
+        str(host / "var/www/virtual/isabell"), str(host / "var/www/virtual/bob")
+    )
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+
+    store = tmp_path / "store"
+    reports = []
+    for username in ("isabell", "bob"):
+        t = Takeout("andromeda.uberspace.de", root=host)
+        t.takeout(tmp_path / (username + ".chunks"), username, chunk_store=store)
+        reports.append(t.storage_stats)
+
+    # bob's home is a copy of isabell's
+    assert reports[0]["new_bytes"] > 1024 * 1024
+    assert reports[1]["new_bytes"] == 0
+    assert reports[1]["duplicate_bytes"] == reports[1]["bytes"]
+
+    t = Takeout("andromeda.uberspace.de", root=new_host)
+    t.takein(tmp_path / "bob.chunks", "bob")
+    assert (new_host / "home/bob/big").read_bytes() == (
+        host / "home/bob/big"
+    ).read_bytes()
+    assert "conf/cronjobs" in t.ls(tmp_path / "bob.chunks", "conf")
@@ -0,0 +1,83 @@
+import io
+import shutil
+import sys
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from uberspace_takeout.__main__ import main
+from uberspace_takeout.items.base import TakeoutItem
+from uberspace_takeout.storage import TarStorage
+
+
+@pytest.fixture
+def host(tmp_path, mocker):
+    host = tmp_path / "host"
+    shutil.copytree(
+        str(Path(__file__).parent / "uberspaces" / "u6" / "isabell"),
+        str(host),
+        symlinks=True,
+    )
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+    return host
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["uberspace-takeout", *args])
+    # takeouts to stdout print to stderr instead
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    return main()
+
+
+def test_takeout_redirected_stdout(host, monkeypatch, mocker, capfdbinary):
+    # e.g. takeout --tar-file - > file.tar.bz2, stdout is a regular file then
+    exit = mocker.spy(TarStorage, "__exit__")
+
+    run_main(
+        monkeypatch,
+        "takeout",
+        "--root",
+        str(host),
+        "--username",
+        "isabell",
+        "--tar-file",
+        "-",
+    )
+
+    # there is no place for them next to /dev/stdout
+    storage = exit.call_args[0][0]
+    assert not storage._checkpointing
+
+    out, err = capfdbinary.readouterr()
+    with tarfile.open(fileobj=io.BytesIO(out)) as tar:
+        assert "home/.my.cnf" in tar.getnames()
+
+
+def test_ls_cat_options_first(tmp_path, monkeypatch, capfd):
+    path = str(tmp_path / "test.tar.bz2")
+    with TarStorage(path, "takeout") as s:
+        s.store_text("@daily true\n", "conf/cronjobs")
+
+    # in the order the README uses
+    assert run_main(monkeypatch, "ls", "--tar-file", path, "conf/") == 0
+    assert capfd.readouterr().out == "conf/cronjobs\n"
+
+    assert run_main(monkeypatch, "cat", "--tar-file", path, "conf/cronjobs") == 0
+    assert capfd.readouterr().out == "@daily true\n"
+
+
+@pytest.mark.parametrize(
+    "option", ["--jobs", "--parallel-items", "--batch-processes", "--max-commands"]
+)
+def test_positive_options(monkeypatch, capfd, option):
+    with pytest.raises(SystemExit) as ex:
+        run_main(monkeypatch, "takeout", option, "0")
+
+    assert ex.value.code == 2
+    assert "must be at least 1" in capfd.readouterr().err
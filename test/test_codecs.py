@@ -0,0 +1,221 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+from uberspace_takeout import codecs
+from uberspace_takeout.storage import TarStorage
+from uberspace_takeout.storage import TarStreamStorage
+
+available_codecs = [
+    pytest.param(
+        name,
+        marks=pytest.mark.skipif(
+            not codec.available, reason="needs " + str(codec.requires)
+        ),
+    )
+    for name, codec in codecs.CODECS.items()
+]
+
+
+@pytest.mark.parametrize("name", available_codecs)
+def test_codec_roundtrip(name):
+    codec = codecs.get_codec(name)
+    data = b"some data " * 1000
+
+    compressed = codec.compress(data) + codec.compress(data, level=1)
+    assert codecs.detect_codec(compressed) is codec
+    assert codec.open_read(io.BytesIO(compressed)).read() == data + data
+
+
+@pytest.mark.parametrize("name", available_codecs)
+def test_codec_tarstorage(name, tmp_path):
+    path = tmp_path / "test.tar"
+
+    with TarStorage(path, "takeout", compression=name) as s:
+        s.store_text("some text 1", "simple_text.txt")
+        s.store_text("some text 2", "subdir/bla/simple_text.txt")
+
+    with TarStorage(path, "takein") as s:
+        assert s.codec.name == name
+        # read backwards on purpose, so the reader has to seek
+        assert s.unstore_text("subdir/bla/simple_text.txt") == "some text 2"
+        assert s.unstore_text("simple_text.txt") == "some text 1"
+
+    with TarStreamStorage(path, "takein") as s:
+        assert s.unstore_text("simple_text.txt") == "some text 1"
+
+
+def test_parse_compression():
+    assert codecs.parse_compression("gzip") == (codecs.CODECS["gzip"], None)
+    assert codecs.parse_compression("xz:9") == (codecs.CODECS["xz"], 9)
+
+    with pytest.raises(ValueError) as ex:
+        codecs.parse_compression("rar")
+    assert 'unknown compression "rar"' in str(ex)
+
+    with pytest.raises(ValueError) as ex:
+        codecs.parse_compression("gzip:fast")
+    assert 'invalid compression level "fast"' in str(ex)
+
+
+def test_unavailable_codec(mocker):
+    mocker.patch.object(codecs, "zstandard", None)
+
+    with pytest.raises(ValueError) as ex:
+        codecs.get_codec("zstd")
+    assert 'needs the python package "zstandard"' in str(ex)
+
+    with pytest.raises(ValueError):
+        codecs.detect_codec(codecs.ZstdCodec.magic + b"...")
+
+
+def test_detect_plain_tar():
+    assert codecs.detect_codec(b"some_file.txt\0\0\0") is codecs.CODECS["none"]
+
+
+@pytest.mark.parametrize("name", available_codecs)
+def test_parallel_writer(name, tmp_path, mocker):
+    mocker.patch.object(codecs.ParallelCompressWriter, "block_size", 1000)
+    data = b"".join(b"line %d\n" % i for i in range(2000))
+
+    with (tmp_path / "data").open("wb") as f:
+        with codecs.open_writer(f, codecs.get_codec(name), jobs=3) as writer:
+            writer.write(data[:10])
+            writer.write(data[10:])
+
+    compressed = (tmp_path / "data").read_bytes()
+    assert codecs.get_codec(name).open_read(io.BytesIO(compressed)).read() == data
+
+
+@pytest.mark.parametrize("name", ["gzip", "bz2", "xz"])
+def test_parallel_tarstorage_standard_tools(name, tmp_path, mocker):
+    mocker.patch.object(codecs.ParallelCompressWriter, "block_size", 1000)
+    path = tmp_path / "test.tar"
+
+    with TarStorage(path, "takeout", compression=name, jobs=2) as s:
+        for i in range(20):
+            s.store_text("some text {}\n".format(i) * 50, "texts/{}.txt".format(i))
+
+    with TarStorage(path, "takein") as s:
+        assert s.unstore_text("texts/19.txt") == "some text 19\n" * 50
+
+    expected = ["texts/{}.txt".format(i) for i in range(20)]
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames()[:20] == expected
+
+    if shutil.which("tar"):
+        out = subprocess.check_output(["tar", "-tf", str(path)])
+        assert out.decode().split()[:20] == expected
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+@pytest.mark.parametrize("name", available_codecs)
+def test_frame_reader(name, jobs, tmp_path, mocker):
+    mocker.patch.object(codecs.ParallelCompressWriter, "block_size", 1000)
+    data = b"".join(b"line %d\n" % i for i in range(2000))
+
+    with (tmp_path / "data").open("wb") as f:
+        with codecs.open_writer(f, codecs.get_codec(name), jobs=jobs) as writer:
+            writer.write(data[:5000])
+            start = writer.end_frame()
+            writer.write(data[5000:])
+            writer.end_frame()
+            frames = writer.frames
+
+    assert frames[0] == (0, 0)
+    assert start[1] == 5000 and start in frames
+
+    with (tmp_path / "data").open("rb") as f:
+        reader = codecs.FrameReader(f, codecs.get_codec(name), frames)
+        for offset in (10000, 5000, 5001, 12000, 0, 4999):
+            reader.seek(offset)
+            assert reader.read(100) == data[offset : offset + 100]
+
+
+def test_is_incompressible(tmp_path):
+    (tmp_path / "text").write_bytes(b"some text " * 10000)
+    (tmp_path / "random").write_bytes(os.urandom(100000))
+    (tmp_path / "photo.JPG").write_bytes(b"some text " * 10000)
+
+    assert not codecs.is_incompressible(tmp_path / "text")
+    assert codecs.is_incompressible(tmp_path / "random")
+    # trusted without looking
+    assert codecs.is_incompressible(tmp_path / "photo.JPG")
+    assert not codecs.is_incompressible(tmp_path / "missing")
+
+
+stored_codecs = [
+    p
+    for p in available_codecs
+    if p.values[0] != "none" and codecs.get_codec(p.values[0]).store_level is not None
+]
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+@pytest.mark.parametrize("jobs", [1, 3])
+@pytest.mark.parametrize("name", stored_codecs)
+def test_stored_frames(name, jobs, pipeline, tmp_path, mocker):
+    mocker.patch.object(codecs.ParallelCompressWriter, "block_size", 100000)
+    codec = codecs.get_codec(name)
+    text = b"some text " * 100000
+    random = os.urandom(500000)
+
+    with (tmp_path / "data").open("wb") as f:
+        with codecs.open_writer(f, codec, jobs=jobs, pipeline=pipeline) as writer:
+            writer.write(text)
+            writer.set_stored(True)
+            writer.write(random)
+            writer.set_stored(False)
+            writer.write(text)
+            writer.end_frame()
+            frames = writer.frames
+
+    # frames start where the stored data does
+    assert len(text) in [f[1] for f in frames]
+    assert os.path.getsize(str(tmp_path / "data")) < len(random) + len(text) / 10
+
+    with (tmp_path / "data").open("rb") as f:
+        assert codec.open_read(f).read() == text + random + text
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+@pytest.mark.parametrize("jobs", [1, 3])
+@pytest.mark.parametrize("name", stored_codecs)
+def test_tarstorage_store_incompressible(name, jobs, pipeline, tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "text").write_bytes(b"some text " * 100000)
+    (source / "random.bin").write_bytes(os.urandom(300000))
+    (source / "small.jpg").write_bytes(b"too small to matter")
+    path = tmp_path / "test.tar"
+
+    with TarStorage(
+        path,
+        "takeout",
+        compression=name,
+        jobs=jobs,
+        pipeline=pipeline,
+        store_incompressible=True,
+    ) as s:
+        s.store_directory(source, "dir")
+        s.store_text("some text", "text.txt")
+
+    with TarStorage(path, "takein") as s:
+        s.unstore_directory("dir", tmp_path / "target")
+        assert s.unstore_text("text.txt") == "some text"
+
+    for name in ("text", "random.bin", "small.jpg"):
+        assert (tmp_path / "target" / name).read_bytes() == (source / name).read_bytes()
+
+
+def test_tarstorage_store_incompressible_unsupported(tmp_path):
+    with pytest.raises(Exception, match="bz2"):
+        TarStorage(tmp_path / "test.tar", "takeout", store_incompressible=True)
+
+    # lz4's default is as fast as it gets, a stored mode would save nothing
+    assert codecs.get_codec("lz4").store_level is None
@@ -0,0 +1,194 @@
+import json
+import os
+import time
+
+import pytest
+
+from uberspace_takeout.commands import CommandRunner
+from uberspace_takeout.commands import RecordingRunner
+from uberspace_takeout.commands import ReplayRunner
+from uberspace_takeout.exc import CommandError
+from uberspace_takeout.exc import CommandTimeoutError
+from uberspace_takeout.items.base import TakeoutItem
+
+
+def test_runner_output():
+    runner = CommandRunner()
+    result = runner.run(["sh", "-c", "echo one; echo; echo two >&2; exit 3"])
+
+    assert result.lines == ["one", "two"]
+    assert result.returncode == 3
+
+
+def test_runner_long_lines():
+    runner = CommandRunner()
+    result = runner.run(
+        ["sh", "-c", "head -c 200000 /dev/zero | tr '\\0' x; echo; printf end"]
+    )
+
+    assert result.lines == ["x" * 200000, "end"]
+
+
+def test_runner_max_concurrent():
+    with pytest.raises(ValueError):
+        CommandRunner(max_concurrent=0)
+
+
+def test_runner_input():
+    runner = CommandRunner()
+    assert runner.run(["cat"], input_text="some\ninput\n").lines == ["some", "input"]
+
+
+def test_runner_env(monkeypatch):
+    monkeypatch.setenv("SUDO_USER", "root")
+    runner = CommandRunner()
+
+    assert "SUDO_USER" not in runner.env
+    assert runner.env["PATH"].startswith("/usr/local/bin/:")
+
+
+def test_runner_on_line():
+    runner = CommandRunner()
+    lines = []
+    runner.run(["sh", "-c", "echo a; echo b"], on_line=lines.append)
+
+    assert lines == ["a", "b"]
+
+
+def test_runner_timeout():
+    runner = CommandRunner()
+    start = time.monotonic()
+
+    with pytest.raises(CommandTimeoutError):
+        runner.run(["sleep", "10"], timeout=0.1)
+
+    assert time.monotonic() - start < 5
+
+
+def test_runner_concurrency():
+    runner = CommandRunner(max_concurrent=2)
+    start = time.monotonic()
+
+    results = runner.gather(
+        [runner.run_async(["sh", "-c", "sleep 0.2; echo " + str(i)]) for i in range(4)]
+    )
+
+    duration = time.monotonic() - start
+    assert [r.lines for r in results] == [["0"], ["1"], ["2"], ["3"]]
+    # two batches of two
+    assert 0.4 <= duration < 0.8 * 4
+
+
+def test_item_run_concurrently():
+    item = TakeoutItem("isabell", "example.com", None)
+    results = item.run_concurrently(
+        item.run_command_async(["echo", str(i)]) for i in range(3)
+    )
+
+    assert results == [["0"], ["1"], ["2"]]
+    assert item.run_command(["echo", "sync"]) == ["sync"]
+
+
+def test_item_run_many(tmp_path):
+    item = TakeoutItem("isabell", "example.com", None)
+    item.retry_delay = 0
+    marker = str(tmp_path / "marker")
+
+    failed = item.run_many(
+        [
+            ["true"],
+            # fails once, then works
+            [
+                "sh",
+                "-c",
+                "test -f {0} || {{ touch {0}; echo temporary failure; exit 1; }}".format(
+                    marker
+                ),
+            ],
+            ["sh", "-c", "echo broken; exit 2"],
+            ["sh", "-c", "echo domain already exists; exit 3"],
+        ],
+        retries=1,
+    )
+
+    assert len(failed) == 1
+    cmd, error = failed[0]
+    assert cmd[-1] == "echo broken; exit 2"
+    assert "exit code 2" in str(error) and "broken" in str(error)
+
+
+def test_item_run_many_retries(tmp_path):
+    item = TakeoutItem("isabell", "example.com", None)
+    item.retry_delay = 0
+    counter = tmp_path / "counter"
+
+    def cmd(message):
+        return ["sh", "-c", "echo x >> {}; echo {}; exit 1".format(counter, message)]
+
+    # permanent errors are only tried once
+    assert len(item.run_many([cmd("invalid domain")], retries=2)) == 1
+    assert len(counter.read_text().split()) == 1
+
+    counter.unlink()
+    assert len(item.run_many([cmd("database is locked")], retries=2)) == 1
+    assert len(counter.read_text().split()) == 3
+
+
+def test_record_replay(tmp_path):
+    cassette = str(tmp_path / "cassette.jsonl")
+    recorder = RecordingRunner(cassette)
+    recorder.run(["sh", "-c", "sleep 0.1; echo recorded"])
+    recorder.run(["cat"], input_text="some input\n")
+    recorder.run(["sh", "-c", "echo first; exit 1"])
+    with pytest.raises(CommandTimeoutError):
+        recorder.run(["sleep", "10"], timeout=0.1)
+    recorder.close()
+    # inputs might be passwords
+    assert os.stat(cassette).st_mode & 0o777 == 0o600
+
+    replay = ReplayRunner(cassette)
+    start = time.monotonic()
+    result = replay.run(["sh", "-c", "sleep 0.1; echo recorded"])
+    assert time.monotonic() - start >= 0.1
+    assert result.lines == ["recorded"]
+    assert result.returncode == 0
+
+    assert replay.run(["cat"], input_text="some input\n").lines == ["some input"]
+    assert replay.run(["sh", "-c", "echo first; exit 1"]).returncode == 1
+    with pytest.raises(CommandTimeoutError):
+        replay.run(["sleep", "10"])
+
+    with pytest.raises(CommandError):
+        replay.run(["cat"], input_text="other input")
+
+
+def test_replay_order_and_latency(tmp_path):
+    cassette = tmp_path / "cassette.jsonl"
+    cassette.write_text(
+        "".join(
+            json.dumps(
+                {
+                    "cmd": ["uberspace", "web", "domain", "add", "example.com"],
+                    "input": None,
+                    "returncode": returncode,
+                    "lines": [],
+                    "duration": 5,
+                }
+            )
+            + "\n"
+            for returncode in (1, 0)
+        )
+    )
+    replay = ReplayRunner(str(cassette), latency=0.1, max_concurrent=4)
+    cmd = ["uberspace", "web", "domain", "add", "example.com"]
+
+    start = time.monotonic()
+    results = replay.gather([replay.run_async(cmd) for _ in range(4)])
+
+    # served in the recorded order, then the last one again
+    assert [r.returncode for r in results] == [1, 0, 0, 0]
+    # concurrently, with the given latency instead of the recorded one
+    assert 0.1 <= time.monotonic() - start < 0.4
+
+    with pytest.raises(CommandTimeoutError):
+        replay.run(cmd, timeout=0.05)
@@ -0,0 +1,85 @@
+import errno
+import os
+import stat
+
+import pytest
+
+from uberspace_takeout import filecopy
+from uberspace_takeout.filecopy import TreeCopier
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "file").write_bytes(b"some data" * 100000)
+    (source / "sub" / "empty").write_bytes(b"")
+    (source / "sub" / "script").write_text("#!/bin/sh")
+    (source / "sub" / "script").chmod(0o750)
+    os.link(str(source / "file"), str(source / "sub" / "hardlink"))
+    os.symlink("../file", str(source / "sub" / "link"))
+    os.mkfifo(str(source / "fifo"))
+    os.utime(str(source / "sub"), (1000000, 1000000))
+    return source
+
+
+def test_treecopier(tree, tmp_path):
+    target = tmp_path / "target"
+    copier = TreeCopier(jobs=2)
+    copier.copy(tree, target)
+
+    assert (target / "file").read_bytes() == (tree / "file").read_bytes()
+    assert (target / "sub" / "empty").read_bytes() == b""
+    assert stat.S_IMODE((target / "sub" / "script").stat().st_mode) == 0o750
+    assert os.readlink(str(target / "sub" / "link")) == "../file"
+    assert stat.S_ISFIFO((target / "fifo").lstat().st_mode)
+    assert (target / "sub").stat().st_mtime == 1000000
+    assert (target / "sub" / "hardlink").stat().st_ino == (
+        target / "file"
+    ).stat().st_ino
+
+    # the source stays as it is
+    assert (tree / "file").exists()
+
+    counters = copier.counters
+    assert sum(c["files"] for c in counters.values()) == 3
+    assert sum(c["bytes"] for c in counters.values()) == 900000 + len("#!/bin/sh")
+
+
+def test_treecopier_fallback(tmp_path, mocker):
+    def unsupported(src, dst, size):
+        os.write(dst, b"half way")
+        raise OSError(errno.EXDEV, "nope")
+
+    mocker.patch.dict(
+        filecopy._COPY, {s: unsupported for s in filecopy.STRATEGIES[:-1]}
+    )
+    (tmp_path / "a").write_text("some text")
+    (tmp_path / "b").write_text("some more text")
+
+    copier = TreeCopier()
+    give_up = mocker.spy(copier, "_give_up")
+    for name in ("a", "b"):
+        strategy = copier.copy_contents(
+            str(tmp_path / name),
+            str(tmp_path / (name + ".copy")),
+            os.stat(str(tmp_path / name)),
+        )
+        assert strategy == "copy"
+
+    assert (tmp_path / "a.copy").read_text() == "some text"
+    assert (tmp_path / "b.copy").read_text() == "some more text"
+    assert copier.counters["copy"] == {"files": 2, "bytes": 23}
+    # not tried again for the second file
+    assert give_up.call_count == 3
+
+
+def test_treecopier_error(tmp_path, mocker):
+    def broken(src, dst, size):
+        raise OSError(errno.ENOSPC, "full")
+
+    mocker.patch.dict(filecopy._COPY, {s: broken for s in filecopy.STRATEGIES})
+    (tmp_path / "a").write_text("some text")
+
+    with pytest.raises(OSError):
+        TreeCopier().copy(tmp_path / "a", tmp_path / "b")
@@ -0,0 +1,59 @@
+import pickle
+import socket
+
+from uberspace_takeout import host
+from uberspace_takeout import Takeout
+from uberspace_takeout.host import HostContext
+from uberspace_takeout.items.base import TakeoutItem
+
+
+def write_release(root, text):
+    (root / "etc").mkdir(exist_ok=True)
+    (root / "etc" / "centos-release").write_text(text)
+
+
+def test_hostname_lazy(mocker):
+    getfqdn = mocker.patch("socket.getfqdn", return_value="host.example.com")
+
+    t = Takeout()
+    items = list(t.takeout_menu)
+    assert items and not getfqdn.called
+
+    assert t.hostname == "host.example.com"
+    assert TakeoutItem("user", None, None, host=t.host).hostname == "host.example.com"
+    assert getfqdn.call_count == 1
+
+
+def test_hostname_given(mocker):
+    getfqdn = mocker.spy(socket, "getfqdn")
+    assert HostContext(hostname="given.example.com").hostname == "given.example.com"
+    assert not getfqdn.called
+
+
+def test_uberspace_version(tmp_path, mocker):
+    write_release(tmp_path, "CentOS Linux release 7.9.2009 (Core)\n")
+    search = mocker.spy(host.re, "search")
+
+    context = HostContext(tmp_path)
+    for _ in range(10):
+        assert context.uberspace_version == 7
+    assert search.call_count == 1
+
+    # another host, e.g. when taking in what was taken out
+    write_release(tmp_path, "CentOS release 6.10 (Final)\n")
+    assert context.uberspace_version == 6
+
+    assert HostContext(tmp_path, uberspace_version=7).uberspace_version == 7
+
+
+def test_resolve_pickle(tmp_path, mocker):
+    mocker.patch("socket.getfqdn", return_value="host.example.com")
+    write_release(tmp_path, "CentOS release 6.10 (Final)\n")
+
+    context = pickle.loads(pickle.dumps(HostContext(tmp_path).resolve()))
+    (tmp_path / "etc" / "centos-release").unlink()
+    assert context.hostname == "host.example.com"
+    assert context.uberspace_version == 6
+
+    # no centos-release, the items will find out
+    assert HostContext(tmp_path).resolve().hostname == "host.example.com"
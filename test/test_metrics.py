@@ -0,0 +1,114 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+
+from uberspace_takeout import metrics
+from uberspace_takeout.items.base import TakeoutItem
+from uberspace_takeout.metrics import Metrics
+from uberspace_takeout.storage import TarStorage
+
+
+def records(output):
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_metrics_measure():
+    output = io.StringIO()
+    m = Metrics(output)
+
+    with m.measure("Item", "takeout") as item_metrics:
+        assert metrics.current() is item_metrics
+        metrics.add("files", 2)
+        metrics.add("bytes_read", 100)
+        metrics.add("custom")
+
+    assert metrics.current() is metrics.NULL
+
+    (record,) = records(output)
+    assert record["item"] == "Item"
+    assert record["action"] == "takeout"
+    assert record["files"] == 2
+    assert record["bytes_read"] == 100
+    assert record["custom"] == 1
+    assert record["commands"] == 0
+    assert record["wall_seconds"] >= 0
+    assert record["cpu_seconds"] >= 0
+    assert "error" not in record
+
+
+def test_metrics_error():
+    output = io.StringIO()
+
+    with pytest.raises(ValueError):
+        with Metrics(output).measure("Item", "takein"):
+            raise ValueError("broken")
+
+    assert records(output)[0]["error"] == "broken"
+
+
+def test_metrics_threads():
+    output = io.StringIO()
+    m = Metrics(output)
+    started = threading.Barrier(2)
+
+    def run(name):
+        with m.measure(name, "takeout"):
+            started.wait()
+            metrics.add("files", len(name))
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in ("a", "bbb")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert {r["item"]: r["files"] for r in records(output)} == {"a": 1, "bbb": 3}
+
+
+def test_metrics_profile(tmp_path):
+    with Metrics(profile_dir=str(tmp_path / "profile")).measure("Item", "takeout"):
+        sum(range(1000))
+
+    assert os.listdir(str(tmp_path / "profile")) == ["takeout-Item.prof"]
+
+
+def test_metrics_commands():
+    item = TakeoutItem("user", "host", None)
+
+    with Metrics().measure("Item", "takeout") as item_metrics:
+        item.metrics = item_metrics
+        item.run_command(["true"])
+        item.run_concurrently(item.run_command_async(["true"]) for _ in range(2))
+
+    assert item_metrics.counters["commands"] == 3
+    assert item_metrics.counters["command_seconds"] > 0
+
+
+def test_metrics_storage(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "file").write_text("x" * 10000)
+    (source / "file2").write_text("y" * 10)
+
+    output = io.StringIO()
+    m = Metrics(output)
+
+    with TarStorage(tmp_path / "test.tar.gz", "takeout", compression="gzip") as s:
+        with m.measure("Item", "takeout"):
+            s.store_directory(source, "dir")
+    m.storage(s)
+
+    with TarStorage(tmp_path / "test.tar.gz", "takein") as s:
+        with m.measure("Item", "takein"):
+            s.unstore_directory("dir", tmp_path / "target")
+
+    takeout, storage, takein = records(output)
+    assert (takeout["files"], takeout["bytes_read"]) == (2, 10010)
+    assert (takein["files"], takein["bytes_written"]) == (2, 10010)
+    assert storage["storage"] == "TarStorage"
+    assert storage["codec"] == "gzip"
+    assert storage["raw_bytes"] > 10010
+    assert storage["compressed_bytes"] == os.path.getsize(str(tmp_path / "test.tar.gz"))
@@ -0,0 +1,91 @@
+import grp
+import os
+import pwd
+import tarfile
+
+import pytest
+
+from uberspace_takeout.ownership import OwnerMap
+from uberspace_takeout.ownership import parse_user_map
+from uberspace_takeout.storage import TarStorage
+from uberspace_takeout.storage import TarStreamStorage
+
+ME = pwd.getpwuid(os.getuid())
+OTHER = next(u for u in pwd.getpwall() if u.pw_uid != ME.pw_uid)
+
+
+def member(uname, gname=None, uid=12345, gid=12345):
+    tarinfo = tarfile.TarInfo("file")
+    tarinfo.uname = uname
+    tarinfo.gname = gname if gname is not None else uname
+    tarinfo.uid = uid
+    tarinfo.gid = gid
+    return tarinfo
+
+
+def test_parse_user_map():
+    assert parse_user_map(["old:new", "a:b"]) == {"old": "new", "a": "b"}
+
+    for spec in ["old", "old:", ":new"]:
+        with pytest.raises(ValueError):
+            parse_user_map([spec])
+
+
+def test_ownermap_by_name():
+    owners = OwnerMap("nobody-here")
+    assert owners.resolve(member("root")) == (0, 0)
+
+
+def test_ownermap_user_map():
+    owners = OwnerMap("nobody-here", {"olduser": ME.pw_name})
+    assert owners.resolve(member("olduser")) == (ME.pw_uid, ME.pw_gid)
+
+
+def test_ownermap_fallback():
+    owners = OwnerMap(ME.pw_name)
+    assert owners.resolve(member("olduser")) == (ME.pw_uid, ME.pw_gid)
+
+    # nobody to fall back to, so keep the ids just like tarfile
+    owners = OwnerMap("nobody-here")
+    assert owners.resolve(member("olduser", uid=1, gid=2)) == (1, 2)
+
+
+def test_ownermap_cached(mocker):
+    getpwnam = mocker.spy(pwd, "getpwnam")
+    owners = OwnerMap(ME.pw_name)
+
+    for _ in range(100):
+        owners.resolve(member("root"))
+        owners.resolve(member("olduser"))
+
+    # the fallback and one lookup per distinct owner
+    assert getpwnam.call_count == 3
+
+
+@pytest.mark.parametrize("storage", [TarStorage, TarStreamStorage])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_tarstorage_owners(storage, jobs, tmp_path, mocker):
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "file").write_text("file")
+    os.symlink("sub/file", str(source / "link"))
+
+    with TarStorage(tmp_path / "test.tar", "takeout", compression="none") as s:
+        s.store_directory(source, "dir")
+
+    mocker.patch("os.geteuid", return_value=0)
+    lchown = mocker.patch("os.lchown")
+    owners = OwnerMap(ME.pw_name, {ME.pw_name: OTHER.pw_name})
+
+    with storage(tmp_path / "test.tar", "takein", jobs=jobs, owners=owners) as s:
+        s.unstore_directory("dir", tmp_path / "target")
+
+    try:
+        gid = grp.getgrnam(OTHER.pw_name).gr_gid
+    except KeyError:
+        gid = ME.pw_gid
+
+    target = tmp_path / "target"
+    assert sorted(c[0] for c in lchown.call_args_list) == [
+        (str(target / name), OTHER.pw_uid, gid) for name in ["link", "sub", "sub/file"]
+    ]
@@ -0,0 +1,119 @@
+import io
+import threading
+import time
+
+import pytest
+
+from uberspace_takeout import codecs
+from uberspace_takeout.pipeline import ByteBudgetQueue
+from uberspace_takeout.pipeline import PipelinedWriter
+from uberspace_takeout.pipeline import Prefetcher
+from uberspace_takeout.storage import TarStorage
+
+
+def test_byte_budget_queue():
+    q = ByteBudgetQueue(10)
+    q.put("a", 6)
+    # too large, but the queue isn't empty yet
+    blocked = threading.Thread(target=q.put, args=("b", 6))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+
+    assert q.get() == "a"
+    blocked.join(1)
+    assert not blocked.is_alive()
+    assert q.get() == "b"
+
+    # single items larger than the budget are fine
+    q.put("c", 100)
+    assert q.get() == "c"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_pipelined_writer(jobs):
+    codec = codecs.get_codec("gzip")
+    out = io.BytesIO()
+    data = b"".join(b"line %d\n" % i for i in range(10000))
+
+    writer = codecs.open_writer(out, codec, jobs=jobs, pipeline=True)
+    assert isinstance(writer, PipelinedWriter)
+    for i in range(0, len(data), 1000):
+        writer.write(data[i : i + 1000])
+    assert writer.tell() == len(data)
+    writer.close()
+
+    assert codec.open_read(io.BytesIO(out.getvalue())).read() == data
+
+
+def test_pipelined_writer_error():
+    class BrokenFile(io.BytesIO):
+        def write(self, data):
+            raise OSError("disk full")
+
+    writer = PipelinedWriter(
+        BrokenFile(), lambda f: codecs.CompressWriter(f, codecs.get_codec("none")), 10
+    )
+
+    with pytest.raises(OSError) as ex:
+        for _ in range(1000):
+            writer.write(b"0123456789")
+        writer.close()
+
+    assert "disk full" in str(ex)
+
+
+def test_pipelined_writer_compression_error():
+    class BrokenWriter(codecs.CompressWriter):
+        closed_writer = False
+
+        def write(self, data):
+            raise ValueError("compression failed")
+
+        def close(self):
+            # e.g. shuts down a process pool
+            self.closed_writer = True
+
+    writer = PipelinedWriter(
+        io.BytesIO(), lambda f: BrokenWriter(f, codecs.get_codec("none"))
+    )
+    writer.write(b"0123456789")
+
+    with pytest.raises(ValueError):
+        writer.close()
+    assert writer.writer.closed_writer
+
+
+def test_prefetcher(tmp_path):
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "file").write_bytes(b"x" * 100)
+    (tmp_path / "a").write_bytes(b"x" * 100)
+    (tmp_path / "link").symlink_to(tmp_path / "a")
+
+    prefetcher = Prefetcher(tmp_path, lambda: 0, window=150)
+    assert list(prefetcher._files(str(tmp_path))) == [
+        str(tmp_path / "a"),
+        str(tmp_path / "b" / "file"),
+    ]
+
+    # stops reading once it is more than the window ahead, and stop() still works
+    prefetcher.start()
+    deadline = time.monotonic() + 5
+    while prefetcher.prefetched < 200 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    prefetcher.stop()
+    assert prefetcher.prefetched == 200
+
+
+def test_pipelined_tarstorage(tmp_path):
+    (tmp_path / "dir" / "sub").mkdir(parents=True)
+    for i in range(50):
+        (tmp_path / "dir" / "sub" / str(i)).write_text("some text {}".format(i))
+
+    with TarStorage(tmp_path / "test.tar", "takeout", pipeline=True) as s:
+        s.store_text("some text", "text.txt")
+        s.store_directory(tmp_path / "dir", "dir")
+
+    with TarStorage(tmp_path / "test.tar", "takein") as s:
+        assert s.unstore_text("text.txt") == "some text"
+        assert s.unstore_text("dir/sub/42") == "some text 42"
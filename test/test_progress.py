@@ -0,0 +1,82 @@
+import io
+import json
+
+from uberspace_takeout.progress import Progress
+from uberspace_takeout.progress import scan_tree
+from uberspace_takeout.storage import TarStorage
+
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+
+def make_tree(root):
+    (root / "sub").mkdir(parents=True)
+    (root / "a").write_text("a" * 1000)
+    (root / "sub" / "b").write_text("b" * 500)
+    (root / "link").symlink_to("a")
+
+
+def events(output):
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_scan_tree(tmp_path):
+    make_tree(tmp_path / "tree")
+    assert scan_tree(tmp_path / "tree") == (2, 1500)
+    assert scan_tree(tmp_path / "missing") == (0, 0)
+
+
+def test_progress_takeout_takein(tmp_path):
+    make_tree(tmp_path / "tree")
+    output = io.StringIO()
+    progress = Progress(events=output, interval=0.01)
+
+    with TarStorage(tmp_path / "test.tar", "takeout", progress=progress) as s:
+        with progress:
+            progress.scan([tmp_path / "tree"]).join()
+            s.store_directory(tmp_path / "tree", "tree")
+
+    (done,) = [e for e in events(output) if e["event"] == "done"]
+    assert (done["files"], done["bytes"]) == (2, 1500)
+    assert (done["total_files"], done["total_bytes"]) == (2, 1500)
+    assert done["compressed_bytes"] is not None
+    assert {"event": "scan", "files": 2, "bytes": 1500} in events(output)
+
+    output = io.StringIO()
+    progress = Progress(events=output, interval=0.01)
+    with TarStorage(tmp_path / "test.tar", "takein", progress=progress) as s:
+        with progress:
+            s.unstore_directory("tree", tmp_path / "target")
+
+    (done,) = [e for e in events(output) if e["event"] == "done"]
+    assert (done["files"], done["bytes"]) == (2, 1500)
+    assert (done["total_files"], done["total_bytes"]) == (2, 1500)
+    assert done["eta"] == 0
+
+
+def test_progress_terminal():
+    output = Terminal()
+    progress = Progress(output, interval=60)
+
+    with progress:
+        progress.add_total(10, 2000000)
+        progress.add(5, 1000000)
+        progress.draw()
+        progress.item("Homedir", "takeout")
+
+    text = output.getvalue()
+    assert text.startswith("\r\x1b[K5 files of 10, 1.0 MB of 2.0 MB, ")
+    assert "ETA 0:00:00" in text
+    # cleared for the item, and left on a line of its own when done
+    assert text.count("\r\x1b[K") == 3
+    assert text.endswith("\n")
+
+
+def test_progress_disabled():
+    progress = Progress()
+
+    with progress:
+        assert progress.scan(["/"]) is None
+        progress.add(1, 100)
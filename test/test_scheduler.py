@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from uberspace_takeout.scheduler import Scheduler
+from uberspace_takeout.scheduler import Task
+
+
+def recording_task(name, log, dependencies=(), duration=0):
+    def run():
+        log.append(("start", name))
+        time.sleep(duration)
+        log.append(("end", name))
+
+    return Task(name, run, dependencies)
+
+
+def test_scheduler_sequential():
+    log = []
+    Scheduler(1).run(
+        [
+            recording_task("b", log, ["a"]),
+            recording_task("a", log),
+            recording_task("c", log, ["skipped"]),
+        ]
+    )
+
+    assert [name for event, name in log if event == "start"] == ["a", "b", "c"]
+
+
+def test_scheduler_dependencies():
+    log = []
+    Scheduler(4).run(
+        [
+            recording_task("first", log, duration=0.05),
+            recording_task("a", log, ["first"], duration=0.05),
+            recording_task("b", log, ["first"], duration=0.05),
+            recording_task("last", log, ["a", "b"]),
+        ]
+    )
+
+    assert log[:2] == [("start", "first"), ("end", "first")]
+    assert log[-2:] == [("start", "last"), ("end", "last")]
+    # a and b overlap
+    assert {e for e, _ in log[2:4]} == {"start"}
+
+
+def test_scheduler_limit():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def run():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    Scheduler(3).run([Task(str(i), run) for i in range(10)])
+
+    assert max(peak) == 3
+
+
+def test_scheduler_error():
+    log = []
+
+    def fail():
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        Scheduler(2).run(
+            [
+                recording_task("slow", log, duration=0.05),
+                Task("fail", fail),
+                recording_task("after", log, ["fail"]),
+            ]
+        )
+
+    # running tasks finish, no new ones are started
+    assert log == [("start", "slow"), ("end", "slow")]
+
+
+def test_scheduler_cycle():
+    with pytest.raises(Exception) as ex:
+        Scheduler(2).run([Task("a", print, ["b"]), Task("b", print, ["a"])])
+
+    assert "circular dependencies" in str(ex)
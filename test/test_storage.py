@@ -1,8 +1,17 @@
+import errno
+import os
+import tarfile
+import threading
+
 import pytest
 
+from uberspace_takeout.extract import ParallelExtractor
+from uberspace_takeout.index import IndexingTarFile
 from uberspace_takeout.storage import LocalMoveStorage
+from uberspace_takeout.storage import LockedStorage
 from uberspace_takeout.storage import Storage
 from uberspace_takeout.storage import TarStorage
+from uberspace_takeout.storage import TarStreamStorage
 
 
 @pytest.mark.parametrize("mode", ["takeout", "takein",])
@@ -189,3 +198,590 @@ def test_localmovestorage_directory_removed(tmp_path, test_dir):
         assert test_dir.exists()
         s.store_directory(test_dir, "dir")
         assert not test_dir.exists()
+
+
+def test_tarstorage_index(tmp_path, test_dir):
+    with TarStorage(tmp_path / "test.tar.gz", "takeout") as s:
+        s.store_text("some text", "a/text.txt")
+        assert s.has_member("a/text.txt")
+        assert not s.has_member("dir")
+
+        s.store_directory(test_dir, "dir")
+        assert s.has_member("dir")
+        assert s.has_member("dir/some_subdir/file2.txt")
+
+    with TarStorage(tmp_path / "test.tar.gz", "takein") as s:
+        assert not s.has_member("a")
+        assert s.has_member("dir/")
+        assert s.get_member("dir/file.txt").size == len("some file text")
+        assert [m.name for m in s.get_members_in("dir")] == [
+            "file.txt",
+            "some_subdir",
+            "some_subdir/file2.txt",
+        ]
+        assert [m.name for m in s.get_members_in("dir/some_subdir/")] == [
+            "file2.txt"
+        ]
+        assert list(s.get_members_in("dir/file.txt")) == []
+        assert list(s.get_members_in("nope")) == []
+
+        with pytest.raises(FileNotFoundError):
+            s.get_member("dir/nope.txt")
+
+
+def test_tarstorage_index_duplicates(tmp_path):
+    with TarStorage(tmp_path / "test.tar.gz", "takeout") as s:
+        s.store_text("first", "text.txt")
+        s.store_text("second", "text.txt")
+
+    with TarStorage(tmp_path / "test.tar.gz", "takein") as s:
+        assert s.unstore_text("text.txt") == "second"
+
+        with pytest.raises(Exception) as ex:
+            s.get_member("text.txt")
+
+        assert "There are 2 files matching" in str(ex)
+
+
+@pytest.mark.parametrize(
+    "name", ["../evil.txt", "/etc/evil.txt", "./evil.txt", "dir/../../evil.txt"]
+)
+def test_tarstorage_illegal_names(tmp_path, name):
+    with tarfile.open(tmp_path / "test.tar.gz", "w:bz2") as tar:
+        tar.addfile(tarfile.TarInfo(name))
+
+    with pytest.raises(Exception) as ex:
+        with TarStorage(tmp_path / "test.tar.gz", "takein"):
+            pass
+
+    assert "illegal name" in str(ex)
+
+
+def test_tarstorage_takeout_unsupported(tmp_path, test_dir):
+    # takeouts store everything, only takein refuses what it can't restore
+    (test_dir / "a..b").write_text("dots")
+    os.link(str(test_dir / "file.txt"), str(test_dir / "hardlink"))
+    os.mkfifo(str(test_dir / "fifo"))
+
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(test_dir, "dir")
+        assert s.has_member("dir/hardlink")
+        assert s.has_member("dir/fifo")
+
+    with pytest.raises(Exception) as ex:
+        TarStorage(tmp_path / "test.tar.bz2", "takein").__enter__()
+    assert "illegal type" in str(ex.value)
+
+    (test_dir / "hardlink").unlink()
+    (test_dir / "fifo").unlink()
+    with TarStorage(tmp_path / "test2.tar.bz2", "takeout") as s:
+        s.store_directory(test_dir, "dir")
+    with TarStorage(tmp_path / "test2.tar.bz2", "takein") as s:
+        s.unstore_directory("dir", tmp_path / "new_dir")
+    assert (tmp_path / "new_dir" / "a..b").read_text() == "dots"
+
+
+@pytest.mark.parametrize(
+    "typeflag, linkname, message",
+    [
+        (tarfile.LNKTYPE, b"/etc/passwd", "illegal type"),
+        (tarfile.SYMTYPE, b"/etc/passwd", "doesn't match the archive index"),
+    ],
+)
+def test_tarstorage_archive_index_tampered(tmp_path, typeflag, linkname, message):
+    path = tmp_path / "test.tar"
+    with TarStorage(path, "takeout", compression="none") as s:
+        s.store_text("harmless", "home/evil")
+        (offset,) = [e.offset for e in s.tar.index_entries if e.name == "home/evil"]
+
+    # the index still lists a file, but the header is something else
+    data = bytearray(path.read_bytes())
+    header = data[offset : offset + tarfile.BLOCKSIZE]
+    header[156:157] = typeflag
+    header[157:257] = linkname.ljust(100, b"\0")
+    header[148:156] = b" " * 8
+    header[148:156] = b"%06o\0 " % sum(header)
+    data[offset : offset + tarfile.BLOCKSIZE] = header
+    path.write_bytes(bytes(data))
+
+    with TarStorage(path, "takein") as s:
+        assert s.index is not None
+        with pytest.raises(Exception) as ex:
+            s.unstore_directory("home", tmp_path / "out")
+
+    assert message in str(ex.value)
+    assert not (tmp_path / "out" / "evil").exists()
+
+
+@pytest.mark.parametrize("compression", ["none", "bz2"])
+def test_tarstorage_archive_index(tmp_path, test_dir, compression, mocker):
+    with TarStorage(tmp_path / "test.tar", "takeout", compression=compression) as s:
+        s.store_text("some text", "conf/text.txt")
+        s.store_directory(test_dir, "dir")
+
+    # members come from the index, not from reading the whole archive
+    mocker.patch.object(tarfile.TarFile, "getmembers", side_effect=AssertionError)
+
+    with TarStorage(tmp_path / "test.tar", "takein") as s:
+        assert s.index is not None
+        assert s.manifest is not None
+        assert s.unstore_text("conf/text.txt") == "some text"
+        assert s.list_paths("dir") == [
+            "dir",
+            "dir/file.txt",
+            "dir/some_subdir",
+            "dir/some_subdir/file2.txt",
+        ]
+        assert s.list_paths()[0] == "conf/text.txt"
+
+        with s.open_file("dir/some_subdir/file2.txt") as f:
+            assert f.read() == b"some file text 2"
+        with pytest.raises(IsADirectoryError):
+            s.open_file("dir/some_subdir")
+        with pytest.raises(FileNotFoundError):
+            s.list_paths("nope")
+
+        s.unstore_directory("dir", tmp_path / "new_dir")
+
+    assert (
+        tmp_path / "new_dir/some_subdir/file2.txt"
+    ).read_text() == "some file text 2"
+
+
+def test_tarstorage_archive_index_corrupted(tmp_path):
+    path = tmp_path / "test.tar"
+    with TarStorage(path, "takeout", compression="none") as s:
+        s.store_text("some text", "text.txt")
+
+    path.write_bytes(path.read_bytes().replace(b"some text", b"some test", 1))
+
+    with TarStorage(path, "takein") as s:
+        with pytest.raises(Exception) as ex:
+            s.unstore_text("text.txt")
+
+    assert "is corrupted" in str(ex)
+
+
+def test_tarstorage_without_archive_index(tmp_path, test_file):
+    # e.g. takeouts made by older versions
+    with tarfile.open(tmp_path / "test.tar.bz2", "w:bz2") as tar:
+        tar.add(str(test_file), "text.txt")
+
+    with TarStorage(tmp_path / "test.tar.bz2", "takein") as s:
+        assert s.index is None
+        assert s.unstore_text("text.txt") == "some file text"
+
+
+def test_tarstorage_late_text_frame(tmp_path, mocker):
+    mocker.patch.object(TarStorage, "text_frame_distance", 1000)
+    (tmp_path / "big").write_bytes(os.urandom(10000))
+
+    with TarStorage(tmp_path / "test.tar.gz", "takeout", compression="gzip") as s:
+        s.store_file(tmp_path / "big", "big")
+        s.store_text("some text", "text.txt")
+
+    with TarStorage(tmp_path / "test.tar.gz", "takein") as s:
+        # big, then text.txt, then manifest and index
+        assert len(s.index.frames) == 3
+        assert s.unstore_text("text.txt") == "some text"
+
+
+def test_lockedstorage(tmp_path, test_dir):
+    with TarStorage(tmp_path / "test.tar.gz", "takeout") as tar:
+        s = LockedStorage(tar)
+        s.store_text("some text", "conf/text.txt")
+        s.store_text("1.0", "conf/versions/tool")
+        s.store_directory(test_dir, "dir")
+
+    with TarStorage(tmp_path / "test.tar.gz", "takein") as tar:
+        s = LockedStorage(tar)
+        s.preload(["conf/text.txt", "conf/versions/", "conf/nope"])
+        assert s.unstore_text("conf/text.txt") == "some text"
+        assert s.list_files("conf/versions/") == ["tool"]
+        assert s.unstore_text("conf/versions/tool") == "1.0"
+        with pytest.raises(FileNotFoundError):
+            s.unstore_text("conf/nope")
+
+        s.unstore_directory("dir", tmp_path / "new_dir")
+
+    assert (tmp_path / "new_dir/file.txt").read_text() == "some file text"
+
+
+@pytest.fixture
+def stream_archive(tmp_path, test_dir):
+    path = tmp_path / "test.tar.bz2"
+
+    with TarStorage(path, "takeout") as s:
+        s.store_text("marker", ".marker")
+        s.store_directory(test_dir, "dir")
+        s.store_text("some text 1", "conf/one")
+        s.store_text("some text 2", "conf/two")
+        s.store_text("some text 3", "conf/list/a")
+        s.store_text("some text 4", "conf/list/b")
+
+    return path
+
+
+def test_tarstreamstorage(tmp_path, stream_archive):
+    with TarStreamStorage(stream_archive, "takein") as s:
+        assert s.unstore_text(".marker") == "marker"
+
+        s.unstore_directory("dir", tmp_path / "new_dir")
+
+        with (tmp_path / "new_dir" / "some_subdir/file2.txt").open() as f:
+            assert f.read() == "some file text 2"
+
+        # read past conf/one, which is kept in memory
+        assert s.unstore_text("conf/two") == "some text 2"
+        assert s.unstore_text("conf/one") == "some text 1"
+        assert s.unstore_text("conf/one") == "some text 1"
+        assert sorted(s.list_files("conf/list")) == ["a", "b"]
+
+        with pytest.raises(FileNotFoundError):
+            s.unstore_text("conf/missing")
+
+
+def test_tarstreamstorage_claims(tmp_path, stream_archive):
+    with TarStreamStorage(stream_archive, "takein") as s:
+        s.claim(["dir/", "conf/one"])
+
+        assert s.unstore_text("conf/two") == "some text 2"
+        assert s.unstore_text("conf/one") == "some text 1"
+
+        with pytest.raises(Exception) as ex:
+            s.unstore_directory("dir", tmp_path / "new_dir")
+
+        assert "already been read past" in str(ex)
+
+        with pytest.raises(FileNotFoundError):
+            s.unstore_text(".marker")
+
+
+def test_tarstreamstorage_takeout(tmp_path):
+    with pytest.raises(Exception) as ex:
+        with TarStreamStorage(tmp_path / "test.tar.bz2", "takeout"):
+            pass
+
+    assert "only be used for takein" in str(ex)
+
+
+def test_tarstreamstorage_pipe(tmp_path, stream_archive):
+    fifo = tmp_path / "fifo"
+    os.mkfifo(fifo)
+
+    def feed():
+        with open(fifo, "wb") as f:
+            f.write(stream_archive.read_bytes())
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    with TarStreamStorage(fifo, "takein") as s:
+        assert s.unstore_text(".marker") == "marker"
+        s.unstore_directory("dir/", tmp_path / "new_dir")
+        assert s.unstore_text("conf/two") == "some text 2"
+
+    feeder.join()
+
+    with (tmp_path / "new_dir" / "file.txt").open() as f:
+        assert f.read() == "some file text"
+
+
+@pytest.fixture
+def attr_dir(test_dir):
+    (test_dir / "link").symlink_to("file.txt")
+    (test_dir / "file.txt").chmod(0o640)
+    (test_dir / "some_subdir").chmod(0o750)
+    os.utime(test_dir / "file.txt", (1000000000, 1000000000))
+    os.utime(test_dir / "some_subdir", (1100000000, 1100000000))
+    return test_dir
+
+
+@pytest.mark.parametrize("storage", [TarStorage, TarStreamStorage])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_tarstorage_extract_attrs(storage, jobs, tmp_path, attr_dir):
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(attr_dir, "dir")
+
+    with storage(tmp_path / "test.tar.bz2", "takein", jobs=jobs) as s:
+        s.unstore_directory("dir", tmp_path / "new_dir")
+
+    new_dir = tmp_path / "new_dir"
+    assert (new_dir / "some_subdir/file2.txt").read_text() == "some file text 2"
+    assert os.readlink(new_dir / "link") == "file.txt"
+    assert (new_dir / "file.txt").stat().st_mode & 0o777 == 0o640
+    assert (new_dir / "file.txt").stat().st_mtime == 1000000000
+    assert (new_dir / "some_subdir").stat().st_mode & 0o777 == 0o750
+    assert (new_dir / "some_subdir").stat().st_mtime == 1100000000
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_tarstorage_unstore_directories(jobs, tmp_path, test_dir, mocker):
+    # make sure both the in-memory and the copying code path are used
+    mocker.patch.object(ParallelExtractor, "small_file_size", 14)
+
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(test_dir, "one")
+        s.store_directory(test_dir, "two")
+
+    with TarStorage(tmp_path / "test.tar.bz2", "takein", jobs=jobs) as s:
+        s.unstore_directories(
+            [("one", tmp_path / "new_one"), ("two/", tmp_path / "new_two")]
+        )
+
+        with pytest.raises(FileNotFoundError):
+            s.unstore_directories(
+                [("one", tmp_path / "new_one"), ("three", tmp_path / "new_three")]
+            )
+
+    for name in ("new_one", "new_two"):
+        assert (tmp_path / name / "file.txt").read_text() == "some file text"
+        assert (
+            tmp_path / name / "some_subdir" / "file2.txt"
+        ).read_text() == "some file text 2"
+
+
+@pytest.mark.parametrize("storage", [TarStorage, TarStreamStorage])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_tarstorage_unstore_directories_empty(storage, jobs, tmp_path, test_dir):
+    (tmp_path / "empty").mkdir()
+
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(test_dir, "home")
+        s.store_directory(tmp_path / "empty", "www")
+
+    with storage(tmp_path / "test.tar.bz2", "takein", jobs=jobs) as s:
+        with pytest.raises(FileNotFoundError) as ex:
+            s.unstore_directories(
+                [
+                    ("home", tmp_path / "new_home"),
+                    ("www", tmp_path / "new_www"),
+                    ("missing", tmp_path / "new_missing"),
+                ]
+            )
+
+    # only the missing tree fails
+    assert ex.value.filename == "missing"
+    assert (tmp_path / "new_home" / "file.txt").read_text() == "some file text"
+    assert os.listdir(str(tmp_path / "new_www")) == []
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+def test_tarstorage_incremental(tmp_path, test_dir, checksum):
+    with TarStorage(tmp_path / "base.tar.bz2", "takeout", checksum=checksum) as s:
+        s.store_directory(test_dir, "dir")
+        base_id = s.manifest.id
+
+    (test_dir / "file.txt").write_text("changed file text")
+    (test_dir / "new.txt").write_text("new file text")
+    (test_dir / "some_subdir" / "file2.txt").unlink()
+
+    with TarStorage(
+        tmp_path / "delta.tar.bz2",
+        "takeout",
+        since=tmp_path / "base.tar.bz2",
+        checksum=checksum,
+    ) as s:
+        s.store_directory(test_dir, "dir")
+
+    with TarStorage(tmp_path / "delta.tar.bz2", "takein") as s:
+        assert s.manifest.base == base_id
+        assert s.manifest.deleted == ["dir/some_subdir/file2.txt"]
+        assert s.has_member("dir/file.txt")
+        assert s.has_member("dir/new.txt")
+        assert s.has_member("dir/some_subdir")
+        assert not s.has_member("dir/some_subdir/file2.txt")
+
+    target = tmp_path / "new_dir"
+    for name in ("base", "delta"):
+        with TarStorage(tmp_path / (name + ".tar.bz2"), "takein") as s:
+            s.unstore_directory("dir", target)
+
+    assert (target / "file.txt").read_text() == "changed file text"
+    assert (target / "new.txt").read_text() == "new file text"
+    assert (target / "some_subdir").is_dir()
+    assert not (target / "some_subdir" / "file2.txt").exists()
+
+
+def test_tarstorage_incremental_unchanged(tmp_path, test_dir):
+    with TarStorage(tmp_path / "base.tar.bz2", "takeout") as s:
+        s.store_directory(test_dir, "dir")
+        s.store_text("some text", "text.txt")
+
+    manifest_path = tmp_path / "manifest.json"
+    with TarStorage(tmp_path / "base.tar.bz2", "takein") as s:
+        manifest_path.write_text(s.unstore_text(".uberspace_takeout.manifest"))
+
+    # type changes: the old file needs to be removed first
+    (test_dir / "some_subdir" / "file2.txt").unlink()
+    (test_dir / "some_subdir" / "file2.txt").mkdir()
+
+    with TarStorage(tmp_path / "delta.tar.bz2", "takeout", since=manifest_path) as s:
+        s.store_directory(test_dir, "dir")
+        s.store_text("some text", "text.txt")
+
+    with TarStorage(tmp_path / "delta.tar.bz2", "takein") as s:
+        assert not s.has_member("dir/file.txt")
+        assert s.has_member("dir/some_subdir/file2.txt")
+        assert s.manifest.deleted == ["dir/some_subdir/file2.txt"]
+        # texts are always stored in full
+        assert s.unstore_text("text.txt") == "some text"
+
+    target = tmp_path / "new_dir"
+    for name in ("base", "delta"):
+        with TarStorage(tmp_path / (name + ".tar.bz2"), "takein") as s:
+            s.unstore_directory("dir", target)
+
+    assert (target / "file.txt").read_text() == "some file text"
+    assert (target / "some_subdir" / "file2.txt").is_dir()
+
+
+@pytest.fixture
+def resume_dir(tmp_path):
+    tree = tmp_path / "resume_dir"
+    for i in range(20):
+        directory = tree / "d{}".format(i % 4)
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "f{:02}".format(i)).write_bytes(os.urandom(20000))
+    (tree / "d3" / "link").symlink_to("../d0/f00")
+    return tree
+
+
+def interrupted_takeout(path, tree, mocker, fail_after, **options):
+    # dies after storing a text and fail_after - 1 files, like on a full disk
+    addfile = IndexingTarFile.addfile
+    files = []
+
+    def failing_addfile(self, tarinfo, fileobj=None):
+        if tarinfo.isreg():
+            if len(files) >= fail_after:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            files.append(tarinfo.name)
+        return addfile(self, tarinfo, fileobj)
+
+    patch = mocker.patch.object(
+        IndexingTarFile, "addfile", autospec=True, side_effect=failing_addfile
+    )
+    with pytest.raises(OSError):
+        with TarStorage(path, "takeout", **options) as s:
+            s.store_text("some text", "conf/text")
+            s.item_done("Text")
+            s.store_directory(tree, "home")
+    mocker.stop(patch)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"compression": "none"},
+        {"compression": "gzip"},
+        {"compression": "gzip", "jobs": 2},
+        {"compression": "bz2", "pipeline": True},
+    ],
+)
+def test_tarstorage_resume(tmp_path, resume_dir, mocker, options):
+    mocker.patch.object(TarStorage, "checkpoint_size", 50000)
+    contents = {p: p.read_bytes() for p in resume_dir.rglob("f*")}
+    with TarStorage(tmp_path / "clean.tar", "takeout", **options) as s:
+        s.store_text("some text", "conf/text")
+        s.store_directory(resume_dir, "home")
+
+    archive = tmp_path / "resumed.tar"
+    interrupted_takeout(archive, resume_dir, mocker, 12, **options)
+    # a checkpoint cut off while being written
+    with open(str(archive) + ".checkpoint", "a") as f:
+        f.write('{"offsets": [')
+    # stored before the last checkpoint, so it is not read again
+    (resume_dir / "d0" / "f04").write_bytes(b"changed")
+
+    # the compression is the one the takeout was started with
+    with TarStorage(archive, "takeout", compression="xz", resume=True) as s:
+        assert s.done_items == ["Text"]
+        s.store_directory(resume_dir, "home")
+    assert not os.path.exists(str(archive) + ".checkpoint")
+
+    with tarfile.open(str(tmp_path / "clean.tar")) as clean, tarfile.open(
+        str(archive)
+    ) as resumed:
+        assert resumed.getnames() == clean.getnames()
+
+    target = tmp_path / "target"
+    with TarStorage(archive, "takein") as s:
+        assert s.unstore_text("conf/text") == "some text"
+        s.unstore_directory("home", target)
+    for path, content in contents.items():
+        assert (target / path.relative_to(resume_dir)).read_bytes() == content
+    assert os.readlink(str(target / "d3" / "link")) == "../d0/f00"
+
+
+def test_tarstorage_resume_texts(tmp_path, resume_dir, mocker):
+    # items running in parallel may have stored texts before the checkpoint
+    interrupted_takeout(tmp_path / "test.tar", resume_dir, mocker, 1)
+    with pytest.raises(KeyboardInterrupt):
+        with TarStorage(tmp_path / "test.tar", "takeout", resume=True) as s:
+            s.store_text("an item, which failed", "conf/text")
+            s.store_text("some other text", "conf/text")
+            s.item_done("Other")
+            raise KeyboardInterrupt()
+
+    with TarStorage(tmp_path / "test.tar", "takeout", resume=True) as s:
+        assert s.done_items == ["Text", "Other"]
+        s.store_directory(resume_dir, "home")
+
+    with TarStorage(tmp_path / "test.tar", "takein") as s:
+        assert s.list_paths("conf") == ["conf/text"]
+        assert s.unstore_text("conf/text") == "some other text"
+
+
+def test_tarstorage_no_checkpoints(tmp_path, resume_dir, mocker):
+    interrupted_takeout(tmp_path / "test.tar", resume_dir, mocker, 1, checkpoints=False)
+    assert not (tmp_path / "test.tar.checkpoint").exists()
+
+
+def test_tarstorage_resume_errors(tmp_path, resume_dir, mocker):
+    with pytest.raises(Exception) as ex:
+        TarStorage(tmp_path / "missing.tar", "takeout", resume=True).__enter__()
+    assert "no checkpoint" in str(ex.value)
+
+    interrupted_takeout(
+        tmp_path / "test.tar",
+        resume_dir,
+        mocker,
+        5,
+        checkpoint_info={"username": "isabell"},
+    )
+    with pytest.raises(Exception) as ex:
+        TarStorage(
+            tmp_path / "test.tar",
+            "takeout",
+            resume=True,
+            checkpoint_info={"username": "bob"},
+        ).__enter__()
+    assert "isabell" in str(ex.value)
+
+
+def test_localmovestorage_copy(tmp_path, test_dir):
+    with LocalMoveStorage(tmp_path / "storage", "takeout", copy=True) as s:
+        # items' directory paths end with a slash
+        s.store_directory(test_dir, "dir/")
+    assert (test_dir / "file.txt").exists()
+
+    with LocalMoveStorage(tmp_path / "storage", "takein", copy=True) as s:
+        s.unstore_directory("dir", tmp_path / "target")
+    assert (tmp_path / "storage" / "dir" / "file.txt").exists()
+
+    assert (tmp_path / "target" / "file.txt").read_text() == "some file text"
+    stats = s.stats()
+    assert stats["renamed"] == 0
+    assert sum(v for k, v in stats.items() if k.endswith("_files")) == 2
+
+
+def test_localmovestorage_cross_device(tmp_path, test_dir, mocker):
+    rename = mocker.patch("os.rename", side_effect=OSError(errno.EXDEV, "EXDEV"))
+
+    with LocalMoveStorage(tmp_path / "storage", "takeout") as s:
+        s.store_directory(test_dir, "dir")
+
+    assert rename.called
+    assert not test_dir.exists()
+    assert (tmp_path / "storage" / "dir" / "file.txt").read_text() == "some file text"
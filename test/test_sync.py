@@ -0,0 +1,196 @@
+import os
+import tarfile
+
+import pytest
+
+from uberspace_takeout.storage import ChunkStorage
+from uberspace_takeout.storage import TarStorage
+from uberspace_takeout.storage import TarStreamStorage
+from uberspace_takeout.sync import TreeSync
+
+
+@pytest.fixture
+def tree(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    (tree / "file.txt").write_text("some file text")
+    (tree / "sub" / "file2.txt").write_text("some file text 2")
+    (tree / "link").symlink_to("file.txt")
+    for path in (tree / "file.txt", tree / "sub" / "file2.txt"):
+        os.utime(str(path), (1000000000, 1000000000))
+    os.utime(str(tree / "sub"), (1100000000, 1100000000))
+    return tree
+
+
+def tamper(target):
+    # same size and mtime, but different contents, so only checksum notices
+    (target / "file.txt").write_text("SOME FILE TEXT")
+    os.utime(str(target / "file.txt"), (1000000000, 1000000000))
+    # changed size
+    (target / "sub" / "file2.txt").write_text("changed")
+    # changed type
+    (target / "link").unlink()
+    (target / "link").mkdir()
+    (target / "extra").write_text("not in the takeout")
+    (target / "sub" / "extra_dir").mkdir()
+
+
+def check_synced(target, checksum, delete):
+    expected = "some file text" if checksum else "SOME FILE TEXT"
+    assert (target / "file.txt").read_text() == expected
+    assert (target / "sub" / "file2.txt").read_text() == "some file text 2"
+    assert os.readlink(str(target / "link")) == "file.txt"
+    assert (target / "extra").exists() != delete
+    assert (target / "sub" / "extra_dir").exists() != delete
+    assert (target / "sub").stat().st_mtime == 1100000000
+
+
+def test_unchanged(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("content")
+    os.utime(str(path), (1000000000, 1000000000))
+    sync = TreeSync()
+
+    assert sync.unchanged(str(path), "file", 7, 1000000000)
+    assert not sync.unchanged(str(path), "file", 8, 1000000000)
+    assert not sync.unchanged(str(path), "file", 7, 1000000001)
+    assert not sync.unchanged(str(tmp_path / "missing"), "file", 7, 1000000000)
+    # directories are always restored
+    assert not sync.unchanged(str(tmp_path), "dir")
+
+    sync = TreeSync(checksum=True)
+    assert not sync.unchanged(str(path), "file", 7, 1000000000)
+    assert sync.unchanged(str(path), "file", 7, 1000000000, compare=lambda p: True)
+    assert not sync.unchanged(str(path), "file", 7, 1000000000, compare=lambda p: False)
+
+    # a symlink where the file was is removed
+    assert not sync.unchanged(str(path), "symlink", linkname="file")
+    assert not path.exists()
+
+
+def test_delete_extra(tmp_path):
+    (tmp_path / "keep" / "gone").mkdir(parents=True)
+    (tmp_path / "keep" / "file").write_text("")
+    (tmp_path / "keep" / "gone" / "file").write_text("")
+    (tmp_path / "other").write_text("")
+    names = {"keep", "keep/file"}
+
+    TreeSync().delete_extra(tmp_path, names)
+    assert (tmp_path / "other").exists()
+
+    TreeSync(delete=True).delete_extra(tmp_path, names)
+    assert sorted(os.listdir(str(tmp_path))) == ["keep"]
+    assert os.listdir(str(tmp_path / "keep")) == ["file"]
+
+
+@pytest.mark.parametrize("storage", [TarStorage, TarStreamStorage])
+@pytest.mark.parametrize("jobs", [1, 4])
+@pytest.mark.parametrize("checksum", [False, True])
+@pytest.mark.parametrize("delete", [False, True])
+def test_tarstorage_skip_unchanged(tmp_path, tree, storage, jobs, checksum, delete):
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(tree, "dir")
+
+    target = tmp_path / "target"
+    with TarStorage(tmp_path / "test.tar.bz2", "takein") as s:
+        s.unstore_directory("dir", target)
+    tamper(target)
+
+    with storage(
+        tmp_path / "test.tar.bz2",
+        "takein",
+        jobs=jobs,
+        skip_unchanged=True,
+        checksum=checksum,
+        delete=delete,
+    ) as s:
+        s.unstore_directory("dir", target)
+
+    # streams can't compare contents, with checksum they write files anyway
+    check_synced(target, checksum, delete)
+
+
+@pytest.mark.parametrize("storage", [TarStorage, TarStreamStorage])
+def test_tarstorage_skip_unchanged_attrs_error(tmp_path, tree, storage, mocker):
+    with TarStorage(tmp_path / "test.tar.bz2", "takeout") as s:
+        s.store_directory(tree, "dir")
+
+    target = tmp_path / "target"
+    with TarStorage(tmp_path / "test.tar.bz2", "takein") as s:
+        s.unstore_directory("dir", target)
+
+    # e.g. an unchanged file owned by root, which the user can't chmod
+    mocker.patch.object(
+        tarfile.TarFile, "chmod", side_effect=tarfile.ExtractError("not permitted")
+    )
+    with storage(tmp_path / "test.tar.bz2", "takein", skip_unchanged=True) as s:
+        s.unstore_directory("dir", target)
+
+    assert (target / "file.txt").read_text() == "some file text"
+
+
+def test_tarstorage_skip_unchanged_without_index(tmp_path, tree):
+    # e.g. takeouts made by older versions, contents are compared to the members
+    with tarfile.open(str(tmp_path / "test.tar"), "w") as tar:
+        tar.add(str(tree), "dir")
+
+    target = tmp_path / "target"
+    with TarStorage(tmp_path / "test.tar", "takein") as s:
+        assert s.index is None
+        s.unstore_directory("dir", target)
+    tamper(target)
+
+    with TarStorage(
+        tmp_path / "test.tar", "takein", skip_unchanged=True, checksum=True
+    ) as s:
+        s.unstore_directory("dir", target)
+
+    check_synced(target, True, False)
+
+
+def test_tarstorage_skip_unchanged_incremental(tmp_path, tree):
+    with TarStorage(tmp_path / "base.tar.bz2", "takeout") as s:
+        s.store_directory(tree, "dir")
+    (tree / "new.txt").write_text("new file text")
+    with TarStorage(
+        tmp_path / "delta.tar.bz2", "takeout", since=tmp_path / "base.tar.bz2"
+    ) as s:
+        s.store_directory(tree, "dir")
+
+    target = tmp_path / "target"
+    for _ in range(2):
+        for name in ("base", "delta"):
+            with TarStorage(
+                tmp_path / (name + ".tar.bz2"),
+                "takein",
+                skip_unchanged=True,
+                delete=True,
+            ) as s:
+                s.unstore_directory("dir", target)
+
+    # unchanged files are only in the base, but listed in the delta's manifest
+    assert (target / "file.txt").read_text() == "some file text"
+    assert (target / "new.txt").read_text() == "new file text"
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+@pytest.mark.parametrize("delete", [False, True])
+def test_chunkstorage_skip_unchanged(tmp_path, tree, checksum, delete):
+    with ChunkStorage(tmp_path / "test.chunks", "takeout") as s:
+        s.store_file(str(tree), "dir")
+
+    target = tmp_path / "target"
+    with ChunkStorage(tmp_path / "test.chunks", "takein") as s:
+        s.unstore_file("dir", target)
+    tamper(target)
+
+    with ChunkStorage(
+        tmp_path / "test.chunks",
+        "takein",
+        skip_unchanged=True,
+        checksum=checksum,
+        delete=delete,
+    ) as s:
+        s.unstore_file("dir", target)
+
+    check_synced(target, checksum, delete)
@@ -1,3 +1,4 @@
+import io
 import os
 import shutil
 from pathlib import Path
@@ -6,6 +7,13 @@ import pytest
 from pyfakefs.fake_filesystem_unittest import Pause
 
 from uberspace_takeout import Takeout
+from uberspace_takeout.exc import TakeoutError
+from uberspace_takeout.items import common
+from uberspace_takeout.items import u7
+from uberspace_takeout.items.base import TakeoutItem
+from uberspace_takeout.items.u7 import ToolVersions
+from uberspace_takeout.storage import LocalMoveStorage
+from uberspace_takeout.storage import TarStorage
 
 
 def prefix_root(prefix):
@@ -103,9 +111,16 @@ def mock_run_command(fs, mocker):
                 else:
                     return []
 
+            async def _run_command_async(item, cmd, input_text=None, *args, **kwargs):
+                return _run_command(item, cmd, input_text)
+
             mocker.patch(
                 "uberspace_takeout.items.base.TakeoutItem.run_command", _run_command
             )
+            mocker.patch(
+                "uberspace_takeout.items.base.TakeoutItem.run_command_async",
+                _run_command_async,
+            )
 
     return Commands()
 
@@ -203,3 +218,274 @@ def test_takeout_u6_to_u7(fs, mock_run_command):
     assert os.path.islink("/home/isabell/html")
     assert_file_unchanged("/home/isabell/html/index.html", fs, "u6/isabell")
     assert_file_unchanged("/home/isabell/Maildir/cur/mail-888", fs, "u6/isabell")
+
+
+def test_takeout_u6_to_u6_stream(fs, mock_run_command):
+    populate_root(fs, "u6/isabell")
+    mock_run_command.add_prefix_commands("u6/isabell")
+
+    takeout = Takeout(hostname="andromeda.uberspace.de")
+
+    takeout.takeout("/tmp/test.tar.gz", "isabell")
+
+    clean_root()
+
+    mock_run_command.clear()
+
+    takeout.takein("/tmp/test.tar.gz", "isabell", stream=True)
+
+    assert_in_file("/home/isabell/.my.cnf", "Lei4e%ngekäe3iÖt4Ies")
+    mock_run_command.assert_called("uberspace-add-domain -m -d mail.example.com")
+    mock_run_command.assert_called("crontab -", "@daily echo good morning\n")
+
+    assert_file_unchanged("/var/www/virtual/isabell/html/index.html", fs, "u6/isabell")
+    assert os.path.islink("/home/isabell/html")
+    assert_file_unchanged("/home/isabell/Maildir/cur/mail-888", fs, "u6/isabell")
+
+
+def test_takeout_u6_to_u6_incremental(fs, mock_run_command):
+    populate_root(fs, "u6/isabell")
+    mock_run_command.add_prefix_commands("u6/isabell")
+
+    takeout = Takeout(hostname="andromeda.uberspace.de")
+
+    takeout.takeout("/tmp/base.tar.gz", "isabell")
+
+    with open("/home/isabell/Maildir/cur/mail-888", "w") as f:
+        f.write("changed mail")
+    os.remove("/home/isabell/Maildir/new/mail-999")
+
+    takeout.takeout("/tmp/delta.tar.gz", "isabell", since="/tmp/base.tar.gz")
+
+    clean_root()
+
+    mock_run_command.clear()
+
+    takeout.takein("/tmp/base.tar.gz", "isabell", incrementals=["/tmp/delta.tar.gz"])
+
+    assert content("/home/isabell/Maildir/cur/mail-888") == "changed mail"
+    assert not os.path.exists("/home/isabell/Maildir/new/mail-999")
+    assert_file_unchanged("/var/www/virtual/isabell/html/index.html", fs, "u6/isabell")
+    mock_run_command.assert_called("crontab -", "@daily echo good morning\n")
+
+    with pytest.raises(Exception) as ex:
+        takeout.takein(
+            "/tmp/delta.tar.gz", "isabell", incrementals=["/tmp/base.tar.gz"]
+        )
+
+    assert "is not an incremental takeout" in str(ex)
+
+
+def test_takeout_ls_cat(fs, mock_run_command):
+    populate_root(fs, "u6/isabell")
+    mock_run_command.add_prefix_commands("u6/isabell")
+
+    takeout = Takeout(hostname="andromeda.uberspace.de")
+    takeout.takeout("/tmp/test.tar.gz", "isabell")
+
+    paths = takeout.ls("/tmp/test.tar.gz")
+    # settings come before the directories
+    assert paths.index("conf/cronjobs") < paths.index("home")
+    assert "home/Maildir/cur/mail-888" in takeout.ls("/tmp/test.tar.gz", "home/")
+
+    output = io.BytesIO()
+    takeout.cat("/tmp/test.tar.gz", "conf/cronjobs", output)
+    assert output.getvalue() == b"@daily echo good morning\n"
+
+
+def test_takeout_u6_to_u6_parallel(fs, mock_run_command):
+    populate_root(fs, "u6/isabell")
+    mock_run_command.add_prefix_commands("u6/isabell")
+
+    takeout = Takeout(hostname="andromeda.uberspace.de")
+
+    takeout.takeout("/tmp/test.tar.gz", "isabell", parallel_items=4)
+
+    clean_root()
+
+    mock_run_command.clear()
+
+    takeout.takein("/tmp/test.tar.gz", "isabell", parallel_items=4)
+
+    assert not takeout.errors
+    # restored after the homedir, which contains .my.cnf as well
+    assert_in_file("/home/isabell/.my.cnf", "Lei4e%ngekäe3iÖt4Ies")
+    mock_run_command.assert_called("uberspace-add-domain -m -d mail.example.com")
+    mock_run_command.assert_called("crontab -", "@daily echo good morning\n")
+
+    assert_file_unchanged("/var/www/virtual/isabell/html/index.html", fs, "u6/isabell")
+    assert_file_unchanged("/home/isabell/Maildir/cur/mail-888", fs, "u6/isabell")
+
+
+def test_tool_versions_u7_takeout(fs, mock_run_command):
+    mock_run_command.add_command(
+        "uberspace tools version list", "- Node.js\n- PHP\n- Ruby\n"
+    )
+    for tool, version in [("Node.js", "12"), ("PHP", "7.4"), ("Ruby", "2.7")]:
+        mock_run_command.add_command(
+            "uberspace tools version show " + tool,
+            "Using '{}' version: '{}'\n".format(tool, version),
+        )
+
+    with TarStorage("/tmp/test.tar.gz", "takeout") as storage:
+        ToolVersions("isabell", "andromeda.uberspace.de", storage).takeout()
+
+    with TarStorage("/tmp/test.tar.gz", "takein") as storage:
+        assert storage.unstore_text("conf/tool-version/Node.js") == "12"
+        assert storage.unstore_text("conf/tool-version/PHP") == "7.4"
+        assert storage.unstore_text("conf/tool-version/Ruby") == "2.7"
+
+    mock_run_command.assert_called("uberspace tools version list")
+    mock_run_command.assert_called("uberspace tools version show PHP")
+
+    with TarStorage("/tmp/test.tar.gz", "takein") as storage:
+        storage.claim([ToolVersions.storage_path])
+        ToolVersions("isabell", "andromeda.uberspace.de", storage).takein()
+
+    mock_run_command.assert_called("uberspace tools version use PHP 7.4")
+
+
+def test_domains_u7_takein(tmp_path, mocker):
+    (tmp_path / "conf").mkdir()
+    (tmp_path / "conf/domains-web").write_text(
+        "example.com\n*.example.com\nwww.example.com\nExample.com \n"
+        "broken.example.com\nfoo.example.com namespace\n"
+    )
+    added = []
+
+    async def run_command_async(item, cmd, *args, **kwargs):
+        added.append(cmd[-1])
+        if cmd[-1] == "broken.example.com":
+            raise TakeoutError("could not add broken.example.com, try again later")
+        if cmd[-1] == "foo.example.com":
+            # restored by a takein before
+            raise TakeoutError("foo.example.com already exists")
+        return []
+
+    mocker.patch.object(u7.WebDomains, "run_command_async", run_command_async)
+    mocker.patch.object(u7.WebDomains, "retry_delay", 0)
+
+    with LocalMoveStorage(tmp_path, "takein") as storage:
+        item = u7.WebDomains("isabell", "andromeda.uberspace.de", storage)
+        with pytest.raises(TakeoutError) as ex:
+            item.takein()
+
+    assert ex.value.args == ("could not add broken.example.com, try again later",)
+    # tried three times
+    assert added.count("broken.example.com") == 3
+    assert sorted(set(added)) == [
+        "broken.example.com",
+        "example.com",
+        "foo.example.com",
+        "www.example.com",
+    ]
+    assert len(added) == 6
+
+
+def test_takeout_root(tmp_path, mocker):
+    host = tmp_path / "host"
+    new_host = tmp_path / "new_host"
+    shutil.copytree(str(prefix_root("u6/isabell")), str(host), symlinks=True)
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+
+    Takeout("andromeda.uberspace.de", root=host).takeout(
+        tmp_path / "test.tar.gz", "isabell"
+    )
+    Takeout("andromeda.uberspace.de", root=new_host).takein(
+        tmp_path / "test.tar.gz", "isabell"
+    )
+
+    assert_files_equal(
+        host / "home/isabell/Maildir/cur/mail-888",
+        new_host / "home/isabell/Maildir/cur/mail-888",
+    )
+    assert_files_equal(
+        host / "var/www/virtual/isabell/html/index.html",
+        new_host / "var/www/virtual/isabell/html/index.html",
+    )
+    assert_in_file(new_host / "home/isabell/.my.cnf", "Lei4e%ngekäe3iÖt4Ies")
+
+
+def test_takeout_resume(tmp_path, mocker, capsys):
+    host = tmp_path / "host"
+    new_host = tmp_path / "new_host"
+    shutil.copytree(str(prefix_root("u6/isabell")), str(host), symlinks=True)
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+
+    # the document root is stored last, the connection drops while doing so
+    www = mocker.patch.object(
+        common.Www, "takeout", autospec=True, side_effect=KeyboardInterrupt()
+    )
+    with pytest.raises(KeyboardInterrupt):
+        Takeout("andromeda.uberspace.de", root=host).takeout(
+            tmp_path / "test.tar.gz", "isabell", compression="gzip"
+        )
+    mocker.stop(www)
+    assert (tmp_path / "test.tar.gz.checkpoint").exists()
+
+    with pytest.raises(Exception) as ex:
+        Takeout("andromeda.uberspace.de", root=host).takeout(
+            tmp_path / "test.tar.gz", "bob", resume=True
+        )
+    assert "isabell" in str(ex.value)
+
+    capsys.readouterr()
+    Takeout("andromeda.uberspace.de", root=host).takeout(
+        tmp_path / "test.tar.gz", "isabell", resume=True
+    )
+    output = capsys.readouterr().out
+    assert "done: Homedirectory" in output
+    assert "takeout: Documentroot" in output
+    assert not (tmp_path / "test.tar.gz.checkpoint").exists()
+
+    Takeout("andromeda.uberspace.de", root=new_host).takein(
+        tmp_path / "test.tar.gz", "isabell"
+    )
+    assert_files_equal(
+        host / "home/isabell/Maildir/cur/mail-888",
+        new_host / "home/isabell/Maildir/cur/mail-888",
+    )
+    assert_files_equal(
+        host / "var/www/virtual/isabell/html/index.html",
+        new_host / "var/www/virtual/isabell/html/index.html",
+    )
+    assert_in_file(new_host / "home/isabell/.my.cnf", "Lei4e%ngekäe3iÖt4Ies")
+
+
+def test_takein_missing_path_item(tmp_path, mocker):
+    host = tmp_path / "host"
+    new_host = tmp_path / "new_host"
+    shutil.copytree(str(prefix_root("u6/isabell")), str(host), symlinks=True)
+    shutil.copytree(str(host / "etc"), str(new_host / "etc"))
+
+    async def run_command_async(*args, **kwargs):
+        return []
+
+    mocker.patch.object(TakeoutItem, "run_command", return_value=[])
+    mocker.patch.object(TakeoutItem, "run_command_async", run_command_async)
+
+    Takeout("andromeda.uberspace.de", root=host).takeout(
+        tmp_path / "test.tar.gz", "isabell", ["Www"], compression="gzip"
+    )
+
+    t = Takeout("andromeda.uberspace.de", root=new_host)
+    t.takein(tmp_path / "test.tar.gz", "isabell")
+
+    # the document root is missing, everything else is restored anyway
+    assert t.errors == {"Homedir": ("missing from the takeout: www",)}
+    assert_files_equal(
+        host / "home/isabell/Maildir/cur/mail-888",
+        new_host / "home/isabell/Maildir/cur/mail-888",
+    )
@@ -0,0 +1,105 @@
+import os
+import pwd
+import socket
+import tarfile
+
+from uberspace_takeout.walk import TreeWalker
+
+ATTRIBUTES = (
+    "name",
+    "type",
+    "mode",
+    "uid",
+    "gid",
+    "uname",
+    "gname",
+    "size",
+    "mtime",
+    "linkname",
+)
+
+
+def make_tree(root):
+    os.makedirs(str(root / "b" / "nested"))
+    os.makedirs(str(root / "a"))
+    (root / "b" / "nested" / "file").write_text("nested")
+    (root / "a" / "file").write_text("a")
+    (root / "c").write_text("c")
+    os.symlink("a/file", str(root / "link"))
+    os.link(str(root / "c"), str(root / "hardlink"))
+    os.mkfifo(str(root / "fifo"))
+
+
+def expected_members(root, arcname):
+    members = []
+
+    class Recorder(tarfile.TarFile):
+        def addfile(self, tarinfo, fileobj=None):
+            members.append(tarinfo)
+
+    with Recorder(os.devnull, "w") as tar:
+        tar.add(str(root), arcname)
+
+    return members
+
+
+def test_walker_matches_tarfile(tmp_path):
+    root = tmp_path / "home"
+    make_tree(root)
+
+    expected = expected_members(root, "home")
+    walked = [tarinfo for _, tarinfo, _ in TreeWalker().walk(root, "home")]
+
+    assert [t.name for t in walked] == [
+        "home",
+        "home/a",
+        "home/a/file",
+        "home/b",
+        "home/b/nested",
+        "home/b/nested/file",
+        "home/c",
+        "home/fifo",
+        "home/hardlink",
+        "home/link",
+    ]
+    assert len(walked) == len(expected)
+    for walked_info, expected_info in zip(walked, expected):
+        for attr in ATTRIBUTES:
+            assert getattr(walked_info, attr) == getattr(expected_info, attr), attr
+
+
+def test_walker_paths(tmp_path):
+    root = tmp_path / "home"
+    make_tree(root)
+
+    for path, tarinfo, stat_result in TreeWalker().walk(root, "/stored/"):
+        relative = tarinfo.name[len("stored") :].lstrip("/")
+        if relative:
+            assert path == os.path.join(str(root), relative)
+        else:
+            assert path == str(root)
+        assert stat_result == os.lstat(path)
+
+
+def test_walker_skips_sockets(tmp_path):
+    root = tmp_path / "home"
+    root.mkdir()
+    (root / "file").write_text("file")
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(str(root / "socket"))
+        names = [tarinfo.name for _, tarinfo, _ in TreeWalker().walk(root, "home")]
+
+    assert names == ["home", "home/file"]
+
+
+def test_walker_caches_names(tmp_path, mocker):
+    root = tmp_path / "home"
+    make_tree(root)
+    getpwuid = mocker.spy(pwd, "getpwuid")
+
+    walker = TreeWalker()
+    list(walker.walk(root, "home"))
+    list(walker.walk(root, "home2"))
+
+    assert getpwuid.call_count == 1
@@ -1,10 +1,14 @@
 #!/opt/uberspace/python-venv/bin/python
-import socket
+import shutil
 
 import uberspace_takeout.items as items
+import uberspace_takeout.ownership as ownership
+import uberspace_takeout.scheduler as scheduler
 import uberspace_takeout.storage as storage
 from uberspace_takeout.exc import TakeoutError
-
+from uberspace_takeout.host import HostContext
+from uberspace_takeout.metrics import Metrics
+from uberspace_takeout.progress import Progress
 
 __version__ = "0.3.0"
 
@@ -27,45 +31,245 @@ class Takeout:
         items.u6.MailDomains,
     ]
 
-    def __init__(self, hostname=None):
-        if not hostname:
-            hostname = socket.getfqdn()
-
-        self.hostname = hostname
+    def __init__(self, hostname=None, metrics=None, root="/", progress=None, host=None):
+        # hostname and version of the host, looked up once for all items. The
+        # host's files are read from and restored to below its root.
+        self.host = host if host is not None else HostContext(root, hostname)
         self.errors = {}
+        # measures all items, see metrics.Metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+        # reports files and bytes done so far, see progress.Progress
+        self.progress = progress if progress is not None else Progress()
+        # Storage.stats() of the last takeout
+        self.storage_stats = {}
+
+    @property
+    def hostname(self):
+        return self.host.hostname
+
+    @property
+    def root(self):
+        return self.host.root
 
     def get_items(self, username, storage):
         for item in self.takeout_menu:
-            instance = item(username, self.hostname, storage)
+            instance = item(username, None, storage, host=self.host)
             if instance.is_active():
                 yield instance
 
-    def takein(self, tar_path, username, skipped_items=None):
+    def takein(
+        self,
+        tar_path,
+        username,
+        skipped_items=None,
+        stream=False,
+        incrementals=(),
+        parallel_items=1,
+        user_map=None,
+        **storage_options
+    ):
+        """
+        Restore tar_path. incrementals are paths of takeouts made with
+        `since`, which are applied on top of it, in order. Only items marked as
+        `incremental` are restored from every takeout, all others just from the
+        last one. Up to parallel_items items are restored at the same time,
+        except for streams, which can only be read in order. user_map renames
+        the owners of restored files ({old name: new name}), see OwnerMap.
+        """
+        # storage_options are passed on to TarStorage, e.g. jobs
         if skipped_items is None:
             skipped_items = []
-        with storage.TarStorage(tar_path, "takein") as stor:
-            for item in self.get_items(username, stor):
-                if item.__class__.__name__ in skipped_items:
-                    print("skip: " + item.description)
-                    continue
+        if stream and incrementals:
+            raise Exception("incremental takeouts cannot be read from a stream.")
+
+        chain = [tar_path, *incrementals]
+        owners = ownership.OwnerMap(username, user_map)
+        previous = None
+
+        for position, path in enumerate(chain):
+            storage_class = storage.archive_class(path, stream)
+            with storage_class(
+                path, "takein", owners=owners, progress=self.progress, **storage_options
+            ) as stor, self.progress:
+                if previous is not None:
+                    self._check_chain(previous, path, stor.manifest)
+                previous = stor.manifest
 
-                print("takein: " + item.description)
+                last = position == len(chain) - 1
+                self._takein(
+                    stor,
+                    username,
+                    skipped_items,
+                    only_incremental=not last,
+                    parallel_items=1 if stream else parallel_items,
+                )
+
+    def _check_chain(self, previous, path, manifest):
+        if previous is None or manifest is None or manifest.base != previous.id:
+            raise Exception(
+                "{} is not an incremental takeout of the one before it.".format(path)
+            )
+
+    def _takein(
+        self, stor, username, skipped_items, only_incremental=False, parallel_items=1
+    ):
+        if parallel_items > 1:
+            stor = storage.LockedStorage(stor)
+
+        all_items = [
+            i
+            for i in self.get_items(username, stor)
+            if i.incremental or not only_incremental
+        ]
+        active_items = [
+            i for i in all_items if i.__class__.__name__ not in skipped_items
+        ]
+        stor.claim(i.storage_path for i in active_items if i.storage_path)
+
+        path_items = [i for i in active_items if isinstance(i, items.base.PathItem)]
+
+        if parallel_items > 1:
+            # so items don't have to wait for the directories to read settings
+            stor.preload(
+                i.storage_path
+                for i in active_items
+                if i.storage_path and i not in path_items
+            )
+
+        # restore all path items together, as the first one of them
+        group = {
+            i.__class__.__name__: path_items[0].__class__.__name__ for i in path_items
+        }
+
+        def takein_paths():
+            name = group[path_items[0].__class__.__name__]
+            self.progress.item(name, "takein")
+            for i in path_items:
+                print("takein: " + i.description)
+            with self.metrics.measure(name, "takein") as item_metrics:
                 try:
-                    item.takein()
+                    items.base.PathItem.takein_all(stor, path_items)
                 except TakeoutError as exc:
-                    self.errors[item.__class__.__name__] = exc.args
+                    self.errors[name] = exc.args
+                    item_metrics.add("errors", len(exc.args))
+
+        tasks = []
+        for item in all_items:
+            if item not in active_items:
+                print("skip: " + item.description)
+            elif path_items and item is path_items[0]:
+                dependencies = {
+                    group.get(d, d)
+                    for i in path_items
+                    for d in i.dependencies + i.takein_dependencies
+                }
+                tasks.append(
+                    scheduler.Task(
+                        group[item.__class__.__name__],
+                        takein_paths,
+                        dependencies - set(group.values()),
+                    )
+                )
+            elif item not in path_items:
+                tasks.append(self._task(item, "takein", group))
 
-    def takeout(self, tar_path, username, skipped_items=None):
+        scheduler.Scheduler(parallel_items).run(tasks)
+
+    def _task(self, item, action, group=None):
+        # group maps names of items, which run as part of another task
+        group = group or {}
+        name = item.__class__.__name__
+        dependencies = item.dependencies
+        if action == "takein":
+            dependencies += item.takein_dependencies
+
+        def run():
+            self.progress.item(name, action)
+            print(action + ": " + item.description)
+            with self.metrics.measure(name, action) as item_metrics:
+                item.metrics = item_metrics
+                try:
+                    getattr(item, action)()
+                except TakeoutError as exc:
+                    self.errors[name] = exc.args
+                    item_metrics.add("errors", len(exc.args))
+                else:
+                    if action == "takeout":
+                        item.storage.item_done(name)
+
+        return scheduler.Task(name, run, (group.get(d, d) for d in dependencies))
+
+    def takeout(
+        self,
+        tar_path,
+        username,
+        skipped_items=None,
+        parallel_items=1,
+        chunk_store=None,
+        resume=False,
+        **storage_options
+    ):
+        # storage_options are passed on to TarStorage, e.g. compression or jobs.
+        # With chunk_store, files go there, see ChunkStorage. resume carries on
+        # with an interrupted takeout from its last checkpoint, skipping the
+        # items which were done by then.
         if skipped_items is None:
             skipped_items = []
-        with storage.TarStorage(tar_path, "takeout") as stor:
-            for item in self.get_items(username, stor):
+        if chunk_store:
+            if resume:
+                raise Exception("chunked takeouts can't be resumed.")
+            storage_class = storage.ChunkStorage
+            storage_options["chunk_store"] = chunk_store
+        else:
+            storage_class = storage.TarStorage
+            storage_options["resume"] = resume
+            storage_options["checkpoint_info"] = {"username": username}
+
+        with storage_class(
+            tar_path, "takeout", progress=self.progress, **storage_options
+        ) as tar, self.progress:
+            stor = storage.LockedStorage(tar) if parallel_items > 1 else tar
+
+            # store the small settings first and the big directories last, so
+            # reading settings never has to decompress a homedir first. In
+            # parallel, start the directories first, as they take longest.
+            # TarStorage stores texts written after them in frames of their own.
+            takeout_items = sorted(
+                self.get_items(username, stor),
+                key=lambda i: isinstance(i, items.base.PathItem),
+                reverse=parallel_items > 1,
+            )
+            tasks = []
+            for item in takeout_items:
                 if item.__class__.__name__ in skipped_items:
                     print("skip: " + item.description)
                     continue
+                if item.__class__.__name__ in tar.done_items:
+                    print("done: " + item.description)
+                    continue
 
-                print("takeout: " + item.description)
-                try:
-                    item.takeout()
-                except TakeoutError as exc:
-                    self.errors[item.__class__.__name__] = exc.args
+                tasks.append(self._task(item, "takeout"))
+
+            # totals for the ETA, counted while the first items are running
+            self.progress.scan(
+                i.path()
+                for i in takeout_items
+                if isinstance(i, items.base.PathItem)
+                and i.__class__.__name__ not in skipped_items
+                and i.__class__.__name__ not in tar.done_items
+            )
+
+            scheduler.Scheduler(parallel_items).run(tasks)
+
+        # compressed and raw size, which are only known once the tar is closed
+        self.metrics.storage(tar)
+        self.storage_stats = tar.stats()
+
+    def ls(self, tar_path, storage_path=""):
+        with storage.archive_class(tar_path)(tar_path, "takein") as stor:
+            return stor.list_paths(storage_path)
+
+    def cat(self, tar_path, storage_path, output):
+        with storage.archive_class(tar_path)(tar_path, "takein") as stor:
+            with stor.open_file(storage_path) as f:
+                shutil.copyfileobj(f, output)
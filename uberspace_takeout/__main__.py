@@ -1,42 +1,443 @@
 import argparse
+import contextlib
 import datetime
 import getpass
+import json
+import os
 import sys
 
 from . import __version__ as version
+from . import batch
+from . import codecs
+from . import commands
+from . import ownership
 from . import Takeout
+from .metrics import Metrics
+from .progress import Progress
+
+
+def compression(spec):
+    try:
+        return codecs.parse_compression(spec)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def archive_extension(args, codec):
+    return ".chunks" if args.chunk_store else ".tar" + codec.extension
+
+
+def sync_options(args):
+    return {
+        "skip_unchanged": args.skip_unchanged,
+        "checksum": args.checksum,
+        "delete": args.delete,
+    }
+
+
+def run_batch(args, host, codec, level, user_map, timestamp):
+    directory = args.tar_file or "."
+    if args.action == "takeout":
+        storage_options = {
+            "compression": codec.name,
+            "level": level,
+            "pipeline": args.pipeline,
+            "store_incompressible": args.store_incompressible,
+            "checkpoints": args.checkpoints,
+        }
+        if args.chunk_store:
+            storage_options = {
+                "compression": codec.name,
+                "level": level,
+                "chunk_store": args.chunk_store,
+            }
+    else:
+        storage_options = {"user_map": user_map, **sync_options(args)}
+
+    b = batch.Batch(
+        args.action,
+        batch.read_users(args.users_from),
+        directory,
+        host,
+        # compression and extraction processes/threads of all users together
+        # shouldn't outnumber the CPUs
+        processes=args.batch_processes or max(1, os.cpu_count() // args.jobs),
+        retries=args.batch_retries,
+        order=args.batch_order,
+        skipped_items=args.skip_item,
+        command_options={
+            "max_concurrent": args.max_commands,
+            "replay": args.replay_commands,
+            "replay_latency": args.replay_latency,
+        },
+        extension=archive_extension(args, codec),
+        jobs=args.jobs,
+        parallel_items=args.parallel_items,
+        **storage_options,
+    )
+    summary = b.run()
+
+    summary_path = args.batch_summary or os.path.join(
+        directory, "batch_{}_{}.json".format(args.action, timestamp)
+    )
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print("summary: " + summary_path)
+
+    if summary["failed"]:
+        print()
+        print("[ERROR] failed: " + ", ".join(summary["failed"]))
+        return 1
+    return 0
 
 
 def main():
     username = getpass.getuser()
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
-    default_tar_path = "takeout_{}_{}.tar.bz2".format(username, timestamp)
 
     p = argparse.ArgumentParser()
-    p.add_argument("action", choices=["takeout", "takein", "items"])
+    p.add_argument("action", choices=["takeout", "takein", "items", "ls", "cat"])
+    p.add_argument("path", nargs="?", help="ls/cat: path inside of the takeout")
     p.add_argument("--username", default=username)
     p.add_argument("--skip-item", action="append", default=[])
-    p.add_argument("--tar-file", default=default_tar_path)
+    p.add_argument("--tar-file")
+    p.add_argument(
+        "--compression",
+        type=compression,
+        default="bz2",
+        help="codec[:level] for takeout, one of: " + ", ".join(codecs.CODECS),
+    )
+    p.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help="number of processes to compress with (takeout) "
+        "or threads to extract with (takein)",
+    )
+    p.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="read files, compress and write the takeout in separate threads",
+    )
+    p.add_argument(
+        "--store-incompressible",
+        action="store_true",
+        help="takeout: don't recompress files which are compressed already, "
+        "e.g. images or archives (gzip or zstd only)",
+    )
+    p.add_argument(
+        "--resume",
+        metavar="ARCHIVE",
+        help="takeout: carry on with this interrupted takeout from its last "
+        "checkpoint, using the compression it was started with",
+    )
+    p.add_argument(
+        "--no-checkpoints",
+        dest="checkpoints",
+        action="store_false",
+        help="takeout: don't sync the archive after every item and 256 MiB, "
+        "and don't keep <archive>.checkpoint for --resume if it fails",
+    )
+    p.add_argument(
+        "--chunk-store",
+        metavar="DIR",
+        help="takeout: store file contents in this deduplicating chunk store, "
+        "which can be shared by many takeouts and users",
+    )
+    p.add_argument(
+        "--since",
+        help="takeout: only store files changed since this takeout (or manifest)",
+    )
+    p.add_argument(
+        "--checksum",
+        action="store_true",
+        help="compare file contents, not just size/mtime/inode: on takeout for "
+        "--since, on takein for --skip-unchanged",
+    )
+    p.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="takein: leave files alone, which are there already with the same "
+        "size and mtime, e.g. when retrying a migration",
+    )
+    p.add_argument(
+        "--delete",
+        action="store_true",
+        help="takein: with --skip-unchanged, remove files in restored directories "
+        "which aren't in the takeout",
+    )
+    p.add_argument(
+        "--incremental",
+        action="append",
+        default=[],
+        help="takein: apply this incremental takeout on top, can be repeated",
+    )
+    p.add_argument(
+        "--map-user",
+        action="append",
+        default=[],
+        metavar="OLD:NEW",
+        help="takein: restore files owned by user OLD as owned by NEW, "
+        "can be repeated",
+    )
+    p.add_argument(
+        "--parallel-items",
+        type=positive_int,
+        default=1,
+        help="number of items to take out or in at the same time",
+    )
+    p.add_argument(
+        "--max-commands",
+        type=positive_int,
+        default=8,
+        help="number of commands (e.g. uberspace ...) to run at the same time",
+    )
+    p.add_argument(
+        "--record-commands",
+        metavar="PATH",
+        help="record all commands, their output and duration to PATH",
+    )
+    p.add_argument(
+        "--replay-commands",
+        metavar="PATH",
+        help="don't run any commands, replay the ones recorded to PATH instead",
+    )
+    p.add_argument(
+        "--replay-latency",
+        type=float,
+        metavar="SECONDS",
+        help="delay replayed commands by this instead of their recorded duration",
+    )
+    p.add_argument(
+        "--progress",
+        action="store_true",
+        default=None,
+        help="show progress on stderr (default: if stderr is a terminal)",
+    )
+    p.add_argument("--no-progress", action="store_false", dest="progress")
+    p.add_argument(
+        "--progress-json",
+        metavar="PATH",
+        help="write progress events to PATH, as JSON lines",
+    )
+    p.add_argument(
+        "--metrics-json",
+        metavar="PATH",
+        help="write time, CPU, I/O and command counters of every item to PATH, "
+        "as JSON lines",
+    )
+    p.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="run every item using cProfile and write its stats to DIR",
+    )
+    p.add_argument(
+        "--root",
+        default="/",
+        help="look for the user's files below this directory instead of /, "
+        "e.g. a synthetic host for benchmarks (commands still run as usual)",
+    )
+    p.add_argument(
+        "--users-from",
+        metavar="PATH",
+        help="take out or in all users listed in PATH (one per line, optionally "
+        "followed by their archive), writing archives, logs and a summary to "
+        "the directory --tar-file",
+    )
+    p.add_argument(
+        "--batch-processes",
+        type=positive_int,
+        help="--users-from: number of users to run at the same time "
+        "(default: CPUs divided by --jobs)",
+    )
+    p.add_argument(
+        "--batch-retries",
+        type=int,
+        default=1,
+        help="--users-from: how often to retry users which failed",
+    )
+    p.add_argument(
+        "--batch-order",
+        choices=["largest", "given"],
+        default="largest",
+        help="--users-from: start the users with the most data first, "
+        "or go in the order given",
+    )
+    p.add_argument(
+        "--batch-summary",
+        metavar="PATH",
+        help="--users-from: where to write the JSON summary "
+        "(default: batch_<action>_<time>.json in --tar-file)",
+    )
     p.add_argument("--version", action="version", version=version)
-    args = p.parse_args()
+    # the path may come after the options, e.g. ls --tar-file X conf/
+    args = p.parse_intermixed_args()
 
+    codec, level = args.compression
+    if args.store_incompressible and codec.store_level is None:
+        p.error("--store-incompressible doesn't work with " + codec.name)
+    if args.chunk_store and (
+        args.action != "takeout"
+        or args.since
+        or args.pipeline
+        or args.store_incompressible
+        or args.tar_file == "-"
+    ):
+        p.error(
+            "--chunk-store only works with takeout, and not with --since, "
+            "--pipeline, --store-incompressible or streams"
+        )
+    if (args.skip_unchanged or args.delete) and args.action != "takein":
+        p.error("--skip-unchanged and --delete only work with takein")
+    if args.delete and not args.skip_unchanged:
+        p.error("--delete needs --skip-unchanged")
     tar_path = args.tar_file
-    t = Takeout()
+    if args.action in ("ls", "cat") and tar_path is None:
+        p.error("--tar-file is required for " + args.action)
+    if args.action == "cat" and not args.path:
+        p.error("cat needs a path")
+    try:
+        user_map = ownership.parse_user_map(args.map_user)
+    except ValueError as exc:
+        p.error("--map-user: " + str(exc))
+    if args.resume:
+        if args.action != "takeout" or args.users_from or args.chunk_store:
+            p.error("--resume only works with takeout of a single user into a tar")
+        if tar_path not in (None, args.resume):
+            p.error("--resume is the archive to write to, drop --tar-file")
+        if not args.checkpoints:
+            p.error("--resume needs checkpoints, drop --no-checkpoints")
+        tar_path = args.resume
+    if args.users_from:
+        if args.action not in ("takeout", "takein"):
+            p.error("--users-from only works with takeout and takein")
+        if tar_path == "-" or args.since or args.incremental:
+            p.error("--users-from can't be combined with streams or incrementals")
+    elif tar_path is None:
+        tar_path = "takeout_{}_{}{}".format(
+            username, timestamp, archive_extension(args, codec)
+        )
+
+    if args.record_commands and args.replay_commands:
+        p.error("--record-commands and --replay-commands can't be combined")
+    if args.record_commands and args.users_from:
+        p.error("--record-commands doesn't work with --users-from")
+    commands.configure(
+        args.max_commands,
+        record=args.record_commands,
+        replay=args.replay_commands,
+        replay_latency=args.replay_latency,
+    )
+    try:
+        return run(args, tar_path, codec, level, user_map, timestamp)
+    finally:
+        # e.g. closes the cassette of --record-commands
+        commands.close()
+
+
+def run(args, tar_path, codec, level, user_map, timestamp):
+    with contextlib.ExitStack() as outputs:
+
+        def output(path):
+            return outputs.enter_context(open(path, "w")) if path else None
+
+        show_progress = sys.stderr.isatty() if args.progress is None else args.progress
+        progress = Progress(
+            sys.stderr if show_progress else None,
+            output(args.progress_json),
+            # one line every 30s is plenty for logs
+            interval=1 if sys.stderr.isatty() else 30,
+        )
+        t = Takeout(
+            metrics=Metrics(output(args.metrics_json), args.profile),
+            root=args.root,
+            progress=progress,
+        )
+        return run_action(args, t, tar_path, codec, level, user_map, timestamp)
+
+
+def run_action(args, t, tar_path, codec, level, user_map, timestamp):
+    if args.users_from:
+        return run_batch(args, t.host, codec, level, user_map, timestamp)
 
     if args.action == "takeout":
+        checkpoints = args.checkpoints
         if tar_path == "-":
             tar_path = "/dev/stdout"
             sys.stdout = sys.stderr
+            # even if it is redirected to a file, there's nowhere to put them
+            checkpoints = False
 
-        print("writing " + tar_path)
-        t.takeout(tar_path, args.username, args.skip_item)
+        print(("resuming " if args.resume else "writing ") + tar_path)
+        if args.chunk_store:
+            storage_options = {"chunk_store": args.chunk_store}
+        else:
+            storage_options = {
+                "pipeline": args.pipeline,
+                "store_incompressible": args.store_incompressible,
+                "since": args.since,
+                "checksum": args.checksum,
+                "resume": bool(args.resume),
+                "checkpoints": checkpoints,
+            }
+        t.takeout(
+            tar_path,
+            args.username,
+            args.skip_item,
+            compression=codec.name,
+            level=level,
+            jobs=args.jobs,
+            parallel_items=args.parallel_items,
+            **storage_options,
+        )
+        if args.chunk_store:
+            report = t.storage_stats
+            print(
+                "chunk store: {} of {} bytes new, dedup ratio {}, "
+                "~{}s of compression saved".format(
+                    report["new_bytes"],
+                    report["bytes"],
+                    # nothing new at all
+                    report["dedup_ratio"] or "-",
+                    report["seconds_saved"],
+                )
+            )
 
     elif args.action == "takein":
-        if tar_path == "-":
+        # pipes can only be read once, front to back
+        stream = tar_path == "-"
+        if stream:
             tar_path = "/dev/stdin"
 
         print("reading " + tar_path)
-        t.takein(tar_path, args.username, args.skip_item)
+        t.takein(
+            tar_path,
+            args.username,
+            args.skip_item,
+            stream=stream,
+            incrementals=args.incremental,
+            parallel_items=args.parallel_items,
+            user_map=user_map,
+            jobs=args.jobs,
+            **sync_options(args),
+        )
+
+    elif args.action == "ls":
+        for path in t.ls(tar_path, args.path or ""):
+            print(path)
+        return 0
+
+    elif args.action == "cat":
+        sys.stdout.flush()
+        t.cat(tar_path, args.path, sys.stdout.buffer)
+        return 0
 
     elif args.action == "items":
         print(
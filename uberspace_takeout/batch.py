@@ -0,0 +1,291 @@
+import concurrent.futures
+import contextlib
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
+from . import commands
+from . import Takeout
+from .items.base import PathItem
+from .progress import scan_tree
+
+
+def read_users(path):
+    """
+    Read a --users-from file: one user per line, optionally followed by the
+    path of their archive. Empty lines and lines starting with # are skipped.
+    """
+    users = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            users.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return users
+
+
+def user_size(username, host):
+    # bytes in the user's directories, to start the biggest users first
+    size = 0
+    for item in Takeout.takeout_menu:
+        if issubclass(item, PathItem):
+            size += scan_tree(item(username, None, None, host=host).path())[1]
+    return size
+
+
+class BatchJob:
+    def __init__(self, username, archive, log, size=0):
+        self.username = username
+        self.archive = archive
+        self.log = log
+        self.size = size
+        self.attempts = 0
+        self.result = None
+
+
+def run_job(action, username, archive, log, options):
+    """
+    Take out or in a single user. Runs in a worker process, writes everything
+    items print to log and returns a summary for the report.
+    """
+    start = time.perf_counter()
+    result = {"errors": {}, "exception": None}
+
+    with open(log, "a") as f, contextlib.redirect_stdout(f):
+        try:
+            t = Takeout(host=options["host"])
+            if action == "takeout":
+                t.takeout(
+                    archive,
+                    username,
+                    options["skipped_items"],
+                    **options["storage_options"]
+                )
+            else:
+                t.takein(
+                    archive,
+                    username,
+                    options["skipped_items"],
+                    **options["storage_options"]
+                )
+            result["errors"] = {k: [str(e) for e in v] for k, v in t.errors.items()}
+            if action == "takeout":
+                result["storage"] = t.storage_stats
+        except Exception as exc:
+            traceback.print_exc(file=f)
+            result["exception"] = "{}: {}".format(exc.__class__.__name__, exc)
+
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def _init_worker(command_options):
+    # each worker has a command runner of its own
+    commands.configure(**command_options)
+
+
+class Batch:
+    """
+    Takes out (or in) many users of the same host, e.g. to evacuate it, using
+    a pool of processes, which run one user at a time each. Host facts (see
+    HostContext) are resolved once, and workers are forked, so they don't pay
+    for interpreter startup again. Users are started biggest first, so a big
+    one doesn't hold up the end of the batch. Users whose run raised or whose
+    worker died are retried up to retries times, once all others are done;
+    errors collected from items are deterministic, so they aren't retried.
+    """
+
+    def __init__(
+        self,
+        action,
+        users,
+        directory,
+        host,
+        processes=1,
+        retries=1,
+        order="largest",
+        skipped_items=None,
+        command_options=None,
+        extension=".tar",
+        **storage_options
+    ):
+        self.action = action
+        self.directory = str(directory)
+        self.host = host
+        self.processes = processes
+        self.retries = retries
+        self.order = order
+        self.skipped_items = skipped_items or []
+        self.command_options = command_options or {}
+        if self.command_options.get("record"):
+            # every worker would write to the start of the same cassette
+            raise Exception("commands can't be recorded in batches")
+        self.storage_options = storage_options
+
+        self.timestamp = time.strftime("%Y-%m-%d_%H_%M_%S")
+        self.jobs = []
+        for username, archive in users:
+            name = "{}_{}_{}".format(action, username, self.timestamp)
+            if archive is None:
+                archive = self._default_archive(username, extension)
+            self.jobs.append(
+                BatchJob(username, archive, os.path.join(self.directory, name + ".log"))
+            )
+
+    def _default_archive(self, username, extension):
+        if self.action == "takeout":
+            return os.path.join(
+                self.directory,
+                "takeout_{}_{}{}".format(username, self.timestamp, extension),
+            )
+
+        # the newest takeout of this user, if any, tar or chunked
+        found = []
+        for pattern in ("takeout_{}_*.tar*", "takeout_{}_*.chunks"):
+            found += glob.glob(os.path.join(self.directory, pattern.format(username)))
+        # takeouts which failed leave their checkpoint behind, see TarStorage
+        found = sorted(
+            path
+            for path in found
+            if not path.endswith(".checkpoint")
+            and not os.path.exists(path + ".checkpoint")
+        )
+        return found[-1] if found else None
+
+    def _sizes(self):
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            if self.action == "takeout":
+                sizes = pool.map(
+                    lambda j: user_size(j.username, self.host),
+                    self.jobs,
+                )
+            else:
+                sizes = pool.map(
+                    lambda j: os.path.getsize(j.archive) if j.archive else 0, self.jobs
+                )
+            for job, size in zip(self.jobs, sizes):
+                job.size = size
+
+    def _options(self):
+        return {
+            "host": self.host,
+            "skipped_items": self.skipped_items,
+            "storage_options": self.storage_options,
+        }
+
+    def run(self):
+        """
+        Run all users and return the report, see summary().
+        """
+        start = time.perf_counter()
+        self.host.resolve()
+        pending = []
+        for job in self.jobs:
+            if job.archive is None:
+                job.result = {
+                    "errors": {},
+                    "exception": "no takeout found in " + self.directory,
+                }
+            else:
+                pending.append(job)
+
+        if self.order == "largest":
+            self._sizes()
+            pending.sort(key=lambda j: j.size, reverse=True)
+
+        for _ in range(self.retries + 1):
+            pending = self._run_round(pending)
+            if not pending:
+                break
+
+        return self.summary(time.perf_counter() - start)
+
+    def _run_round(self, jobs):
+        # a fresh pool each round, a worker dying breaks the whole pool
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.command_options,),
+        ) as pool:
+            futures = {
+                pool.submit(
+                    run_job,
+                    self.action,
+                    job.username,
+                    job.archive,
+                    job.log,
+                    self._options(),
+                ): job
+                for job in jobs
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                job.attempts += 1
+                try:
+                    job.result = future.result()
+                except Exception as exc:
+                    # the worker died, e.g. killed by the OOM killer
+                    job.result = {
+                        "errors": {},
+                        "exception": "{}: {}".format(exc.__class__.__name__, exc),
+                    }
+
+                ok = self._ok(job)
+                print(
+                    "{}: {} ({})".format(
+                        self.action, job.username, "ok" if ok else "failed"
+                    )
+                )
+                if job.result["exception"]:
+                    failed.append(job)
+
+        return failed
+
+    def _ok(self, job):
+        return (
+            job.result is not None
+            and not job.result["exception"]
+            and not job.result["errors"]
+        )
+
+    def summary(self, seconds):
+        users = [
+            {
+                "username": job.username,
+                "archive": job.archive,
+                "log": job.log,
+                "size": job.size,
+                "ok": self._ok(job),
+                "attempts": job.attempts,
+                **(job.result or {}),
+            }
+            for job in self.jobs
+        ]
+        summary = {
+            "action": self.action,
+            "hostname": self.host.hostname,
+            "processes": self.processes,
+            "seconds": round(seconds, 3),
+            "users": users,
+            "failed": [u["username"] for u in users if not u["ok"]],
+        }
+
+        # users sharing a chunk store, see ChunkStorage
+        chunked = [u["storage"] for u in users if "new_bytes" in u.get("storage", {})]
+        if chunked:
+            total = sum(s["bytes"] for s in chunked)
+            new = sum(s["new_bytes"] for s in chunked)
+            summary["dedup"] = {
+                "bytes": total,
+                "new_bytes": new,
+                "stored_bytes": sum(s["stored_bytes"] for s in chunked),
+                "dedup_ratio": round(total / new, 3) if new else None,
+                "seconds_saved": round(sum(s["seconds_saved"] for s in chunked), 3),
+            }
+        return summary
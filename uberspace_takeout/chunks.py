@@ -0,0 +1,168 @@
+import hashlib
+import io
+import os
+import threading
+import time
+
+from . import codecs
+
+# chunks are at least MIN_SIZE and at most MAX_SIZE bytes long, and end where
+# the content says so, MIN_SIZE + 64 KiB into the chunk on average. Files up to
+# MIN_SIZE are a single chunk, so identical small files share it, too.
+MIN_SIZE = 64 * 1024
+MAX_SIZE = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# A chunk ends after WINDOW bytes whose BITS, one per byte, spell PATTERN, which
+# happens once in 2**16 positions for random data. Translating and searching
+# runs in C, a rolling hash in python is some 20 times slower. Neither may
+# ever change, or chunks of new takeouts won't match the old ones anymore.
+_BITS = bytes(hashlib.sha256(bytes([b])).digest()[0] & 1 for b in range(256))
+BITS = bytes.maketrans(bytes(range(256)), bytes(b"01"[b] for b in _BITS))
+PATTERN = b"0110100110010110"
+WINDOW = len(PATTERN)
+
+
+def _cut(buffer):
+    # length of the next chunk at the start of buffer
+    if len(buffer) <= MIN_SIZE:
+        return len(buffer)
+
+    start = MIN_SIZE - WINDOW
+    match = buffer[start:MAX_SIZE].translate(BITS).find(PATTERN)
+    if match >= 0:
+        return start + match + WINDOW
+    return min(len(buffer), MAX_SIZE)
+
+
+def split(f):
+    """
+    Split the file object f into content-defined chunks, so data inserted into
+    or removed from a file only changes the chunks around it.
+    """
+    buffer = bytearray()
+    eof = False
+
+    while True:
+        while not eof and len(buffer) < MAX_SIZE:
+            data = f.read(READ_SIZE)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+
+        length = _cut(buffer)
+        yield bytes(buffer[:length])
+        del buffer[:length]
+
+
+class ChunkStore:
+    """
+    A directory of chunks, each named by its SHA-256 and compressed on its
+    own. Every chunk is only stored once, no matter how many files, takeouts
+    or users it appears in, so many takeouts (and processes) can share one.
+    """
+
+    # first byte of every chunk file
+    RAW = b"\x00"
+    COMPRESSED = b"\x01"
+
+    def __init__(self, directory, compression="gzip", level=None):
+        self.directory = str(directory)
+        self.codec = codecs.get_codec(compression)
+        self.level = level
+        self.counters = {
+            "chunks": 0,
+            "bytes": 0,
+            "new_chunks": 0,
+            "new_bytes": 0,
+            "stored_bytes": 0,
+            "compress_seconds": 0.0,
+        }
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def put(self, data):
+        """
+        Store data, unless it is stored already, and return its digest.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        self._count(chunks=1, bytes=len(data))
+        if os.path.exists(path):
+            return digest
+
+        start = time.perf_counter()
+        packed = self.RAW + data
+        if self.codec.name != "none":
+            compressed = self.COMPRESSED + self.codec.compress(data, self.level)
+            if len(compressed) < len(packed):
+                packed = compressed
+        seconds = time.perf_counter() - start
+
+        # written under another name first, so a process running at the same
+        # time, or one that was interrupted, never leaves half a chunk
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.{}-{}".format(path, os.getpid(), threading.get_ident())
+        with open(temporary, "wb") as f:
+            f.write(packed)
+        os.replace(temporary, path)
+
+        self._count(
+            new_chunks=1,
+            new_bytes=len(data),
+            stored_bytes=len(packed),
+            compress_seconds=seconds,
+        )
+        return digest
+
+    def get(self, digest):
+        try:
+            with open(self._path(digest), "rb") as f:
+                packed = f.read()
+        except FileNotFoundError:
+            raise Exception(
+                "Chunk {} is missing from {}.".format(digest, self.directory)
+            )
+
+        tag, packed = packed[:1], packed[1:]
+        if tag == self.COMPRESSED:
+            data = codecs.detect_codec(packed).open_read(io.BytesIO(packed)).read()
+        else:
+            data = packed
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise Exception("Chunk {} is corrupted.".format(digest))
+        return data
+
+    def report(self):
+        """
+        How well deduplication went: the share of data which was stored
+        already, and an estimate of the time that saved compressing it.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+
+        duplicate_bytes = counters["bytes"] - counters["new_bytes"]
+        speed = (
+            counters["new_bytes"] / counters["compress_seconds"]
+            if counters["compress_seconds"]
+            else 0
+        )
+        counters["compress_seconds"] = round(counters["compress_seconds"], 3)
+        counters["duplicate_bytes"] = duplicate_bytes
+        counters["dedup_ratio"] = (
+            round(counters["bytes"] / counters["new_bytes"], 3)
+            if counters["new_bytes"]
+            else None
+        )
+        counters["seconds_saved"] = round(duplicate_bytes / speed, 3) if speed else 0
+        return counters
@@ -0,0 +1,553 @@
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import io
+import lzma
+import multiprocessing
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from .pipeline import PipelinedWriter
+
+
+class Codec:
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+    # level for data which doesn't compress anyway, at next to no CPU cost. Its
+    # frames are read like any other. None if the codec has no such level.
+    store_level = None
+    # name of the python package needed for this codec, if any
+    requires = None
+
+    @property
+    def available(self):
+        return True
+
+    def compressor(self, level=None):
+        """
+        Return an object with compress(data) and flush() methods, like
+        zlib.compressobj(). flush() ends the compressed stream/frame.
+        """
+        raise NotImplementedError()
+
+    def compress(self, data, level=None):
+        compressor = self.compressor(level)
+        return compressor.compress(data) + compressor.flush()
+
+    def open_read(self, fileobj):
+        raise NotImplementedError()
+
+    def _level(self, level):
+        return self.default_level if level is None else level
+
+
+class _Passthrough:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class NoneCodec(Codec):
+    name = "none"
+    extension = ""
+    store_level = 0
+
+    def compressor(self, level=None):
+        return _Passthrough()
+
+    def open_read(self, fileobj):
+        return fileobj
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = ".gz"
+    magic = b"\x1f\x8b"
+    default_level = 6
+    # deflate's stored blocks
+    store_level = 0
+
+    def compressor(self, level=None):
+        # wbits=31 gets us a gzip header and trailer
+        return zlib.compressobj(self._level(level), zlib.DEFLATED, 31)
+
+    def open_read(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+
+class Bz2Codec(Codec):
+    name = "bz2"
+    extension = ".bz2"
+    magic = b"BZh"
+    default_level = 9
+
+    def compressor(self, level=None):
+        return bz2.BZ2Compressor(self._level(level))
+
+    def open_read(self, fileobj):
+        return bz2.BZ2File(fileobj, mode="rb")
+
+
+class XzCodec(Codec):
+    name = "xz"
+    extension = ".xz"
+    magic = b"\xfd7zXZ\x00"
+    default_level = 6
+
+    def compressor(self, level=None):
+        return lzma.LZMACompressor(preset=self._level(level))
+
+    def open_read(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode="rb")
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".zst"
+    magic = b"\x28\xb5\x2f\xfd"
+    default_level = 3
+    # writes raw blocks once it notices data doesn't compress
+    store_level = 1
+    requires = "zstandard"
+
+    @property
+    def available(self):
+        return zstandard is not None
+
+    def compressor(self, level=None):
+        return zstandard.ZstdCompressor(level=self._level(level)).compressobj()
+
+    def _open_stream(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False
+        )
+
+    def open_read(self, fileobj):
+        return RewindingReader(fileobj, self._open_stream)
+
+
+class _Lz4Compressor:
+    def __init__(self, level):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._started = False
+
+    def compress(self, data):
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.compress(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.flush()
+        return self._compressor.flush()
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    extension = ".lz4"
+    magic = b"\x04\x22\x4d\x18"
+    default_level = 0
+    # the default already is the fastest mode, a stored one isn't exposed
+    requires = "lz4"
+
+    @property
+    def available(self):
+        return lz4 is not None
+
+    def compressor(self, level=None):
+        return _Lz4Compressor(self._level(level))
+
+    def open_read(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode="rb")
+
+
+CODECS = {
+    c.name: c
+    for c in (NoneCodec(), GzipCodec(), Bz2Codec(), XzCodec(), ZstdCodec(), Lz4Codec())
+}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(
+            'unknown compression "{}", expected one of: {}'.format(
+                name, ", ".join(CODECS)
+            )
+        )
+
+    codec = CODECS[name]
+    if not codec.available:
+        raise ValueError(
+            'compression "{}" needs the python package "{}", please install it.'.format(
+                name, codec.requires
+            )
+        )
+
+    return codec
+
+
+def parse_compression(spec):
+    """
+    Parse "codec" or "codec:level", e.g. "zstd:19", into (codec, level).
+    """
+    name, _, level = spec.partition(":")
+    codec = get_codec(name)
+
+    if not level:
+        return codec, None
+
+    try:
+        return codec, int(level)
+    except ValueError:
+        raise ValueError('invalid compression level "{}"'.format(level))
+
+
+def detect_codec(header):
+    """
+    Find the codec an archive was written with, based on its first few bytes.
+    Plain tar files do not have any magic bytes at the start.
+    """
+    for codec in CODECS.values():
+        if codec.magic and header.startswith(codec.magic):
+            return get_codec(codec.name)
+
+    return CODECS["none"]
+
+
+# files with these extensions are compressed already
+INCOMPRESSIBLE_EXTENSIONS = frozenset(
+    (
+        "jpg jpeg png gif webp heic avif mp3 m4a ogg opus flac mp4 m4v mkv mov "
+        "avi webm zip gz tgz bz2 tbz2 xz txz zst lz4 7z rar jar war whl apk "
+        "docx xlsx pptx odt ods woff woff2 pack"
+    ).split()
+)
+
+
+def is_incompressible(path, sample_size=64 * 1024):
+    """
+    Guess whether the file at path is compressed already, using its extension
+    or, if that doesn't tell, by quickly compressing its first few bytes.
+    """
+    extension = os.path.splitext(str(path))[1].lstrip(".").lower()
+    if extension in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+
+    try:
+        with open(path, "rb") as f:
+            sample = f.read(sample_size)
+    except OSError:
+        return False
+
+    return bool(sample) and len(zlib.compress(sample, 1)) > len(sample) * 0.95
+
+
+class CompressWriter(io.RawIOBase):
+    """
+    A write-only file compressing everything written to it into fileobj.
+    tell() is the position in the uncompressed data, which is all tarfile needs.
+    fileobj is not closed on close().
+
+    frames lists (compressed offset, uncompressed offset) of every stream/frame
+    started so far, see end_frame() and FrameReader.
+    """
+
+    def __init__(self, fileobj, codec, level=None):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = [(0, 0)]
+        # see set_stored()
+        self.stored = False
+        self._compressor = None
+
+    def writable(self):
+        return True
+
+    def _level(self):
+        return self.codec.store_level if self.stored else self.level
+
+    def _output(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.bytes_out += len(data)
+
+    def _compress(self, data):
+        if not data:
+            return
+        if self._compressor is None:
+            self._compressor = self.codec.compressor(self._level())
+        self._output(self._compressor.compress(data))
+
+    def _finish(self):
+        if self._compressor is None:
+            self._compressor = self.codec.compressor(self._level())
+        self._output(self._compressor.flush())
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._compress(data)
+        return len(data)
+
+    def end_frame(self):
+        """
+        End the current stream/frame, so everything written from now on can be
+        decompressed without the data before it. Returns the (compressed,
+        uncompressed) offsets the next frame starts at.
+        """
+        if self.bytes_in != self.frames[-1][1]:
+            self._finish()
+            self._compressor = None
+            self.frames.append((self.bytes_out, self.bytes_in))
+
+        return self.frames[-1]
+
+    def set_stored(self, stored):
+        """
+        Write frames at the codec's store_level from now on (stored=True), e.g.
+        for files which are compressed already, or go back to normal. Takes
+        effect at the next frame, so this ends the current one.
+        """
+        if stored != self.stored:
+            self.end_frame()
+            self.stored = stored
+
+    def resume(self, frames, offsets):
+        """
+        Continue an archive which ends where a frame ends, at offsets
+        (compressed, uncompressed), e.g. one cut off at a checkpoint. frames
+        are those written before, fileobj must be positioned at its end.
+        """
+        self.bytes_out, self.bytes_in = offsets
+        self.frames = [tuple(f) for f in frames]
+        if not self.frames or self.frames[-1] != tuple(offsets):
+            self.frames.append(tuple(offsets))
+
+    def tell(self):
+        return self.bytes_in
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._finish()
+                self.fileobj.flush()
+            finally:
+                super().close()
+
+
+def _compress_block(codec_name, level, data):
+    return CODECS[codec_name].compress(data, level)
+
+
+class ParallelCompressWriter(CompressWriter):
+    """
+    Like CompressWriter, but splits the data into blocks and compresses each one
+    into a separate stream/frame using a process pool, like pigz or pbzip2 do.
+    All our codecs, and the standard tools, read concatenated streams/frames.
+    """
+
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, fileobj, codec, level=None, jobs=2):
+        super().__init__(fileobj, codec, level)
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+        # keep every worker busy, but don't queue up the whole archive in memory
+        self._max_pending = jobs * 2
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        # every block is a frame of its own, they are added once written
+        self.frames = []
+        self._submitted = 0
+
+    def _submit(self, block):
+        future = self._executor.submit(
+            _compress_block, self.codec.name, self._level(), block
+        )
+        self._pending.append((self._submitted, future))
+        self._submitted += len(block)
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending=0):
+        while len(self._pending) > max_pending:
+            start, future = self._pending.popleft()
+            self.frames.append((self.bytes_out, start))
+            self._output(future.result())
+
+    def _compress(self, data):
+        self._buffer += data
+
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+
+    def _finish(self):
+        if self._buffer or not self._submitted:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+
+        self._drain()
+
+    def end_frame(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+
+        # the offsets of the next frame are only known once all before it are
+        self._drain()
+        return self.bytes_out, self._submitted
+
+    def resume(self, frames, offsets):
+        super().resume(frames, offsets)
+        # added again once the next block is written
+        self.frames.pop()
+        self._submitted = self.bytes_in
+
+    def set_stored(self, stored):
+        # the next block starts a new frame anyway, no need to wait for it
+        if stored != self.stored:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            self.stored = stored
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._executor.shutdown()
+
+
+def open_writer(fileobj, codec, level=None, jobs=1, pipeline=False):
+    def make_writer(fileobj):
+        if jobs > 1 and codec.name != "none":
+            return ParallelCompressWriter(fileobj, codec, level, jobs)
+
+        return CompressWriter(fileobj, codec, level)
+
+    if pipeline:
+        return PipelinedWriter(fileobj, make_writer)
+
+    return make_writer(fileobj)
+
+
+class _StreamReader(io.RawIOBase):
+    """
+    Reads from the decompressing stream _stream, keeping track of the position
+    in the uncompressed data. Seeking forward skips data, subclasses decide in
+    _rewind() where to start over from for everything else.
+    """
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # tarfile does not like short reads, so fill the buffer if at all possible
+        length = 0
+        while length < len(buffer):
+            data = self._stream.read(len(buffer) - length)
+            if not data:
+                break
+            buffer[length : length + len(data)] = data
+            length += len(data)
+
+        self._position += length
+        return length
+
+    def tell(self):
+        return self._position
+
+    def _rewind(self, offset):
+        raise NotImplementedError()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek relative to start/current")
+
+        self._rewind(offset)
+
+        while self._position < offset:
+            data = self._stream.read(min(offset - self._position, 1024 * 1024))
+            if not data:
+                break
+            self._position += len(data)
+
+        return self._position
+
+
+class RewindingReader(_StreamReader):
+    """
+    Make a forward-only decompressing reader seekable by starting over from the
+    beginning when asked to seek backwards, just like gzip.GzipFile does.
+    """
+
+    def __init__(self, fileobj, open_stream):
+        self._fileobj = fileobj
+        self._start = fileobj.tell() if fileobj.seekable() else None
+        self._open_stream = open_stream
+        self._stream = open_stream(fileobj)
+        self._position = 0
+
+    def seekable(self):
+        return self._start is not None
+
+    def _rewind(self, offset):
+        if offset < self._position:
+            if self._start is None:
+                raise io.UnsupportedOperation("cannot seek backwards in a stream")
+            self._fileobj.seek(self._start)
+            self._stream = self._open_stream(self._fileobj)
+            self._position = 0
+
+
+class FrameReader(_StreamReader):
+    """
+    Random access to data written in several streams/frames, given the frames
+    a CompressWriter recorded: seeking starts decompressing at the closest
+    frame before the target, instead of at the very beginning of fileobj.
+    """
+
+    def __init__(self, fileobj, codec, frames):
+        self._fileobj = fileobj
+        self._codec = codec
+        self._frames = sorted(frames, key=lambda f: f[1])
+        self._starts = [f[1] for f in self._frames]
+        self._open_frame(0)
+
+    def _open_frame(self, i):
+        compressed, uncompressed = self._frames[i]
+        self._fileobj.seek(compressed)
+        # codecs read across frames, so this goes on until the very end
+        self._stream = self._codec.open_read(self._fileobj)
+        self._position = uncompressed
+
+    def seekable(self):
+        return True
+
+    def _rewind(self, offset):
+        i = max(bisect.bisect_right(self._starts, offset) - 1, 0)
+        if offset < self._position or self._starts[i] > self._position:
+            self._open_frame(i)
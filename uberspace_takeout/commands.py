@@ -0,0 +1,301 @@
+import asyncio
+import collections
+import json
+import locale
+import os
+import threading
+import time
+
+from uberspace_takeout.exc import CommandError
+from uberspace_takeout.exc import CommandTimeoutError
+
+
+def command_env():
+    env = os.environ.copy()
+    env["PATH"] = "/usr/local/bin/:" + env["PATH"]
+    env.pop("SUDO_USER", None)
+    return env
+
+
+class CommandResult:
+    def __init__(self, cmd, returncode, lines, duration=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        # output (stdout and stderr) without empty lines
+        self.lines = lines
+        # seconds from starting the command until it finished
+        self.duration = duration
+
+    def check(self):
+        if self.returncode != 0:
+            raise CommandError(
+                "command failed with exit code {}: {}\n{}".format(
+                    self.returncode, " ".join(self.cmd), "\n".join(self.lines)
+                ).strip()
+            )
+
+
+def _timeout_error(cmd, timeout):
+    return CommandTimeoutError(
+        "command timed out after {}s: {}".format(timeout, " ".join(cmd))
+    )
+
+
+class CommandRunner:
+    """
+    Runs commands as asyncio subprocesses, at most max_concurrent at a time.
+    The event loop runs in a thread of its own, so run() can be called from
+    any (non-async) code, e.g. items running in several threads at once.
+    """
+
+    def __init__(self, max_concurrent=8, env=None):
+        if max_concurrent < 1:
+            # no command would ever start
+            raise ValueError("max_concurrent has to be at least 1")
+        self.max_concurrent = max_concurrent
+        self.env = env if env is not None else command_env()
+        self._encoding = locale.getpreferredencoding(False)
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=loop.run_forever, name="takeout-commands", daemon=True
+                )
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    def _get_semaphore(self):
+        # only ever called in the loop's thread, so it is bound to that loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def _read_lines(self, stream, on_line):
+        # readline() gives up on lines longer than 64 KiB, e.g. of mysql
+        lines = []
+        buffer = b""
+        while True:
+            data = await stream.read(64 * 1024)
+            buffer += data
+            *complete, buffer = buffer.split(b"\n")
+            if not data:
+                complete.append(buffer)
+
+            for line in complete:
+                line = line.decode(self._encoding, errors="replace").rstrip("\r")
+                if line:
+                    lines.append(line)
+                    if on_line is not None:
+                        on_line(line)
+
+            if not data:
+                return lines
+
+    async def _write_input(self, stream, input_text):
+        if input_text:
+            stream.write(input_text.encode(self._encoding))
+            try:
+                await stream.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # just like communicate(), ignore commands not reading their input
+                pass
+        stream.close()
+
+    async def run_async(self, cmd, input_text=None, timeout=None, on_line=None):
+        """
+        Run cmd and return a CommandResult. on_line(line) is called for every
+        line of output as soon as it arrives. Raises CommandTimeoutError if the
+        command doesn't finish within timeout seconds. Has to be awaited in
+        this runner's loop, see run() and gather().
+        """
+        async with self._get_semaphore():
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                stdin=asyncio.subprocess.PIPE,
+                env=self.env,
+            )
+
+            async def communicate():
+                _, lines = await asyncio.gather(
+                    self._write_input(process.stdin, input_text),
+                    self._read_lines(process.stdout, on_line),
+                )
+                await process.wait()
+                return lines
+
+            try:
+                lines = await asyncio.wait_for(communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise _timeout_error(cmd, timeout)
+
+            return CommandResult(
+                cmd, process.returncode, lines, time.perf_counter() - start
+            )
+
+    def run(self, cmd, input_text=None, timeout=None, on_line=None):
+        return self.gather([self.run_async(cmd, input_text, timeout, on_line)])[0]
+
+    def gather(self, coroutines):
+        """
+        Run coroutines concurrently in this runner's loop, and wait for all of
+        them. Returns their results, in order.
+        """
+
+        async def gather():
+            return await asyncio.gather(*coroutines)
+
+        return asyncio.run_coroutine_threadsafe(gather(), self._get_loop()).result()
+
+    def close(self):
+        pass
+
+
+class RecordingRunner(CommandRunner):
+    """
+    Runs commands just like CommandRunner, and appends every one of them to
+    a cassette: a file with one JSON object per command, containing its
+    input, exit code, output and how long it took. See ReplayRunner.
+    """
+
+    def __init__(self, path, max_concurrent=8, env=None):
+        super().__init__(max_concurrent, env)
+        # inputs are recorded as they are, including MySQL passwords
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        self._cassette = open(fd, "w")
+
+    def close(self):
+        self._cassette.close()
+
+    def _record(self, cmd, input_text, **result):
+        # only called in the loop's thread, so writes don't interleave
+        entry = {"cmd": list(cmd), "input": input_text or None, **result}
+        self._cassette.write(json.dumps(entry) + "\n")
+        self._cassette.flush()
+
+    async def run_async(self, cmd, input_text=None, timeout=None, on_line=None):
+        try:
+            result = await super().run_async(cmd, input_text, timeout, on_line)
+        except CommandTimeoutError:
+            self._record(cmd, input_text, timeout=timeout, duration=timeout)
+            raise
+
+        self._record(
+            cmd,
+            input_text,
+            returncode=result.returncode,
+            lines=result.lines,
+            duration=result.duration,
+        )
+        return result
+
+
+class ReplayRunner(CommandRunner):
+    """
+    Serves commands from a cassette written by RecordingRunner, without
+    running anything. Each result is delayed by the recorded duration, or by
+    latency seconds if given, while taking up one of max_concurrent slots,
+    so items are scheduled just like with real commands.
+
+    Commands are matched by their arguments and input. Commands recorded
+    several times (e.g. retries) are served in the recorded order, the last
+    result is repeated after that.
+    """
+
+    def __init__(self, path, latency=None, max_concurrent=8):
+        super().__init__(max_concurrent, env={})
+        self.latency = latency
+        self._recordings = collections.defaultdict(list)
+        self._served = collections.Counter()
+
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    key = self._key(entry["cmd"], entry["input"])
+                    self._recordings[key].append(entry)
+
+    def _key(self, cmd, input_text):
+        return (tuple(cmd), input_text or None)
+
+    def _next(self, cmd, input_text):
+        key = self._key(cmd, input_text)
+        entries = self._recordings.get(key)
+        if not entries:
+            raise CommandError("no recording of command: " + " ".join(cmd))
+
+        index = min(self._served[key], len(entries) - 1)
+        self._served[key] += 1
+        return entries[index]
+
+    async def run_async(self, cmd, input_text=None, timeout=None, on_line=None):
+        entry = self._next(cmd, input_text)
+        latency = entry["duration"] if self.latency is None else self.latency
+
+        async with self._get_semaphore():
+            if entry.get("timeout") is not None:
+                await asyncio.sleep(latency)
+                raise _timeout_error(cmd, entry["timeout"])
+            if timeout is not None and latency > timeout:
+                await asyncio.sleep(timeout)
+                raise _timeout_error(cmd, timeout)
+
+            await asyncio.sleep(latency)
+
+        if on_line is not None:
+            for line in entry["lines"]:
+                on_line(line)
+
+        return CommandResult(cmd, entry["returncode"], list(entry["lines"]), latency)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = CommandRunner()
+        return _runner
+
+
+def configure(max_concurrent=8, record=None, replay=None, replay_latency=None):
+    """
+    Set up the runner used by all items: record commands to the cassette
+    record, or replay them from the cassette replay, see RecordingRunner and
+    ReplayRunner.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.close()
+        if replay:
+            _runner = ReplayRunner(replay, replay_latency, max_concurrent)
+        elif record:
+            _runner = RecordingRunner(record, max_concurrent)
+        else:
+            _runner = CommandRunner(max_concurrent)
+
+
+def close():
+    """
+    Close the runner used by all items, e.g. the cassette it records to.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.close()
+            _runner = None
@@ -1,2 +1,10 @@
 class TakeoutError(Exception):
     pass
+
+
+class CommandTimeoutError(TakeoutError):
+    pass
+
+
+class CommandError(TakeoutError):
+    pass
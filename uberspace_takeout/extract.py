@@ -0,0 +1,123 @@
+import concurrent.futures
+import os
+import shutil
+import tarfile
+import threading
+
+
+class _ByteBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            while self._used and self._used + size > self.max_bytes:
+                self._cond.wait()
+            self._used += size
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+
+class ParallelExtractor:
+    """
+    Extracts members of a tarfile.TarFile like extractall() does, but hands
+    creating files, writing them and setting their attributes to a thread pool.
+    Reading from the archive, i.e. decompression, stays in the calling thread,
+    so this works for streams, too. Directory attributes are set in close(),
+    once all files are in place.
+
+    Members are expected to come from TarStorage.get_members_in(), which has
+    checked their names and types already.
+    """
+
+    # files up to this size are read into memory and written by the pool,
+    # larger ones are copied in the calling thread.
+    small_file_size = 1024 * 1024
+
+    def __init__(self, tar, jobs, max_bytes=64 * 1024 * 1024):
+        self.tar = tar
+        self._executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self._budget = _ByteBudget(max_bytes)
+        self._futures = []
+        self._directories = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close(wait_only=exception_type is not None)
+
+    def _set_attrs(self, member, path):
+        try:
+            self.tar.chown(member, path, False)
+            if not member.issym():
+                self.tar.chmod(member, path)
+                self.tar.utime(member, path)
+        except tarfile.ExtractError:
+            # just like extractall()
+            if self.tar.errorlevel > 1:
+                raise
+
+    def _write_file(self, member, path, content):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+            self._set_attrs(member, path)
+        finally:
+            self._budget.release(len(content))
+
+    def _write_symlink(self, member, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(member.linkname, path)
+        self._set_attrs(member, path)
+
+    def _submit(self, fn, *args):
+        self._futures.append(self._executor.submit(fn, *args))
+
+        # don't keep results of finished jobs around forever
+        if len(self._futures) > 1000:
+            done = [f for f in self._futures if f.done()]
+            for future in done:
+                future.result()
+            self._futures = [f for f in self._futures if not f.done()]
+
+    def extract(self, member, path):
+        path = os.path.join(str(path), member.name)
+
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+            self._directories.append((member, path))
+        elif member.issym():
+            self._submit(self._write_symlink, member, path)
+        elif member.size <= self.small_file_size:
+            content = self.tar.extractfile(member).read()
+            self._budget.acquire(len(content))
+            self._submit(self._write_file, member, path, content)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.tar.extractfile(member) as source, open(path, "wb") as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            self._submit(self._set_attrs, member, path)
+
+    def close(self, wait_only=False):
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+        if wait_only:
+            return
+
+        # deepest first, so changing a directory doesn't touch its parent's mtime
+        self._directories.sort(key=lambda d: d[1], reverse=True)
+        for member, path in self._directories:
+            self._set_attrs(member, path)
@@ -0,0 +1,195 @@
+import concurrent.futures
+import errno
+import os
+import shutil
+import stat
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# how to copy file contents, fastest first. "reflink" shares the blocks of the
+# source (btrfs, xfs), the others copy in the kernel, "copy" in python.
+STRATEGIES = ("reflink", "copy_file_range", "sendfile", "copy")
+
+# what the kernel answers if a strategy doesn't work for these two files
+_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EBADF,
+)
+
+
+def _reflink(src, dst, size):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "no fcntl")
+    fcntl.ioctl(dst, FICLONE, src)
+
+
+def _copy_file_range(src, dst, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "no copy_file_range")
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src, dst, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile(src, dst, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst, src, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _copy(src, dst, size):
+    while True:
+        data = memoryview(os.read(src, 1024 * 1024))
+        if not data:
+            break
+        while data:
+            data = data[os.write(dst, data) :]
+
+
+_COPY = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "copy": _copy,
+}
+
+
+class TreeCopier:
+    """
+    Copies files and directories, keeping modes, owners (as root), times and
+    symlinks. File contents are copied by a pool of jobs threads, using the
+    fastest of STRATEGIES which works. Strategies which failed for a pair of
+    filesystems aren't tried again for it. counters tells how many files and
+    bytes each strategy copied.
+    """
+
+    def __init__(self, jobs=4):
+        self.jobs = jobs
+        self.counters = {s: {"files": 0, "bytes": 0} for s in STRATEGIES}
+        # (source device, target device) => strategies which failed there
+        self._unsupported = {}
+        self._lock = threading.Lock()
+
+    def _strategies(self, devices):
+        with self._lock:
+            unsupported = self._unsupported.get(devices, ())
+        return [s for s in STRATEGIES if s not in unsupported]
+
+    def _give_up(self, devices, strategy):
+        with self._lock:
+            self._unsupported.setdefault(devices, set()).add(strategy)
+
+    def copy_contents(self, source, target, stat_result):
+        """
+        Copy the contents of the regular file source to a new file target.
+        Returns the strategy used.
+        """
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            devices = (stat_result.st_dev, os.fstat(dst.fileno()).st_dev)
+
+            for strategy in self._strategies(devices):
+                try:
+                    _COPY[strategy](src.fileno(), dst.fileno(), stat_result.st_size)
+                except OSError as exc:
+                    if strategy == "copy" or exc.errno not in _UNSUPPORTED:
+                        raise
+                    self._give_up(devices, strategy)
+                    # start over, a strategy might have given up half way
+                    dst.truncate(0)
+                    os.lseek(src.fileno(), 0, os.SEEK_SET)
+                    os.lseek(dst.fileno(), 0, os.SEEK_SET)
+                    continue
+
+                with self._lock:
+                    self.counters[strategy]["files"] += 1
+                    self.counters[strategy]["bytes"] += stat_result.st_size
+                return strategy
+
+    def _copy_metadata(self, source, target, stat_result):
+        if os.geteuid() == 0:
+            os.lchown(target, stat_result.st_uid, stat_result.st_gid)
+        # after chown, which resets setuid bits
+        shutil.copystat(source, target, follow_symlinks=False)
+
+    def _copy_file(self, source, target, stat_result):
+        self.copy_contents(source, target, stat_result)
+        self._copy_metadata(source, target, stat_result)
+
+    def _copy_node(self, source, target, stat_result):
+        # anything but regular files and directories
+        if stat.S_ISLNK(stat_result.st_mode):
+            os.symlink(os.readlink(source), target)
+        elif stat.S_ISFIFO(stat_result.st_mode):
+            os.mkfifo(target)
+        elif stat.S_ISCHR(stat_result.st_mode) or stat.S_ISBLK(stat_result.st_mode):
+            os.mknod(target, stat_result.st_mode, stat_result.st_rdev)
+        else:
+            # sockets, tar skips them as well
+            return
+        self._copy_metadata(source, target, stat_result)
+
+    def copy(self, source, target):
+        """
+        Copy the file or directory source to target, which mustn't exist yet.
+        """
+        directories = []
+        # (st_dev, st_ino) => first copy, further ones become hardlinks to it
+        copied = {}
+        links = []
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            futures = []
+
+            def visit(source, target, stat_result):
+                if stat.S_ISDIR(stat_result.st_mode):
+                    os.mkdir(target)
+                    directories.append((source, target, stat_result))
+                    with os.scandir(source) as it:
+                        entries = sorted(it, key=lambda e: e.name)
+                    for entry in entries:
+                        visit(
+                            entry.path,
+                            os.path.join(target, entry.name),
+                            entry.stat(follow_symlinks=False),
+                        )
+                elif not stat.S_ISREG(stat_result.st_mode):
+                    self._copy_node(source, target, stat_result)
+                elif (stat_result.st_dev, stat_result.st_ino) in copied:
+                    links.append(
+                        (copied[stat_result.st_dev, stat_result.st_ino], target)
+                    )
+                else:
+                    if stat_result.st_nlink > 1:
+                        copied[stat_result.st_dev, stat_result.st_ino] = target
+                    futures.append(
+                        pool.submit(self._copy_file, source, target, stat_result)
+                    )
+
+            visit(str(source), str(target), os.lstat(str(source)))
+
+            for future in futures:
+                future.result()
+
+        for first, link in links:
+            os.link(first, link)
+
+        # last, as creating their contents changes their mtime
+        for source, target, stat_result in reversed(directories):
+            self._copy_metadata(source, target, stat_result)
@@ -0,0 +1,73 @@
+import os
+import re
+import socket
+import threading
+
+
+class HostContext:
+    """
+    Facts about the host, which all items share: where its files are (root),
+    its hostname and its Uberspace version. Both are looked up on first use
+    and only once, so e.g. `uberspace-takeout items` never waits for DNS. Pass
+    them in to skip the lookups, e.g. in tests or batches.
+    """
+
+    def __init__(self, root="/", hostname=None, uberspace_version=None):
+        # the host's files are looked up below root, e.g. for benchmarks
+        self.root = str(root)
+        self._hostname = hostname
+        self._uberspace_version = uberspace_version
+        self._release = None
+        self._release_key = None
+        self._lock = threading.Lock()
+
+    def path(self, path):
+        # path (e.g. /home/isabell) on the host, i.e. below root
+        return os.path.join(self.root, path.lstrip("/"))
+
+    @property
+    def hostname(self):
+        with self._lock:
+            if not self._hostname:
+                self._hostname = socket.getfqdn()
+            return self._hostname
+
+    @property
+    def uberspace_version(self):
+        if self._uberspace_version is not None:
+            return self._uberspace_version
+
+        # parsed once, but a stat() tells whether this is still the same file,
+        # e.g. when a Takeout is used for takeout and takein on another host
+        path = self.path("/etc/centos-release")
+        stat_result = os.stat(path)
+        key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+        with self._lock:
+            if self._release_key != key:
+                with open(path) as f:
+                    # looks like "CentOS release 6.10 (Final)"
+                    release = re.search(r"release ([0-9])+\.", f.read()).groups()[0]
+                self._release = int(release)
+                self._release_key = key
+            return self._release
+
+    def resolve(self):
+        """
+        Look up everything now and keep it, e.g. before forking workers. The
+        version is left to the items if there is no /etc/centos-release.
+        """
+        self.hostname
+        try:
+            self._uberspace_version = self.uberspace_version
+        except OSError:
+            pass
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
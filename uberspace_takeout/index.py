@@ -0,0 +1,194 @@
+import io
+import json
+import os
+import tarfile
+import zlib
+
+
+class IndexEntry:
+    __slots__ = ("name", "type", "offset", "offset_data", "size", "crc")
+
+    def __init__(self, name, type, offset, offset_data, size, crc):
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.offset_data = offset_data
+        self.size = size
+        self.crc = crc
+
+    def to_list(self):
+        return [
+            self.name,
+            self.type.decode("ascii"),
+            self.offset,
+            self.offset_data,
+            self.size,
+            self.crc,
+        ]
+
+    @classmethod
+    def from_list(cls, fields):
+        name, type_, *rest = fields
+        return cls(name, type_.encode("ascii"), *rest)
+
+
+class ArchiveIndex:
+    """
+    Lists where each member of a takeout is, so single members can be read
+    without going through the whole archive.
+
+    The index is stored as a member of its own, in a frame of its own, at the
+    end of the archive. The very last frame holds a tiny footer member pointing
+    at it, which is found by looking at the last few KiB of the file. frames
+    are the (compressed offset, uncompressed offset) pairs of every frame, see
+    codecs.FrameReader.
+    """
+
+    storage_path = ".uberspace_takeout.index"
+    footer_path = ".uberspace_takeout.index.footer"
+    # how far from the end of the file we look for the footer
+    footer_search_size = 64 * 1024
+
+    def __init__(self, entries=None, frames=None):
+        self.entries = entries if entries is not None else []
+        self.frames = frames if frames is not None else [(0, 0)]
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "version": 1,
+                "frames": self.frames,
+                "members": [e.to_list() for e in self.entries],
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+
+        if data.get("version") != 1:
+            raise Exception(
+                "unsupported archive index version: {}".format(data.get("version"))
+            )
+
+        return cls(
+            [IndexEntry.from_list(m) for m in data["members"]],
+            [tuple(f) for f in data["frames"]],
+        )
+
+    @staticmethod
+    def footer_json(compressed_offset):
+        return json.dumps({"version": 1, "offset": compressed_offset})
+
+    @classmethod
+    def _find_footer(cls, fileobj, codec):
+        size = fileobj.seek(0, os.SEEK_END)
+        # tar headers are block aligned, which is all we have for plain tars
+        start = max(0, size - cls.footer_search_size)
+        start -= start % tarfile.BLOCKSIZE
+        fileobj.seek(start)
+        tail = fileobj.read()
+
+        if codec.magic:
+            marker, step = codec.magic, 1
+        else:
+            marker, step = cls.footer_path.encode("utf-8"), tarfile.BLOCKSIZE
+
+        position = tail.rfind(marker)
+        while position >= 0:
+            if position % step == 0:
+                footer = cls._read_footer(codec, tail[position:])
+                if footer is not None:
+                    return footer
+            position = tail.rfind(marker, 0, position)
+
+        return None
+
+    @classmethod
+    def _read_footer(cls, codec, data):
+        try:
+            reader = codec.open_read(io.BytesIO(data))
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                member = tar.next()
+                if member is None or member.name != cls.footer_path:
+                    return None
+                return json.loads(tar.extractfile(member).read().decode("utf-8"))
+        except Exception:
+            # the magic bytes happened to be inside of compressed data, every
+            # codec has its own idea of how to complain about that.
+            return None
+
+    @classmethod
+    def load(cls, fileobj, codec):
+        """
+        Read the index of the archive in fileobj, or return None for archives
+        without one, e.g. from older versions. Leaves fileobj at its start.
+        """
+        try:
+            footer = cls._find_footer(fileobj, codec)
+            if footer is None:
+                return None
+
+            if footer.get("version") != 1:
+                raise Exception(
+                    "unsupported archive index version: {}".format(
+                        footer.get("version")
+                    )
+                )
+
+            fileobj.seek(footer["offset"])
+            with tarfile.open(fileobj=codec.open_read(fileobj), mode="r|") as tar:
+                for member in tar:
+                    if member.name == cls.storage_path:
+                        text = tar.extractfile(member).read().decode("utf-8")
+                        return cls.from_json(text)
+
+            raise Exception("archive index is missing, but its footer is not.")
+        finally:
+            fileobj.seek(0)
+
+
+class _Crc32Reader:
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.crc = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+
+class IndexingTarFile(tarfile.TarFile):
+    """
+    A TarFile recording the offsets and a CRC32 of the data of all members it
+    writes, as IndexEntry objects for an ArchiveIndex.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.index_entries = []
+        super().__init__(*args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        if fileobj is not None:
+            fileobj = _Crc32Reader(fileobj)
+
+        super().addfile(tarinfo, fileobj)
+
+        size = tarinfo.size if fileobj is not None else 0
+        blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+        if remainder:
+            blocks += 1
+
+        self.index_entries.append(
+            IndexEntry(
+                tarinfo.name.rstrip("/"),
+                tarinfo.type,
+                offset,
+                self.offset - blocks * tarfile.BLOCKSIZE,
+                size,
+                fileobj.crc if fileobj is not None else None,
+            )
+        )
@@ -1,15 +1,48 @@
+import asyncio
 import re
-import os
-import subprocess
+
+from uberspace_takeout import commands
+from uberspace_takeout import metrics
+from uberspace_takeout.exc import CommandTimeoutError
+from uberspace_takeout.exc import TakeoutError
+from uberspace_takeout.host import HostContext
 
 
 class TakeoutItem:
     description = None
-
-    def __init__(self, username, hostname, storage):
+    storage_path = None
+    # restore from every takeout in a chain of incremental ones, not just the last
+    incremental = False
+    # names of items, which have to be done before this one (if they run at all)
+    dependencies = ("TakeoutMarker",)
+    takein_dependencies = ()
+    # seconds to wait before retrying a command in run_many(), times the attempt
+    retry_delay = 1
+    # output of failed commands in run_many(), which are worth retrying, and
+    # which mean there is nothing left to do, e.g. when a takein is retried
+    transient_errors = re.compile(
+        r"temporar|try again|timed? ?out|locked|busy|connection", re.IGNORECASE
+    )
+    done_errors = re.compile(r"already (exists|added|been added)", re.IGNORECASE)
+    # ItemMetrics, set while the item runs, see Takeout._task()
+    metrics = metrics.NULL
+
+    def __init__(self, username, hostname, storage, root="/", host=None):
         self.username = username
-        self.hostname = hostname
         self.storage = storage
+        # hostname, root and version of the host, see HostContext
+        self.host = host if host is not None else HostContext(root, hostname)
+
+    @property
+    def hostname(self):
+        return self.host.hostname
+
+    @property
+    def root(self):
+        return self.host.root
+
+    def host_path(self, path):
+        return self.host.path(path)
 
     def takeout(self):
         raise NotImplementedError()
@@ -20,29 +53,76 @@ class TakeoutItem:
     def is_active(self):
         return True
 
-    def run_command(self, cmd, input_text=None):
-        env = os.environ.copy()
-        env["PATH"] = "/usr/local/bin/:" + env["PATH"]
-        env.pop("SUDO_USER", None)
-
-        p = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            stdin=subprocess.PIPE,
-            env=env,
-            universal_newlines=True,  # get a string, not bytes
-        )
-        out, _ = p.communicate(input_text)
+    def run_command(self, cmd, input_text=None, timeout=None, check=False):
+        # timeout is in seconds, CommandTimeoutError is raised after that. With
+        # check, CommandError is raised if cmd fails.
+        result = commands.get_runner().run(cmd, input_text, timeout)
+        self._count_command(result)
+        if check:
+            result.check()
+        return result.lines
 
-        return [l for l in out.split("\n") if l]
+    def _count_command(self, result):
+        self.metrics.add("commands")
+        self.metrics.add("command_seconds", result.duration)
 
     def run_uberspace(self, *cmd):
         return self.run_command(["uberspace"] + list(cmd))
 
+    async def run_command_async(self, cmd, input_text=None, timeout=None, check=False):
+        result = await commands.get_runner().run_async(cmd, input_text, timeout)
+        self._count_command(result)
+        if check:
+            result.check()
+        return result.lines
+
+    async def run_uberspace_async(self, *cmd):
+        return await self.run_command_async(["uberspace"] + list(cmd))
+
+    def run_concurrently(self, coroutines):
+        """
+        Wait for several run_*_async() calls at once and return their results,
+        in order, e.g.:
+
+            self.run_concurrently(self.run_uberspace_async(...) for ... in ...)
+        """
+        return commands.get_runner().gather(list(coroutines))
+
+    async def _run_with_retries(self, cmd, retries):
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * attempt)
+            try:
+                await self.run_command_async(cmd, check=True)
+                return None
+            except CommandTimeoutError as exc:
+                error = exc
+            except TakeoutError as exc:
+                if self.done_errors.search(str(exc)):
+                    return None
+                if not self.transient_errors.search(str(exc)):
+                    # e.g. an invalid domain, which fails every time
+                    return exc
+                error = exc
+        return error
+
+    def run_many(self, cmds, retries=2):
+        """
+        Run all cmds concurrently (as many as the command runner allows at once)
+        and retry the ones which timed out or failed for a transient reason.
+        Commands failing because it is done already (see done_errors) count as
+        done. Returns (cmd, error) for each cmd which failed nonetheless,
+        instead of stopping at the first one.
+        """
+        cmds = list(cmds)
+        errors = self.run_concurrently(
+            self._run_with_retries(cmd, retries) for cmd in cmds
+        )
+        return [(cmd, error) for cmd, error in zip(cmds, errors) if error]
+
 
 class PathItem(TakeoutItem):
-    storage_path = None
+    incremental = True
 
     def takeout(self):
         self.storage.store_directory(self.path(), self.storage_path)
@@ -50,17 +130,23 @@ class PathItem(TakeoutItem):
     def takein(self):
         self.storage.unstore_directory(self.storage_path, self.path())
 
+    @classmethod
+    def takein_all(cls, storage, items):
+        # path items restore into separate trees, so storages can handle all of
+        # them at once, see Storage.unstore_directories().
+        try:
+            storage.unstore_directories([(i.storage_path, i.path()) for i in items])
+        except FileNotFoundError as exc:
+            # the other trees have been restored nonetheless
+            raise TakeoutError("missing from the takeout: {}".format(exc.filename))
+
 
 class UberspaceVersionMixin:
     uberspace_version = None
 
     @property
     def current_uberspace_version(self):
-        with open("/etc/centos-release") as f:
-            text = f.read()
-            # looks like "CentOS release 6.10 (Final)"
-            centos_release = re.search(r"release ([0-9])+\.", text).groups()[0]
-            return int(centos_release)
+        return self.host.uberspace_version
 
     def is_active(self):
         return self.current_uberspace_version == int(self.uberspace_version)
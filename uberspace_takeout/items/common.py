@@ -7,12 +7,15 @@ from uberspace_takeout.exc import TakeoutError
 
 class TakeoutMarker(TakeoutItem):
     description = "Takeout Marker (internal)"
+    storage_path = ".uberspace_takeout"
+    incremental = True
+    dependencies = ()
 
     def takeout(self):
-        self.storage.store_text("uberspace_takeout", ".uberspace_takeout")
+        self.storage.store_text("uberspace_takeout", self.storage_path)
 
     def takein(self):
-        content = self.storage.unstore_text(".uberspace_takeout")
+        content = self.storage.unstore_text(self.storage_path)
 
         if content != "uberspace_takeout":
             raise Exception("input is not a takeout.")
@@ -23,7 +26,7 @@ class Homedir(PathItem):
     storage_path = "home/"
 
     def path(self):
-        return "/home/" + self.username
+        return self.host_path("/home/" + self.username)
 
 
 class Www(PathItem):
@@ -31,11 +34,12 @@ class Www(PathItem):
     storage_path = "www/"
 
     def path(self):
-        return "/var/www/virtual/" + self.username
+        return self.host_path("/var/www/virtual/" + self.username)
 
 
 class Cronjobs(TakeoutItem):
     description = "Cronjobs"
+    storage_path = "conf/cronjobs"
 
     def takeout(self):
         cronjobs = self.run_command(["crontab", "-l"])
@@ -45,19 +49,22 @@ class Cronjobs(TakeoutItem):
         else:
             text = "\n".join(cronjobs) + "\n"
 
-        self.storage.store_text(text, "conf/cronjobs")
+        self.storage.store_text(text, self.storage_path)
 
     def takein(self):
-        text = self.storage.unstore_text("conf/cronjobs")
+        text = self.storage.unstore_text(self.storage_path)
         self.run_command(["crontab", "-"], input_text=text)
 
 
 class MySQLPassword(TakeoutItem):
     description = "MySQL password"
+    storage_path = "conf/mysql-password-client"
+    # restoring the homedir would overwrite .my.cnf
+    takein_dependencies = ("Homedir",)
 
     @property
     def _my_cnf_path(self):
-        return "/home/" + self.username + "/.my.cnf"
+        return self.host_path("/home/" + self.username + "/.my.cnf")
 
     def _open_my_cnf(self, section):
         config = configparser.ConfigParser(interpolation=None)
@@ -87,7 +94,7 @@ class MySQLPassword(TakeoutItem):
             config.write(f)
 
     def _set_password(self, suffix):
-        password = self.storage.unstore_text("conf/mysql-password-client" + suffix)
+        password = self.storage.unstore_text(self.storage_path + suffix)
         self.run_command(
             [
                 "mysql",
@@ -100,7 +107,7 @@ class MySQLPassword(TakeoutItem):
 
     def takeout(self):
         password = self._read_my_cnf_password("client")
-        self.storage.store_text(password, "conf/mysql-password-client")
+        self.storage.store_text(password, self.storage_path)
         self._check_password(password)
 
     def takein(self):
@@ -3,6 +3,7 @@ import re
 
 from .base import TakeoutItem
 from .base import UberspaceVersionMixin
+from uberspace_takeout.exc import TakeoutError
 
 
 class U6Mixin(UberspaceVersionMixin):
@@ -28,8 +29,16 @@ class DomainItem(U6Mixin, TakeoutItem):
     def takein(self):
         text = self.storage.unstore_text(self.storage_path)
 
-        for domain in (d for d in text.split("\n") if d):
-            self.run_command(["uberspace-add-domain", self.flag, "-d", domain])
+        domains = []
+        for domain in (d.strip().lower() for d in text.split("\n")):
+            if domain and domain not in domains:
+                domains.append(domain)
+
+        failed = self.run_many(
+            ["uberspace-add-domain", self.flag, "-d", domain] for domain in domains
+        )
+        if failed:
+            raise TakeoutError(*(str(error) for _, error in failed))
 
 
 class WebDomains(DomainItem):
@@ -41,7 +50,8 @@ class WebDomains(DomainItem):
         domains = super()._find_domains()
 
         try:
-            for candidate in os.listdir('/var/www/virtual/' + self.username):
+            www = self.host_path('/var/www/virtual/' + self.username)
+            for candidate in os.listdir(www):
                 if not re.search(r'\.[a-z0-9-]{2,}$', candidate):
                     continue
 
@@ -2,6 +2,7 @@ import re
 
 from .base import TakeoutItem
 from .base import UberspaceVersionMixin
+from uberspace_takeout.exc import TakeoutError
 
 
 class U7Mixin(UberspaceVersionMixin):
@@ -34,19 +35,34 @@ class DomainItem(U7Mixin, TakeoutItem):
         }
         self.storage.store_text("\n".join(domains), self.storage_path)
 
+    def _normalize_domain(self, domain):
+        domain = domain.strip().lower()
+        if " " in domain:
+            domain, _, namespace = domain.partition(" ")
+            print("namespaced domains are not supported, stripping namespace: " + namespace)
+        if domain.startswith("*."):
+            print("wildcard certs are not supported, adding subdomain www at least")
+            domain = "www" + domain[1:]
+        if domain.endswith('.uberspace.de'):
+            print("user.host.uberspace.de domains are not supported, rewriting to .uber.space")
+            domain = convert_legacy_domain(domain)
+        return domain.rstrip(".")
+
     def takein(self):
         text = self.storage.unstore_text(self.storage_path)
-        for domain in (d for d in text.split("\n") if d):
-            if " " in domain:
-                domain, _, namespace = domain.partition(" ")
-                print("namespaced domains are not supported, stripping namespace: " + namespace)
-            if domain.startswith("*."):
-                print("wildcard certs are not supported, adding subdomain www at least")
-                domain = "www" + domain[1:]
-            if domain.endswith('.uberspace.de'):
-                print("user.host.uberspace.de domains are not supported, rewriting to .uber.space")
-                domain = convert_legacy_domain(domain)
-            self.run_uberspace(self.area, "domain", "add", domain)
+
+        domains = []
+        for domain in (d for d in text.split("\n") if d.strip()):
+            domain = self._normalize_domain(domain)
+            # e.g. "*.example.com" and "www.example.com" end up the same
+            if domain not in domains:
+                domains.append(domain)
+
+        failed = self.run_many(
+            ["uberspace", self.area, "domain", "add", domain] for domain in domains
+        )
+        if failed:
+            raise TakeoutError(*(str(error) for _, error in failed))
 
 
 class WebDomains(DomainItem):
@@ -119,22 +135,26 @@ class SpamfilterLogItem(FlagItem):
 
 class ToolVersions(U7Mixin, TakeoutItem):
     description = "Setting: Tool Versions"
+    storage_path = "conf/tool-version/"
 
     def takeout(self):
-        tools = self.run_uberspace("tools", "version", "list")
+        tools = [t.lstrip("- ") for t in self.run_uberspace("tools", "version", "list")]
 
-        for tool in tools:
-            tool = tool.lstrip("- ")
-            out = self.run_uberspace("tools", "version", "show", tool)
+        # each call starts the whole uberspace cli, so run them all at once
+        outputs = self.run_concurrently(
+            self.run_uberspace_async("tools", "version", "show", tool) for tool in tools
+        )
+
+        for tool, out in zip(tools, outputs):
             version = re.search(r"'([0-9\.]+)'", out[0]).groups()[0]
-            self.storage.store_text(version, "conf/tool-version/" + tool)
+            self.storage.store_text(version, self.storage_path + tool)
 
     def takein(self):
         try:
-            tools = self.storage.list_files("conf/tool-versions")
+            tools = self.storage.list_files(self.storage_path)
         except FileNotFoundError:
             return
 
         for tool in tools:
-            version = self.storage.unstore_text("conf/tool-versions/" + tool)
+            version = self.storage.unstore_text(self.storage_path + tool)
             self.run_uberspace("tools", "version", "use", tool, version)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import uuid
+
+
+class Manifest:
+    """
+    Lists everything a takeout stored in its directories, so a later takeout
+    can store just the differences (see TarStorage's since option).
+
+    entries maps storage paths to [type, size, mtime_ns, inode, sha256], where
+    sha256 is only set if checksums were requested. deleted lists storage paths
+    of the previous takeout, which are gone (or changed their type) now.
+    """
+
+    # where the manifest is stored inside the takeout
+    storage_path = ".uberspace_takeout.manifest"
+
+    def __init__(self, id=None, base=None, entries=None, deleted=None):
+        self.id = id or str(uuid.uuid4())
+        self.base = base
+        self.entries = entries if entries is not None else {}
+        self.deleted = deleted if deleted is not None else []
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "version": 1,
+                "id": self.id,
+                "base": self.base,
+                "entries": self.entries,
+                "deleted": self.deleted,
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+
+        if data.get("version") != 1:
+            raise Exception(
+                "unsupported manifest version: {}".format(data.get("version"))
+            )
+
+        return cls(data["id"], data["base"], data["entries"], data["deleted"])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a manifest from a file, or from a takeout containing one.
+        """
+        # avoid the circular import
+        from .storage import TarStorage
+
+        with open(path, "rb") as f:
+            is_json = f.read(1) == b"{"
+
+        if is_json:
+            with open(path) as f:
+                return cls.from_json(f.read())
+
+        with TarStorage(path, "takein") as s:
+            try:
+                return cls.from_json(s.unstore_text(cls.storage_path))
+            except FileNotFoundError:
+                raise Exception("{} does not contain a manifest.".format(path))
+
+    @staticmethod
+    def entry(path, stat_result, checksum=False):
+        if stat.S_ISREG(stat_result.st_mode):
+            type_ = "f"
+        elif stat.S_ISDIR(stat_result.st_mode):
+            type_ = "d"
+        elif stat.S_ISLNK(stat_result.st_mode):
+            type_ = "l"
+        else:
+            type_ = "o"
+
+        digest = None
+        if checksum and type_ == "f":
+            digest = file_digest(path)
+
+        return [
+            type_,
+            stat_result.st_size,
+            stat_result.st_mtime_ns,
+            stat_result.st_ino,
+            digest,
+        ]
+
+    def is_unchanged(self, name, entry):
+        previous = self.entries.get(name)
+
+        if previous is None or previous[:4] != entry[:4]:
+            return False
+
+        # only compare checksums, if we have them both times
+        return entry[4] is None or previous[4] == entry[4]
+
+    def type_changed(self, name, entry):
+        previous = self.entries.get(name)
+        return previous is not None and previous[0] != entry[0]
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_inside(name, directory):
+    return name == directory or name.startswith(directory + "/")
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
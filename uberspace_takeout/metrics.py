@@ -0,0 +1,160 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    # KiB on Linux, the only platform takeouts run on anyway
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ItemMetrics:
+    """
+    Counters of a single item, e.g. files, bytes_read or commands. Items add
+    to them from their own thread as well as from the command runner's.
+    """
+
+    def __init__(self, name, action):
+        self.name = name
+        self.action = action
+        self.counters = {
+            "files": 0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "commands": 0,
+            "command_seconds": 0.0,
+        }
+        self._lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {"item": self.name, "action": self.action, **self.counters}
+
+
+class _NullMetrics(ItemMetrics):
+    def __init__(self):
+        super().__init__(None, None)
+
+    def add(self, counter, value=1):
+        pass
+
+
+# what add() counts to outside of Metrics.measure()
+NULL = _NullMetrics()
+
+_local = threading.local()
+
+
+def current():
+    """
+    The ItemMetrics of the item running in this thread, e.g. for storages.
+    """
+    return getattr(_local, "metrics", NULL)
+
+
+def add(counter, value=1):
+    current().add(counter, value)
+
+
+class Metrics:
+    """
+    Measures items, and writes one JSON object per item and storage to output
+    (a file object), if given. With profile_dir, every item is run using
+    cProfile and its stats are written to <profile_dir>/<action>-<item>.prof.
+    """
+
+    def __init__(self, output=None, profile_dir=None):
+        self.output = output
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def _write(self, record):
+        if self.output is None:
+            return
+
+        with self._lock:
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+
+    def _start_profile(self):
+        if not self.profile_dir:
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python >= 3.12 can only profile one thread at a time, so items
+            # running in parallel to a profiled one are not profiled.
+            return None
+        return profile
+
+    def _stop_profile(self, profile, metrics):
+        if profile is None:
+            return
+
+        profile.disable()
+        profile.dump_stats(
+            os.path.join(
+                self.profile_dir, "{}-{}.prof".format(metrics.action, metrics.name)
+            )
+        )
+
+    @contextlib.contextmanager
+    def measure(self, name, action):
+        """
+        Measure the item name, which runs in this thread, and yield its
+        ItemMetrics, which current() returns in the meantime, too.
+        """
+        metrics = ItemMetrics(name, action)
+        previous = current()
+        _local.metrics = metrics
+
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        profile = self._start_profile()
+        error = None
+
+        try:
+            yield metrics
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self._stop_profile(profile, metrics)
+            _local.metrics = previous
+
+            record = metrics.to_dict()
+            record["wall_seconds"] = round(time.perf_counter() - start, 6)
+            record["cpu_seconds"] = round(time.thread_time() - start_cpu, 6)
+            record["peak_rss_kib"] = peak_rss()
+            if error is not None:
+                record["error"] = str(error)
+            self._write(record)
+
+    def storage(self, storage):
+        """
+        Write the counters of storage, see Storage.stats().
+        """
+        stats = storage.stats()
+        if stats:
+            self._write(
+                {"storage": storage.__class__.__name__, "action": storage.mode, **stats}
+            )
@@ -0,0 +1,103 @@
+import os
+import tarfile
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+
+def parse_user_map(specs):
+    """
+    Turn ["old:new", ...] into {"old": "new", ...}.
+    """
+    user_map = {}
+    for spec in specs:
+        old, sep, new = spec.partition(":")
+        if not sep or not old or not new:
+            raise ValueError("expected OLD:NEW, got {!r}".format(spec))
+        user_map[old] = new
+    return user_map
+
+
+class OwnerMap:
+    """
+    Decides who owns restored files. Owners are looked up by name, like
+    tarfile does, after renaming users (and their groups of the same name)
+    according to user_map. Names which don't exist on this host fall back to
+    username instead of keeping the uid/gid of the old host.
+
+    Archives only contain a handful of distinct owners, so each one is looked
+    up once instead of for every single member.
+    """
+
+    def __init__(self, username, user_map=None):
+        self.username = username
+        self.user_map = dict(user_map or {})
+        self._owners = {}
+        self._fallback = None
+
+    def _lookup(self, database, name):
+        if database is None or not name:
+            return None
+        try:
+            return database(name)
+        except KeyError:
+            return None
+
+    def _get_fallback(self):
+        if self._fallback is None:
+            user = self._lookup(pwd and pwd.getpwnam, self.username)
+            self._fallback = (user.pw_uid, user.pw_gid) if user else (None, None)
+        return self._fallback
+
+    def _resolve(self, uname, gname, uid, gid):
+        uname = self.user_map.get(uname, uname)
+        gname = self.user_map.get(gname, gname)
+        fallback_uid, fallback_gid = self._get_fallback()
+
+        user = self._lookup(pwd and pwd.getpwnam, uname)
+        if user is not None:
+            uid = user.pw_uid
+        elif fallback_uid is not None:
+            uid = fallback_uid
+
+        group = self._lookup(grp and grp.getgrnam, gname)
+        if group is not None:
+            gid = group.gr_gid
+        elif fallback_gid is not None:
+            gid = fallback_gid
+
+        return uid, gid
+
+    def resolve(self, member):
+        key = (member.uname, member.gname, member.uid, member.gid)
+        if key not in self._owners:
+            self._owners[key] = self._resolve(*key)
+        return self._owners[key]
+
+    def chown(self, member, path):
+        # just like tarfile, only root can give files away
+        if not hasattr(os, "geteuid") or os.geteuid() != 0:
+            return
+
+        uid, gid = self.resolve(member)
+        try:
+            os.lchown(path, uid, gid)
+        except OSError as exc:
+            raise tarfile.ExtractError("could not change owner") from exc
+
+
+class OwnerMapTarFile(tarfile.TarFile):
+    """
+    A TarFile using an OwnerMap for extract(), extractall() and everyone
+    calling its chown(), e.g. the ParallelExtractor.
+    """
+
+    owners = None
+
+    def chown(self, tarinfo, targetpath, numeric_owner):
+        if self.owners is None or numeric_owner:
+            return super().chown(tarinfo, targetpath, numeric_owner)
+        self.owners.chown(tarinfo, targetpath)
@@ -0,0 +1,268 @@
+import collections
+import io
+import os
+import threading
+
+
+class ByteBudgetQueue:
+    """
+    A FIFO queue, which blocks put() as long as the items in it are larger
+    than max_bytes in total. A single item larger than that is still accepted
+    if the queue is empty, so nothing can get stuck.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = collections.deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    def put(self, item, size):
+        with self._cond:
+            while self._items and self._bytes + size > self.max_bytes:
+                self._cond.wait()
+
+            self._items.append((item, size))
+            self._bytes += size
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+
+_STOP = object()
+
+
+class _Stage:
+    """
+    A thread passing everything put() into its queue to consume(), in order.
+    Callables are called instead, which allows to run things in between data.
+    """
+
+    def __init__(self, consume, max_bytes, name):
+        self._consume = consume
+        self._queue = ByteBudgetQueue(max_bytes)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+
+            if item is _STOP:
+                return
+            if self._error is not None:
+                # keep draining, so put() doesn't block forever
+                continue
+
+            try:
+                if callable(item):
+                    item()
+                else:
+                    self._consume(item)
+            except BaseException as exc:
+                self._error = exc
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, item, size=0):
+        self._raise()
+        self._queue.put(item, size)
+
+    def sync(self):
+        """
+        Wait until everything put() so far has been consumed.
+        """
+        done = threading.Event()
+        self.put(done.set)
+        # on errors, the queue is drained without calling anything
+        while not done.wait(0.1) and self._error is None:
+            pass
+        self._raise()
+
+    def close(self):
+        self._queue.put(_STOP, 0)
+        self._thread.join()
+        self._raise()
+
+
+class _StageFile(io.RawIOBase):
+    def __init__(self, stage, fileobj):
+        self._stage = stage
+        self._fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._stage.put(bytes(data), len(data))
+        return len(data)
+
+    def flush(self):
+        self._stage.put(self._fileobj.flush)
+
+
+class PipelinedWriter(io.RawIOBase):
+    """
+    Moves compression and writing the output into threads of their own:
+
+        write() -> [compression thread] -> [output thread] -> fileobj
+
+    The stages are connected by queues holding at most max_bytes each, so
+    reading input, compressing and writing output overlap while memory usage
+    stays capped. make_writer(fileobj) creates the actual compressing writer,
+    e.g. a codecs.CompressWriter. The bz2/zlib/lzma/zstd compressors release
+    the GIL while working.
+    """
+
+    def __init__(self, fileobj, make_writer, max_bytes=16 * 1024 * 1024):
+        self.fileobj = fileobj
+        self._output = _Stage(fileobj.write, max_bytes, "takeout-output")
+        self.writer = make_writer(_StageFile(self._output, fileobj))
+        self._compression = _Stage(self.writer.write, max_bytes, "takeout-compress")
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._compression.put(bytes(data), len(data))
+        self._position += len(data)
+        return len(data)
+
+    def call(self, fn):
+        """
+        Call fn in the compression thread, after all data written so far.
+        """
+        self._compression.put(fn)
+
+    def end_frame(self):
+        offsets = []
+        self._compression.put(lambda: offsets.append(self.writer.end_frame()))
+        self._compression.sync()
+        return offsets[0]
+
+    def set_stored(self, stored):
+        self.call(lambda: self.writer.set_stored(stored))
+
+    def resume(self, frames, offsets):
+        # nothing has been written yet, so the threads are idle
+        self.writer.resume(frames, offsets)
+        self._position = offsets[1]
+
+    def sync(self):
+        """
+        Wait until everything written so far is in fileobj, e.g. for a
+        checkpoint.
+        """
+        self._compression.sync()
+        self._output.sync()
+
+    @property
+    def frames(self):
+        return self.writer.frames
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            try:
+                self._compression.close()
+            finally:
+                # shuts down the process pool of a ParallelCompressWriter
+                self.writer.close()
+        finally:
+            try:
+                self._output.close()
+                self.fileobj.flush()
+            finally:
+                super().close()
+
+
+class Prefetcher:
+    """
+    Reads the files below path in the same order tarfile.add() does, so they are
+    in the page cache by the time tarfile gets to them. consumed() tells how far
+    the actual reader has got, in bytes; we stay at most window bytes ahead of
+    it, so we don't push out files from the cache before they are used.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path, consumed, window=64 * 1024 * 1024):
+        self.path = str(path)
+        self.consumed = consumed
+        self.window = window
+        self.prefetched = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="takeout-prefetch", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _files(self, path):
+        # same order as tarfile.add(): depth first, sorted by name, no symlinks
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._files(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path
+            except OSError:
+                pass
+
+    def _wait(self):
+        while self.prefetched - self.consumed() > self.window:
+            if self._stopped.wait(0.01):
+                return False
+        return True
+
+    def _prefetch(self, path):
+        with open(path, "rb", buffering=0) as f:
+            while not self._stopped.is_set():
+                if not self._wait():
+                    return
+                data = f.read(self.chunk_size)
+                if not data:
+                    return
+                self.prefetched += len(data)
+
+    def _run(self):
+        paths = self._files(self.path) if os.path.isdir(self.path) else [self.path]
+
+        for path in paths:
+            if self._stopped.is_set():
+                return
+
+            try:
+                self._prefetch(path)
+            except OSError:
+                # tarfile will run into the same problem and report it
+                pass
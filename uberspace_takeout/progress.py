@@ -0,0 +1,226 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+
+def scan_tree(path):
+    """
+    Count the regular files below path and their sizes, without reading or
+    looking up anything else. Returns (files, bytes).
+    """
+    files = size = 0
+    stack = [str(path)]
+
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            # vanished or unreadable, tar will complain about it if it matters
+            pass
+
+    return files, size
+
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1000
+    return "{:.1f} TB".format(size)
+
+
+class Progress:
+    """
+    Reports how many files and bytes were stored or restored so far, how fast,
+    and, once the totals are known, how long it will take.
+
+    Storages call add() for every file, totals are added using add_total(),
+    or by scan(), which counts files in a thread of its own, so archiving
+    doesn't have to wait for it. While running (see start()), a line is
+    written to output every interval seconds (redrawn in place on terminals),
+    and a JSON object to events.
+    """
+
+    def __init__(self, output=None, events=None, interval=1.0):
+        self.output = output
+        self.events = events
+        self.interval = interval
+        # callable returning how much has been written to the archive so far
+        self.compressed_bytes = None
+
+        self.files = 0
+        self.bytes = 0
+        self.total_files = 0
+        self.total_bytes = 0
+        self._scans = 0
+        self._lock = threading.Lock()
+        self._output_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+        self._drawn = False
+
+    @property
+    def enabled(self):
+        return self.output is not None or self.events is not None
+
+    def add(self, files, size):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+
+    def add_total(self, files, size):
+        with self._lock:
+            self.total_files += files
+            self.total_bytes += size
+
+    def scan(self, paths):
+        # returns the thread scanning, if any
+        if not self.enabled:
+            return None
+
+        paths = list(paths)
+        with self._lock:
+            self._scans += 1
+
+        def run():
+            for path in paths:
+                self.add_total(*scan_tree(path))
+            with self._lock:
+                self._scans -= 1
+            self._event("scan", files=self.total_files, bytes=self.total_bytes)
+
+        thread = threading.Thread(target=run, name="takeout-scan", daemon=True)
+        thread.start()
+        return thread
+
+    def snapshot(self):
+        with self._lock:
+            state = {
+                "files": self.files,
+                "bytes": self.bytes,
+                "total_files": self.total_files if not self._scans else None,
+                "total_bytes": self.total_bytes if not self._scans else None,
+            }
+
+        elapsed = time.monotonic() - self._start if self._start else 0
+        compressed = self.compressed_bytes() if self.compressed_bytes else None
+        state["elapsed"] = round(elapsed, 3)
+        state["compressed_bytes"] = compressed
+        state["files_per_second"] = round(state["files"] / elapsed, 1) if elapsed else 0
+        state["bytes_per_second"] = round(state["bytes"] / elapsed) if elapsed else 0
+        state["ratio"] = (
+            round(compressed / state["bytes"], 3)
+            if compressed is not None and state["bytes"]
+            else None
+        )
+
+        eta = None
+        if state["total_bytes"] is not None and state["bytes_per_second"]:
+            remaining = max(state["total_bytes"] - state["bytes"], 0)
+            eta = round(remaining / state["bytes_per_second"])
+        state["eta"] = eta
+
+        return state
+
+    def _format(self, state):
+        parts = [
+            "{} files".format(state["files"]),
+            _format_bytes(state["bytes"]),
+        ]
+        if state["total_bytes"] is not None:
+            parts[0] += " of {}".format(state["total_files"])
+            parts[1] += " of {}".format(_format_bytes(state["total_bytes"]))
+        parts.append(_format_bytes(state["bytes_per_second"]) + "/s")
+        parts.append("{:.0f} files/s".format(state["files_per_second"]))
+        if state["ratio"] is not None:
+            parts.append("ratio {:.2f}".format(state["ratio"]))
+        if state["eta"] is not None:
+            parts.append("ETA " + str(datetime.timedelta(seconds=state["eta"])))
+        return ", ".join(parts)
+
+    def _event(self, event, **data):
+        if self.events is None:
+            return
+        with self._output_lock:
+            self.events.write(json.dumps({"event": event, **data}) + "\n")
+            self.events.flush()
+
+    def _is_terminal(self):
+        return hasattr(self.output, "isatty") and self.output.isatty()
+
+    def _clear(self):
+        # only called holding _output_lock
+        if self._drawn:
+            self.output.write("\r\x1b[K")
+            self.output.flush()
+            self._drawn = False
+
+    def draw(self):
+        state = self.snapshot()
+        self._event("progress", **state)
+
+        if self.output is None:
+            return
+        with self._output_lock:
+            if self._is_terminal():
+                self.output.write("\r\x1b[K" + self._format(state))
+                self._drawn = True
+            else:
+                self.output.write(self._format(state) + "\n")
+            self.output.flush()
+
+    def item(self, name, action):
+        # announce an item, without messing up the line drawn last
+        self._event("item", item=name, action=action)
+        if self.output is not None:
+            with self._output_lock:
+                self._clear()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.draw()
+
+    def start(self):
+        with self._lock:
+            self.files = self.bytes = 0
+            self.total_files = self.total_bytes = 0
+        self._start = time.monotonic()
+        if self.enabled:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="takeout-progress", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        self.draw()
+        if self.output is not None:
+            with self._output_lock:
+                if self._drawn:
+                    self.output.write("\n")
+                    self.output.flush()
+                    self._drawn = False
+        self._event("done", **self.snapshot())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
@@ -0,0 +1,81 @@
+import concurrent.futures
+
+
+class Task:
+    def __init__(self, name, run, dependencies=()):
+        self.name = name
+        self.run = run
+        self.dependencies = tuple(dependencies)
+
+
+class Scheduler:
+    """
+    Runs tasks in up to jobs threads, each one as soon as all of its
+    dependencies are done. Dependencies on tasks which aren't scheduled at all
+    (e.g. skipped items) are ignored. Ready tasks are started in the order they
+    were given, so with jobs=1 this is just a loop over them.
+
+    If a task raises, no further tasks are started and the exception is raised
+    once the running ones are done.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(jobs, 1)
+
+    def _check(self, tasks):
+        names = {t.name for t in tasks}
+        if len(names) != len(tasks):
+            raise Exception("task names have to be unique.")
+
+        # make sure there are no cycles, which would never finish
+        done = set()
+        pending = list(tasks)
+        while pending:
+            ready = [t for t in pending if self._is_ready(t, names, done)]
+            if not ready:
+                raise Exception(
+                    "circular dependencies between: "
+                    + ", ".join(t.name for t in pending)
+                )
+            done.update(t.name for t in ready)
+            pending = [t for t in pending if t.name not in done]
+
+    def _is_ready(self, task, names, done):
+        return all(d in done or d not in names for d in task.dependencies)
+
+    def run(self, tasks):
+        tasks = list(tasks)
+        self._check(tasks)
+
+        names = {t.name for t in tasks}
+        pending = list(tasks)
+        running = {}
+        done = set()
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            while pending or running:
+                if error is None:
+                    for task in list(pending):
+                        if len(running) >= self.jobs:
+                            break
+                        if self._is_ready(task, names, done):
+                            pending.remove(task)
+                            running[executor.submit(task.run)] = task
+                else:
+                    pending = []
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    task = running.pop(future)
+                    done.add(task.name)
+                    if future.exception() is not None and error is None:
+                        error = future.exception()
+
+        if error is not None:
+            raise error
@@ -1,7 +1,37 @@
+import collections
+import concurrent.futures
 import datetime
 import errno
+import functools
+import hashlib
+import itertools
+import json
 import os
+import posixpath
+import stat
 import tarfile
+import threading
+import time
+import zlib
+
+from . import chunks
+from . import codecs
+from . import metrics
+from .chunks import ChunkStore
+from .extract import ParallelExtractor
+from .filecopy import TreeCopier
+from .index import ArchiveIndex
+from .index import IndexEntry
+from .index import IndexingTarFile
+from .manifest import is_inside
+from .manifest import Manifest
+from .manifest import remove_path
+from .ownership import OwnerMapTarFile
+from .pipeline import Prefetcher
+from .sync import file_crc32
+from .sync import same_content
+from .sync import TreeSync
+from .walk import TreeWalker
 
 try:
     from BytesIO import BytesIO
@@ -9,6 +39,16 @@ except ImportError:
     from io import BytesIO
 
 
+def raise_missing(storage_paths):
+    # once everything else has been restored
+    if storage_paths:
+        raise FileNotFoundError(
+            errno.ENOENT,
+            "not in the takeout",
+            ", ".join(str(p).strip("/") for p in storage_paths),
+        )
+
+
 class Storage:
     def __init__(self, destination, mode):
         if mode not in ("takein", "takeout"):
@@ -18,6 +58,8 @@ class Storage:
 
         self.destination = str(destination)
         self.mode = mode
+        # takeout: names of the items, which are done, see item_done()
+        self.done_items = []
 
     def __enter__(self):
         raise NotImplementedError()
@@ -40,21 +82,471 @@ class Storage:
     def unstore_file(self, storage_path, system_path):
         raise NotImplementedError()
 
+    def stats(self):
+        # totals of the whole storage, e.g. compressed_bytes, see metrics.py
+        return {}
+
+    def claim(self, storage_paths):
+        # items announce which paths they are going to unstore. Only needed by
+        # storages which cannot go back, see TarStreamStorage.
+        pass
+
+    def item_done(self, name):
+        # takeouts announce every item, which is done. Only needed by storages
+        # which can resume a takeout, see TarStorage.
+        self.done_items.append(name)
+
     def store_directory(self, system_path, storage_path):
         return self.store_file(system_path, storage_path)
 
     def unstore_directory(self, storage_path, system_path):
         return self.unstore_file(storage_path, system_path)
 
+    def unstore_directories(self, directories):
+        # directories is a list of (storage_path, system_path) tuples, which
+        # storages may restore in one go. Trees missing from the takeout don't
+        # keep the others from being restored, see raise_missing().
+        missing = []
+        for storage_path, system_path in directories:
+            try:
+                self.unstore_directory(storage_path, system_path)
+            except FileNotFoundError:
+                missing.append(storage_path)
+        raise_missing(missing)
+
 
 class TarStorage(Storage):
+    # texts stored after this much other data start a new frame, so they can
+    # be read without decompressing everything before them.
+    text_frame_distance = 1024 * 1024
+    # takeouts write a checkpoint at least this often, in uncompressed bytes
+    # and in seconds, see checkpoint()
+    checkpoint_size = 256 * 1024 * 1024
+    checkpoint_interval = 60
+    checkpoint_format = "uberspace-takeout-checkpoint"
+
+    def __init__(
+        self,
+        destination,
+        mode,
+        compression="bz2",
+        level=None,
+        jobs=1,
+        pipeline=False,
+        since=None,
+        checksum=False,
+        owners=None,
+        progress=None,
+        store_incompressible=False,
+        checkpoints=True,
+        resume=False,
+        checkpoint_info=None,
+        skip_unchanged=False,
+        delete=False,
+    ):
+        super().__init__(destination, mode)
+        # only used for takeout, takein detects the codec on its own
+        self.codec = codecs.get_codec(compression)
+        # store files which are compressed already (e.g. images or archives)
+        # in frames of their own, compressed at the codec's store_level
+        if store_incompressible and self.codec.store_level is None:
+            raise Exception(
+                "{} can't store files uncompressed, use gzip or zstd.".format(
+                    self.codec.name
+                )
+            )
+        # nothing to gain without compression
+        self.store_incompressible = store_incompressible and self.codec.name != "none"
+        self.incompressible_size = 256 * 1024
+        self.level = level
+        # takeout: processes to compress with, takein: threads to extract with
+        self.jobs = jobs
+        self.pipeline = pipeline
+        # a Manifest (or path to one), only files changed since then are stored
+        self._since_path = None
+        if since is not None and not isinstance(since, Manifest):
+            self._since_path = os.path.abspath(str(since))
+            since = Manifest.load(since)
+        self.since = since
+        self.checksum = checksum
+        # takein: an OwnerMap deciding who owns restored files (as root)
+        self.owners = owners
+        # a Progress, told about every file stored or restored
+        self.progress = progress
+        # takeout: record checkpoints in checkpoint_path, so an interrupted
+        # takeout can be resumed, i.e. carried on with from the last one
+        self.checkpoints = checkpoints
+        self.resume = resume
+        self.checkpoint_path = self.destination + ".checkpoint"
+        # what has to match to resume, e.g. {"username": ...}
+        self.checkpoint_info = checkpoint_info or {}
+        # takein: leave files alone, which are there already (compared by size
+        # and mtime, with checksum by their contents, too), and with delete,
+        # remove everything the takeout doesn't contain
+        self.sync = TreeSync(checksum, delete) if skip_unchanged else None
+
+    def _open_tar(self, stream=False):
+        self.index = None
+
+        if self.mode == "takeout":
+            if self.resume:
+                # everything after the last checkpoint is written again
+                self._file = open(self.destination, "r+b")
+                self._file.truncate(self._resumed["offsets"][0])
+                self._file.seek(0, os.SEEK_END)
+            else:
+                self._file = open(self.destination, "wb")
+            self._fileobj = codecs.open_writer(
+                self._file, self.codec, self.level, self.jobs, self.pipeline
+            )
+            if self.resume:
+                self._fileobj.resume(self._resumed["frames"], self._resumed["offsets"])
+            return IndexingTarFile.open(fileobj=self._fileobj, mode="w")
+
+        self._file = open(self.destination, "rb")
+        self.codec = codecs.detect_codec(self._read_header())
+
+        if not stream:
+            self.index = ArchiveIndex.load(self._file, self.codec)
+
+        if self.index and self.codec.name != "none":
+            self._fileobj = codecs.FrameReader(
+                self._file, self.codec, self.index.frames
+            )
+        else:
+            self._fileobj = self.codec.open_read(self._file)
+        tar = OwnerMapTarFile.open(fileobj=self._fileobj, mode="r|" if stream else "r")
+        tar.owners = self.owners
+        return tar
+
+    def _read_header(self):
+        if not self._file.seekable():
+            # pipes can't go back, but buffered files let us look ahead
+            return self._file.peek(16)
+
+        header = self._file.read(16)
+        self._file.seek(0)
+        return header
+
+    def _close_tar(self):
+        try:
+            self.tar.close()
+            self._fileobj.close()
+            if self.mode == "takeout":
+                self._stats = {
+                    "codec": self.codec.name,
+                    "raw_bytes": self.tar.offset,
+                    "compressed_bytes": (
+                        self._file.tell() if self._file.seekable() else None
+                    ),
+                }
+        finally:
+            self._file.close()
+
+    def stats(self):
+        return getattr(self, "_stats", {})
+
     def __enter__(self):
-        mode = "w:bz2" if self.mode == "takeout" else "r:bz2"
-        self.tar = tarfile.open(self.destination, mode)
+        if self.mode == "takeout" and self.resume:
+            self._load_checkpoint()
+        self.tar = self._open_tar()
+        # name => list of members with that name, and
+        # directory => {child name: None}, so we can walk sub-trees
+        self._members = {}
+        self._children = {}
+        if self.index:
+            # no need to go through the whole archive
+            self._index_members(self.index.entries)
+        else:
+            self._index_members(self.tar.getmembers())
+
+        if self.mode == "takeout":
+            self.manifest = Manifest(base=self.since.id if self.since else None)
+            self._stored_roots = []
+            self._frame_start = 0
+            self._stored = False
+            self._walker = TreeWalker(self.tar.inodes)
+            # storage roots, which were being stored at the last checkpoint
+            self._resumed_roots = set()
+            if self.progress is not None:
+                self.progress.compressed_bytes = self._written
+            if self.resume:
+                self._restore_checkpoint()
+            self._start_checkpoints()
+        elif self.has_member(Manifest.storage_path):
+            self.manifest = Manifest.from_json(self.unstore_text(Manifest.storage_path))
+        else:
+            # takeouts from older versions
+            self.manifest = None
+
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.tar.close()
+        complete = False
+        try:
+            if self.mode == "takeout" and exception_type is None:
+                # the manifest and the index get a frame of their own, so they
+                # can be read without decompressing everything before them.
+                index_frame = self._fileobj.end_frame()
+                self._store_manifest()
+                self._store_index(index_frame)
+                complete = True
+        finally:
+            self._close_tar()
+
+        if complete and self._checkpointing:
+            # nothing left to resume
+            os.unlink(self.checkpoint_path)
+
+    def _start_checkpoints(self):
+        # only files can be cut off at a checkpoint, pipes can't
+        self._checkpointing = self.checkpoints and stat.S_ISREG(
+            os.fstat(self._file.fileno()).st_mode
+        )
+        if self.resume:
+            self._journaled = self._journal_counts()
+        else:
+            # everything so far goes into the first checkpoint
+            self._journaled = dict.fromkeys(self._journal_counts(), 0)
+        self._forgotten = []
+        self._checkpoint_offset = self.tar.offset
+        self._checkpoint_time = time.monotonic()
+        if not self._checkpointing or self.resume:
+            return
+
+        header = {
+            "format": self.checkpoint_format,
+            "version": 1,
+            "compression": self.codec.name,
+            "level": self.level,
+            "store_incompressible": self.store_incompressible,
+            "checksum": self.checksum,
+            "since": self._since_path,
+            "since_id": self.since.id if self.since else None,
+            "manifest_id": self.manifest.id,
+            "info": self.checkpoint_info,
+        }
+        with open(self.checkpoint_path, "w") as f:
+            f.write(json.dumps(header) + "\n")
+        # so there always is one to resume from
+        self.checkpoint()
+
+    def _journal_counts(self):
+        return {
+            "frames": len(self._fileobj.frames),
+            "entries": len(self.tar.index_entries),
+            "manifest": len(self.manifest.entries),
+            "deleted": len(self.manifest.deleted),
+            "inodes": len(self.tar.inodes),
+        }
+
+    def checkpoint(self):
+        """
+        End the current frame, make sure everything up to it is on disk and
+        append where it ends to the checkpoint file, along with everything
+        stored since the last checkpoint, so a takeout which is interrupted
+        later can be resumed from here.
+        """
+        if not self._checkpointing:
+            return
+
+        offsets = self._fileobj.end_frame()
+        if self.pipeline:
+            self._fileobj.sync()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        counts = self._journaled
+        inodes = itertools.islice(self.tar.inodes.items(), counts["inodes"], None)
+        checkpoint = {
+            "offsets": list(offsets),
+            "frames": [list(f) for f in self._fileobj.frames[counts["frames"] :]],
+            "entries": [
+                e.to_list() for e in self.tar.index_entries[counts["entries"] :]
+            ],
+            "manifest": dict(
+                itertools.islice(
+                    self.manifest.entries.items(), counts["manifest"], None
+                )
+            ),
+            "deleted": self.manifest.deleted[counts["deleted"] :],
+            "inodes": [[ino, dev, name] for (ino, dev), name in inodes],
+            # offsets of entries of earlier checkpoints, which were replaced
+            "forgotten": self._forgotten,
+            "stored_roots": self._stored_roots,
+            "items": self.done_items,
+        }
+        with open(self.checkpoint_path, "a") as f:
+            f.write(json.dumps(checkpoint, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._journaled = self._journal_counts()
+        self._forgotten = []
+        self._frame_start = offsets[1]
+        self._checkpoint_offset = self.tar.offset
+        self._checkpoint_time = time.monotonic()
+
+    def _checkpoint_due(self):
+        return self._checkpointing and (
+            self.tar.offset - self._checkpoint_offset >= self.checkpoint_size
+            or time.monotonic() - self._checkpoint_time >= self.checkpoint_interval
+        )
+
+    def item_done(self, name):
+        super().item_done(name)
+        self.checkpoint()
+
+    def _load_checkpoint(self):
+        # reads the checkpoint file up to its last complete checkpoint, which
+        # is where the takeout is resumed
+        try:
+            journal = open(self.checkpoint_path, "rb")
+        except FileNotFoundError:
+            raise Exception(
+                "{} has no checkpoint to resume from.".format(self.destination)
+            )
+
+        state = {
+            "offsets": None,
+            "frames": [],
+            "entries": [],
+            "manifest": {},
+            "deleted": [],
+            "inodes": {},
+            "forgotten": set(),
+        }
+        with journal:
+            header = json.loads(journal.readline())
+            if header.get("format") != self.checkpoint_format:
+                raise Exception("{} is no checkpoint.".format(self.checkpoint_path))
+            if header.get("version") != 1:
+                raise Exception(
+                    "unsupported checkpoint version: {}".format(header.get("version"))
+                )
+
+            while True:
+                line = journal.readline()
+                try:
+                    # the last one might have been cut off
+                    checkpoint = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    checkpoint = None
+                if checkpoint is None:
+                    break
+
+                for frame in checkpoint["frames"]:
+                    if not state["frames"] or state["frames"][-1] != frame:
+                        state["frames"].append(frame)
+                state["entries"] += checkpoint["entries"]
+                state["manifest"].update(checkpoint["manifest"])
+                state["deleted"] += checkpoint["deleted"]
+                state["forgotten"].update(checkpoint["forgotten"])
+                for ino, dev, name in checkpoint["inodes"]:
+                    state["inodes"][(ino, dev)] = name
+                state["offsets"] = checkpoint["offsets"]
+                state["stored_roots"] = checkpoint["stored_roots"]
+                state["items"] = checkpoint["items"]
+                state["end"] = journal.tell()
+
+        if state["offsets"] is None:
+            raise Exception(
+                "{} has no checkpoint to resume from.".format(self.destination)
+            )
+        if self.checkpoint_info and header["info"] != self.checkpoint_info:
+            raise Exception(
+                "{} can't be resumed, it was taken out with {}.".format(
+                    self.destination, header["info"]
+                )
+            )
+
+        # the archive has to go on the way it started
+        self.codec = codecs.get_codec(header["compression"])
+        self.level = header["level"]
+        self.store_incompressible = header["store_incompressible"]
+        self.checksum = header["checksum"]
+        if header["since"] and self.since is None:
+            self.since = Manifest.load(header["since"])
+            self._since_path = header["since"]
+        if header["since_id"] != (self.since.id if self.since else None):
+            raise Exception(
+                "{} can't be resumed, it was taken out since {}.".format(
+                    self.destination, header["since"]
+                )
+            )
+        state["manifest_id"] = header["manifest_id"]
+        self._resumed = state
+
+    def _restore_checkpoint(self):
+        state = self._resumed
+        entries = [
+            IndexEntry.from_list(e)
+            for e in state["entries"]
+            if e[2] not in state["forgotten"]
+        ]
+        self.tar.index_entries.extend(entries)
+        self._index_members(entries)
+        self.tar.inodes.update(state["inodes"])
+        self.manifest = Manifest(
+            state["manifest_id"],
+            self.manifest.base,
+            state["manifest"],
+            state["deleted"],
+        )
+        self._stored_roots = list(state["stored_roots"])
+        self._resumed_roots = set(self._stored_roots)
+        self.done_items = list(state["items"])
+        self._frame_start = self.tar.offset
+        # drop a checkpoint, which was cut off, the next ones go after the rest
+        os.truncate(self.checkpoint_path, state["end"])
+
+    def _written(self):
+        # how much of the takeout has been written so far, e.g. for Progress
+        if self._file.closed or not self._file.seekable():
+            return None
+        return self._file.tell()
+
+    def _store_manifest(self):
+        if self.since:
+            self.manifest.deleted.extend(
+                name
+                for name in self.since.entries
+                if name not in self.manifest.entries
+                and any(is_inside(name, root) for root in self._stored_roots)
+            )
+
+        self.store_text(self.manifest.to_json(), Manifest.storage_path)
+
+    def _store_index(self, index_frame):
+        frames = list(self._fileobj.frames)
+        if tuple(index_frame) not in frames:
+            frames.append(tuple(index_frame))
+
+        index = ArchiveIndex(list(self.tar.index_entries), frames)
+        self.store_text(index.to_json(), ArchiveIndex.storage_path)
+
+        self._fileobj.end_frame()
+        self.store_text(
+            ArchiveIndex.footer_json(index_frame[0]), ArchiveIndex.footer_path
+        )
+
+    def _track(self, tarinfo, path, stat_result):
+        # records everything in the manifest and skips files, which did not
+        # change since the previous takeout.
+        name = tarinfo.name.rstrip("/")
+        entry = Manifest.entry(path, stat_result, self.checksum)
+        self.manifest.entries[name] = entry
+
+        if self.since is None:
+            return tarinfo
+
+        if self.since.type_changed(name, entry):
+            # remove the old one first on takein
+            self.manifest.deleted.append(name)
+        elif self.since.is_unchanged(name, entry) and not tarinfo.isdir():
+            return None
+
+        return tarinfo
 
     def _check_member_type(self, member):
         if member.type not in (tarfile.REGTYPE, tarfile.SYMTYPE, tarfile.DIRTYPE):
@@ -64,56 +556,114 @@ class TarStorage(Storage):
                 "but is {}".format(member.name, member.type)
             )
 
+    def _check_member_name(self, member):
+        if ".." in member.name.split("/"):
+            raise Exception(
+                'tar member has illegal name (contains ".."): ' + member.name
+            )
+        if member.name.startswith("/"):
+            raise Exception(
+                'tar member has illegal name (starts with "/"): ' + member.name
+            )
+        if member.name.startswith("./"):
+            raise Exception(
+                'tar member has illegal name (starts with "./"): ' + member.name
+            )
+
+    def _index_members(self, members):
+        for m in members:
+            if self.mode == "takein":
+                # takeouts store whatever they find, takein refuses it
+                self._check_member_name(m)
+                self._check_member_type(m)
+
+            # directories are named "dir/" while writing, but "dir" when reading
+            name = m.name.rstrip("/")
+            self._members.setdefault(name, []).append(m)
+
+            # register the member with all of its parents, stopping as soon as we
+            # reach a parent we already know about.
+            child = name
+            while child:
+                parent = posixpath.dirname(child)
+                siblings = self._children.setdefault(parent, {})
+                if child in siblings:
+                    break
+                siblings[child] = None
+                child = parent
+
+    def _walk_index(self, directory):
+        # pre-order, so directories come before their contents, just like in the
+        # archive itself.
+        stack = list(self._children.get(directory, {}))[::-1]
+        while stack:
+            name = stack.pop()
+            yield name
+            stack.extend(list(self._children.get(name, {}))[::-1])
+
+    def _tarinfo(self, member):
+        if not isinstance(member, IndexEntry):
+            return member
+
+        # members listed in the index are only read once they are needed
+        self.tar.fileobj.seek(member.offset)
+        tarinfo = tarfile.TarInfo.fromtarfile(self.tar)
+        # the index was checked already, but the header is what gets extracted
+        self._check_member_name(tarinfo)
+        self._check_member_type(tarinfo)
+        if (
+            tarinfo.name.rstrip("/") != member.name.rstrip("/")
+            or tarinfo.type != member.type
+        ):
+            raise Exception(
+                "tar member doesn't match the archive index: {}".format(member.name)
+            )
+        return tarinfo
+
     def clone_tarinfo(self, tarinfo):
         # "clone" the object so we don't modify names inside the tar
+        tarinfo = self._tarinfo(tarinfo)
         tarinfo2 = tarfile.TarInfo()
         for attr in (*tarinfo.get_info().keys(), "offset", "offset_data"):
             setattr(tarinfo2, attr, getattr(tarinfo, attr))
         return tarinfo2
 
     def get_members_in(self, directory):
-        directory = directory.rstrip("/") + "/"
-
-        for m in self.tar.getmembers():
-            if ".." in m.name:
-                raise Exception(
-                    'tar member has illegal name (contains ".."): ' + m.name
-                )
-            if m.name.startswith("/"):
-                raise Exception(
-                    'tar member has illegal name (starts with "/"): ' + m.name
-                )
-            if m.name.startswith("./"):
-                raise Exception(
-                    'tar member has illegal name (starts with "./"): ' + m.name
-                )
+        directory = directory.rstrip("/")
+        prefix = directory + "/"
 
-            self._check_member_type(m)
+        if not directory:
+            return
 
-            if m.name.startswith(directory):
+        for name in self._walk_index(directory):
+            for m in self._members.get(name, ()):
                 m = self.clone_tarinfo(m)
                 # files might be stored as /www/domain.com/something.html, but need to be extracted
                 # as domain.com/something.html.
-                m.name = m.name[len(directory) :]
+                m.name = name[len(prefix) :]
                 yield m
 
     def has_member(self, path):
-        for m in self.tar.getmembers():
-            self._check_member_type(m)
+        return path.rstrip("/") in self._members
 
-            if m.name == path:
-                return True
+    def list_paths(self, storage_path=""):
+        directory = str(storage_path).strip("/")
 
-        return False
+        if not directory:
+            names = list(self._members)
+        else:
+            names = [
+                n
+                for n in (directory, *self._walk_index(directory))
+                if n in self._members
+            ]
 
-    def get_member(self, path):
-        matching = []
-
-        for m in self.tar.getmembers():
-            self._check_member_type(m)
+        if not names:
+            raise FileNotFoundError()
+        return names
 
-            if m.name == path:
-                matching.append(m)
+    def get_member(self, path):
+        matching = self._members.get(path.rstrip("/"), [])
 
         if len(matching) == 0:
             raise FileNotFoundError()
@@ -142,30 +692,254 @@ class TarStorage(Storage):
 
     def store_text(self, content, storage_path):
         storage_path = str(storage_path).lstrip("/")
+        if self.resume and self.has_member(storage_path):
+            # stored by an item, which wasn't done at the last checkpoint
+            self._forget_member(storage_path)
+        if self.tar.offset - self._frame_start > self.text_frame_distance:
+            self._frame_start = self._fileobj.end_frame()[1]
+
         content = BytesIO(content.encode("utf-8"))
         info = tarfile.TarInfo(storage_path)
         info.size = self._len(content)
         info.mtime = int(datetime.datetime.now().strftime("%s"))
         self.tar.addfile(info, content)
+        self._index_members([info])
+
+    def _forget_member(self, name):
+        # drops it from the index, tarfile still finds it in a stream. Members
+        # are IndexEntry objects if resumed, TarInfo ones if stored since.
+        offsets = {m.offset for m in self._members.pop(name.rstrip("/"))}
+        entries = self.tar.index_entries
+        for position in reversed(range(len(entries))):
+            offset = entries[position].offset
+            if offset not in offsets:
+                continue
+            del entries[position]
+            if position < self._journaled["entries"]:
+                self._journaled["entries"] -= 1
+                self._forgotten.append(offset)
 
     def unstore_text(self, storage_path):
         storage_path = str(storage_path).lstrip("/")
         if not self.has_member(storage_path):
             raise FileNotFoundError()
-        return self.tar.extractfile(storage_path).read().decode("utf-8")
+        # like tarfile itself, prefer the last member if there are several
+        member = self._members[storage_path.rstrip("/")][-1]
+        content = self.tar.extractfile(self._tarinfo(member)).read()
+
+        if getattr(member, "crc", None) is not None:
+            if zlib.crc32(content) != member.crc:
+                raise Exception(
+                    "tar member {} is corrupted, its checksum does not match "
+                    "the archive index.".format(storage_path)
+                )
+
+        return content.decode("utf-8")
+
+    def open_file(self, storage_path):
+        storage_path = str(storage_path).lstrip("/")
+        if not self.has_member(storage_path):
+            raise FileNotFoundError()
+        member = self._tarinfo(self._members[storage_path.rstrip("/")][-1])
+        if not member.isfile():
+            raise IsADirectoryError()
+        return self.tar.extractfile(member)
 
     def store_file(self, system_path, storage_path):
         storage_path = str(storage_path).lstrip("/")
-        if self.has_member(storage_path):
+        storage_root = storage_path.rstrip("/")
+        # resumed takeouts carry on with the directory they were storing
+        resumed = storage_root in self._resumed_roots
+        if self.has_member(storage_path) and not resumed:
             raise FileExistsError()
-        self.tar.add(str(system_path), storage_path)
+        known = len(self.tar.getmembers())
+
+        if self.pipeline:
+            start = self._fileobj.tell()
+            prefetcher = Prefetcher(
+                system_path, lambda: self._fileobj.tell() - start
+            ).start()
+
+        if not resumed:
+            self._stored_roots.append(storage_root)
+
+        try:
+            for path, tarinfo, stat_result in self._walker.walk(
+                system_path, storage_path
+            ):
+                if resumed and tarinfo.name.rstrip("/") in self._members:
+                    # stored before the last checkpoint
+                    if self.progress is not None and tarinfo.isreg():
+                        self.progress.add(1, tarinfo.size)
+                    continue
+                if self._track(tarinfo, path, stat_result) is None:
+                    continue
+                if tarinfo.isreg():
+                    self._set_stored(self._is_incompressible(path, tarinfo))
+                    with open(path, "rb") as f:
+                        self.tar.addfile(tarinfo, f)
+                    metrics.add("files")
+                    metrics.add("bytes_read", tarinfo.size)
+                    if self.progress is not None:
+                        self.progress.add(1, tarinfo.size)
+                else:
+                    self.tar.addfile(tarinfo)
+                if self._checkpoint_due():
+                    self.checkpoint()
+        finally:
+            if self.pipeline:
+                prefetcher.stop()
+            self._set_stored(False)
+
+        self._index_members(self.tar.getmembers()[known:])
+
+    def _is_incompressible(self, path, tarinfo):
+        if not self.store_incompressible or tarinfo.size < self.incompressible_size:
+            return False
+        if not codecs.is_incompressible(path):
+            return False
+        metrics.add("files_stored")
+        return True
+
+    def _set_stored(self, stored):
+        # switching ends a frame, so only do it if anything changes
+        if self.store_incompressible and stored != self._stored:
+            self._fileobj.set_stored(stored)
+            self._stored = stored
 
     def unstore_directory(self, storage_path, system_path):
-        storage_path = str(storage_path).lstrip("/")
-        members = list(self.get_members_in(storage_path))
-        if not members:
-            raise FileNotFoundError()
-        self.tar.extractall(system_path, members)
+        self.unstore_directories([(storage_path, system_path)])
+
+    def unstore_directories(self, directories):
+        storage_paths = []
+        found = []
+        missing = []
+        for storage_path, system_path in directories:
+            storage_path = str(storage_path).strip("/")
+            members = list(self.get_members_in(storage_path))
+            if not members:
+                # empty directories only have a member of their own
+                own = self._members.get(storage_path, [])
+                if not own or own[-1].type != tarfile.DIRTYPE:
+                    missing.append(storage_path)
+                    continue
+                os.makedirs(str(system_path), exist_ok=True)
+            storage_paths.append(storage_path)
+            found.append((members, system_path))
+        directories = found
+
+        if self.manifest and self.manifest.deleted:
+            for storage_path, (_, system_path) in zip(storage_paths, directories):
+                self._apply_deletions(storage_path, system_path)
+
+        if self.sync is not None:
+            directories = [
+                (self._skip_unchanged(storage_path, members, system_path), system_path)
+                for storage_path, (members, system_path) in zip(
+                    storage_paths, directories
+                )
+            ]
+
+        for members, _ in directories:
+            files, size = self._count_extracted(members)
+            if self.progress is not None:
+                self.progress.add_total(files, size)
+
+        if self.jobs <= 1:
+            for members, system_path in directories:
+                self.tar.extractall(system_path, self._report_progress(members))
+        else:
+            # all directories share one pass over the archive and one thread
+            # pool, so the next one is decompressed while the last files of the
+            # previous one are still being written.
+            with ParallelExtractor(self.tar, self.jobs) as extractor:
+                for members, system_path in directories:
+                    for member in self._report_progress(members):
+                        extractor.extract(member, system_path)
+
+        raise_missing(missing)
+
+    def _skip_unchanged(self, storage_path, members, system_path):
+        # returns the members which have to be extracted, i.e. aren't in
+        # system_path already, and removes what isn't in the takeout
+        prefix = storage_path + "/"
+        if self.manifest is not None:
+            # incremental takeouts only contain what changed, but list it all
+            names = {
+                n[len(prefix) :] for n in self.manifest.entries if n.startswith(prefix)
+            }
+        else:
+            names = {m.name for m in members}
+        self.sync.delete_extra(system_path, names)
+
+        changed = []
+        for member in members:
+            path = os.path.join(str(system_path), member.name)
+            compare = functools.partial(
+                self._same_content, prefix + member.name, member
+            )
+            if self.sync.unchanged(
+                path,
+                self._kind(member),
+                member.size,
+                member.mtime,
+                member.linkname,
+                compare,
+            ):
+                self._set_attrs(member, path)
+            else:
+                changed.append(member)
+        return changed
+
+    @staticmethod
+    def _kind(member):
+        if member.issym():
+            return "symlink"
+        if member.isdir():
+            return "dir"
+        if member.isfile():
+            return "file"
+        return "other"
+
+    def _same_content(self, name, member, path):
+        crc = getattr(self._members[name][-1], "crc", None)
+        if crc is not None:
+            return file_crc32(path) == crc
+        # takeouts without an index, read the member itself
+        return same_content(self.tar.extractfile(member), path)
+
+    def _set_attrs(self, member, path):
+        try:
+            self.tar.chown(member, path, False)
+            if not member.issym():
+                self.tar.chmod(member, path)
+                self.tar.utime(member, path)
+        except tarfile.ExtractError:
+            # just like extractall() and ParallelExtractor
+            if self.tar.errorlevel > 1:
+                raise
+
+    def _count_extracted(self, members):
+        files = [m for m in members if m.isfile()]
+        size = sum(m.size for m in files)
+        metrics.add("files", len(files))
+        metrics.add("bytes_written", size)
+        return len(files), size
+
+    def _report_progress(self, members):
+        # tells progress about every member, once it has been extracted
+        for member in members:
+            yield member
+            if self.progress is not None and member.isfile():
+                self.progress.add(1, member.size)
+
+    def _apply_deletions(self, storage_root, system_root):
+        # incremental takeouts record what was deleted since the previous one
+        for name in sorted(self.manifest.deleted, reverse=True):
+            if name != storage_root and is_inside(name, storage_root):
+                remove_path(
+                    os.path.join(str(system_root), name[len(storage_root) + 1 :])
+                )
 
     def unstore_file(self, storage_path, system_path):
         storage_path = str(storage_path).lstrip("/")
@@ -174,7 +948,592 @@ class TarStorage(Storage):
         self.tar.extractall(os.path.dirname(system_path), [member])
 
 
+class TarStreamStorage(TarStorage):
+    """
+    Reads a takeout in a single pass, e.g. from a pipe: unstore_* calls read
+    ahead until they find their path and extract members as they arrive. Small
+    members, which a later item has claimed, are kept in memory on the way,
+    everything else is skipped.
+    """
+
+    buffer_member_size = 1024 * 1024
+    buffer_total_size = 16 * 1024 * 1024
+
+    def __enter__(self):
+        if self.mode != "takein":
+            raise Exception("TarStreamStorage can only be used for takein.")
+
+        self.tar = self._open_tar(stream=True)
+        # the manifest is at the very end, too late to be of any use
+        self.manifest = None
+        self._next_member = None
+        self._eof = False
+        self._claims = None
+        # name => (member, content) of small members we had to read past
+        self._buffered = {}
+        self._buffered_size = 0
+        # names of claimed members we had to read past, but could not buffer
+        self._skipped = set()
+        return self
+
+    def claim(self, storage_paths):
+        self._claims = [str(p).strip("/") for p in storage_paths]
+
+    def _is_claimed(self, name):
+        if self._claims is None:
+            return True
+
+        return any(name == c or name.startswith(c + "/") for c in self._claims)
+
+    def _peek(self):
+        if self._next_member is None and not self._eof:
+            self._next_member = self.tar.next()
+            self._eof = self._next_member is None
+
+            if not self._eof:
+                # tarfile remembers every member it has seen, which would defeat
+                # the point of streaming.
+                self.tar.members.clear()
+                self._check_member_name(self._next_member)
+                self._check_member_type(self._next_member)
+
+        return self._next_member
+
+    def _pop(self):
+        member = self._peek()
+        self._next_member = None
+        return member
+
+    def _buffer(self, member, content):
+        name = member.name.rstrip("/")
+        if name in self._buffered:
+            return True
+        if self._buffered_size + len(content) > self.buffer_total_size:
+            return False
+
+        self._buffered[name] = (member, content)
+        self._buffered_size += len(content)
+        return True
+
+    def _read_past(self, member):
+        name = member.name.rstrip("/")
+
+        if not self._is_claimed(name):
+            return
+
+        if member.isfile() and member.size <= self.buffer_member_size:
+            if self._buffer(member, self.tar.extractfile(member).read()):
+                return
+
+        self._skipped.add(name)
+
+    def _find_member(self, name):
+        if name in self._skipped:
+            raise Exception(
+                "tar member {} has already been read past. "
+                "Use a seekable file instead of a stream.".format(name)
+            )
+
+        while True:
+            member = self._pop()
+
+            if member is None:
+                raise FileNotFoundError()
+            if member.name.rstrip("/") == name:
+                return member
+
+            self._read_past(member)
+
+    def _check_not_read_past(self, prefix):
+        for name in (*self._buffered, *self._skipped):
+            if name.startswith(prefix):
+                raise Exception(
+                    "tar member {} has already been read past. "
+                    "Use a seekable file instead of a stream.".format(name)
+                )
+
+    def _read_directory(self, storage_path):
+        # yields all members in storage_path, which have to be in one piece
+        directory = str(storage_path).strip("/")
+        prefix = directory + "/"
+        found = False
+
+        while True:
+            member = self._peek()
+
+            if member is None:
+                break
+
+            inside = member.name.startswith(prefix)
+            if found and not inside:
+                break
+
+            self._pop()
+
+            if inside:
+                found = True
+                yield member
+            elif member.name.rstrip("/") == directory:
+                # which might be empty
+                found = member.isdir()
+            else:
+                self._read_past(member)
+
+        if not found:
+            raise FileNotFoundError()
+
+    def list_files(self, storage_path):
+        prefix = str(storage_path).strip("/") + "/"
+
+        try:
+            for member in self._read_directory(storage_path):
+                self._read_past(member)
+        except FileNotFoundError:
+            pass
+
+        names = {
+            n[len(prefix) :]
+            for n in (*self._buffered, *self._skipped)
+            if n.startswith(prefix)
+        }
+        if not names:
+            raise FileNotFoundError()
+        return [n for n in names if "/" not in n]
+
+    def unstore_text(self, storage_path):
+        name = str(storage_path).strip("/")
+
+        if name not in self._buffered:
+            member = self._find_member(name)
+            content = self.tar.extractfile(member).read()
+            if not self._buffer(member, content):
+                # too big to keep around, so this is the only chance to read it
+                self._skipped.add(name)
+                return content.decode("utf-8")
+
+        return self._buffered[name][1].decode("utf-8")
+
+    unstore_directories = Storage.unstore_directories
+
+    def unstore_directory(self, storage_path, system_path):
+        prefix = str(storage_path).strip("/") + "/"
+        self._check_not_read_past(prefix)
+
+        names = set()
+        directories = []
+        with ParallelExtractor(self.tar, self.jobs) as extractor:
+            for member in self._report_progress(self._read_directory(storage_path)):
+                member = self.clone_tarinfo(member)
+                member.name = member.name[len(prefix) :]
+                names.add(member.name)
+                if member.isdir():
+                    directories.append(member)
+                if self.sync is not None:
+                    # the contents can't be compared without reading them,
+                    # so with checksum, files are always written
+                    path = os.path.join(str(system_path), member.name)
+                    if self.sync.unchanged(
+                        path,
+                        self._kind(member),
+                        member.size,
+                        member.mtime,
+                        member.linkname,
+                    ):
+                        self._set_attrs(member, path)
+                        continue
+                extractor.extract(member, system_path)
+                self._count_extracted([member])
+        # in case it is empty
+        os.makedirs(str(system_path), exist_ok=True)
+
+        if self.sync is not None and self.sync.delete:
+            self.sync.delete_extra(system_path, names)
+            # deleting changed the mtimes of the directories again
+            for member in reversed(directories):
+                self._set_attrs(member, os.path.join(str(system_path), member.name))
+
+    def unstore_file(self, storage_path, system_path):
+        system_path = str(system_path)
+        name = str(storage_path).strip("/")
+
+        if name in self._buffered:
+            member, content = self._buffered[name]
+            os.makedirs(os.path.dirname(system_path), exist_ok=True)
+            with open(system_path, "wb") as f:
+                f.write(content)
+            self._set_attrs(member, system_path)
+            return
+
+        member = self.clone_tarinfo(self._find_member(name))
+        member.name = os.path.basename(system_path)
+        self.tar.extract(member, os.path.dirname(system_path))
+
+
+class ChunkStorage(Storage):
+    """
+    Stores files as lists of chunks in a ChunkStore, which the takeouts of
+    many users can share, so identical files and parts of files (e.g. the same
+    WordPress in every document root) are only stored once. destination is a
+    JSON lines file: a header, one entry per file, directory, symlink or text,
+    and a last line marking it complete.
+
+    The chunk store defaults to destination + ".store". Its path is recorded
+    in the header, so takein finds it, as long as both are moved together.
+    """
+
+    format = "uberspace-takeout-chunks"
+    types = {
+        tarfile.REGTYPE: "file",
+        tarfile.DIRTYPE: "dir",
+        tarfile.SYMTYPE: "symlink",
+        tarfile.LNKTYPE: "hardlink",
+    }
+
+    def __init__(
+        self,
+        destination,
+        mode,
+        chunk_store=None,
+        compression="gzip",
+        level=None,
+        jobs=1,
+        owners=None,
+        progress=None,
+        skip_unchanged=False,
+        checksum=False,
+        delete=False,
+    ):
+        super().__init__(destination, mode)
+        self.chunk_store = str(chunk_store) if chunk_store else None
+        self.compression = compression
+        self.level = level
+        # threads hashing and compressing chunks
+        self.jobs = jobs
+        # takein: an OwnerMap deciding who owns restored files (as root)
+        self.owners = owners
+        # a Progress, told about every file stored or restored
+        self.progress = progress
+        # takeouts from older versions have one, see TarStorage
+        self.manifest = None
+        # takein: see TarStorage
+        self.sync = TreeSync(checksum, delete) if skip_unchanged else None
+
+    @classmethod
+    def is_archive(cls, path):
+        try:
+            with open(str(path), "rb") as f:
+                header = f.read(64)
+        except OSError:
+            return False
+        return header.startswith(b'{"format": "' + cls.format.encode() + b'"')
+
+    def __enter__(self):
+        # name => entry
+        self._entries = {}
+        self._children = {}
+        self._walker = TreeWalker()
+
+        if self.mode == "takeout":
+            if self.chunk_store is None:
+                self.chunk_store = self.destination + ".store"
+            self.store = ChunkStore(self.chunk_store, self.compression, self.level)
+            self._file = open(self.destination, "w")
+            self._write(
+                {
+                    "format": self.format,
+                    "version": 1,
+                    "chunk_store": os.path.relpath(
+                        self.chunk_store, os.path.dirname(self.destination) or "."
+                    ),
+                }
+            )
+            return self
+
+        with open(self.destination) as f:
+            header = json.loads(f.readline())
+            if header.get("format") != self.format:
+                raise Exception("{} is no chunked takeout.".format(self.destination))
+            complete = False
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("end"):
+                    complete = True
+                    break
+                self._add_entry(entry)
+        if not complete:
+            raise Exception("{} is incomplete.".format(self.destination))
+
+        if self.chunk_store is None:
+            self.chunk_store = os.path.join(
+                os.path.dirname(self.destination), header["chunk_store"]
+            )
+        self.store = ChunkStore(self.chunk_store)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.mode == "takeout":
+            try:
+                if exception_type is None:
+                    self._write({"end": True})
+            finally:
+                self._file.close()
+
+    def stats(self):
+        if not hasattr(self, "store"):
+            return {}
+        return {"chunk_store": self.chunk_store, **self.store.report()}
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+
+    def _add_entry(self, entry):
+        name = entry["path"]
+        if ".." in name.split("/") or name.startswith("/"):
+            raise Exception("chunked takeout has an illegal path: " + name)
+        if name in self._entries:
+            raise Exception("chunked takeout has a path twice: " + name)
+        self._entries[name] = entry
+        self._children.setdefault(posixpath.dirname(name), []).append(name)
+
+    def _store_entry(self, entry):
+        if entry["path"] in self._entries:
+            raise FileExistsError()
+        self._add_entry(entry)
+        self._write(entry)
+
+    def _put_chunks(self, f):
+        if self.jobs <= 1:
+            return [self.store.put(chunk) for chunk in chunks.split(f)]
+
+        # hashlib and the compressors release the GIL for large buffers. Only
+        # a few chunks are read ahead, files can be large.
+        digests = []
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            pending = collections.deque()
+            for chunk in chunks.split(f):
+                pending.append(pool.submit(self.store.put, chunk))
+                if len(pending) >= self.jobs * 2:
+                    digests.append(pending.popleft().result())
+            digests.extend(future.result() for future in pending)
+        return digests
+
+    def store_text(self, content, storage_path):
+        storage_path = str(storage_path).strip("/")
+        self._store_entry({"path": storage_path, "type": "text", "text": content})
+
+    def store_file(self, system_path, storage_path):
+        storage_path = str(storage_path).strip("/")
+        if storage_path in self._entries:
+            raise FileExistsError()
+
+        for path, tarinfo, stat_result in self._walker.walk(system_path, storage_path):
+            type_ = self.types.get(tarinfo.type)
+            if type_ is None:
+                # devices and fifos, which takein refuses anyway
+                continue
+
+            entry = {
+                "path": tarinfo.name.rstrip("/"),
+                "type": type_,
+                "mode": stat.S_IMODE(tarinfo.mode),
+                "uid": tarinfo.uid,
+                "gid": tarinfo.gid,
+                "uname": tarinfo.uname,
+                "gname": tarinfo.gname,
+                "mtime": tarinfo.mtime,
+            }
+            if type_ == "file":
+                with open(path, "rb") as f:
+                    entry["chunks"] = self._put_chunks(f)
+                entry["size"] = tarinfo.size
+                metrics.add("files")
+                metrics.add("bytes_read", tarinfo.size)
+                if self.progress is not None:
+                    self.progress.add(1, tarinfo.size)
+            elif type_ in ("symlink", "hardlink"):
+                entry["target"] = tarinfo.linkname
+            self._store_entry(entry)
+
+    def _get(self, storage_path):
+        storage_path = str(storage_path).strip("/")
+        if storage_path not in self._entries:
+            raise FileNotFoundError()
+        return self._entries[storage_path]
+
+    def _read(self, entry):
+        if entry["type"] == "text":
+            return entry["text"].encode("utf-8")
+        if entry["type"] != "file":
+            raise IsADirectoryError()
+        return b"".join(self.store.get(d) for d in entry["chunks"])
+
+    def unstore_text(self, storage_path):
+        entry = self._get(storage_path)
+        if entry["type"] == "text":
+            return entry["text"]
+        return self._read(entry).decode("utf-8")
+
+    def open_file(self, storage_path):
+        return BytesIO(self._read(self._get(storage_path)))
+
+    def _walk(self, directory):
+        # pre-order, like TarStorage
+        stack = list(reversed(self._children.get(directory, [])))
+        while stack:
+            name = stack.pop()
+            yield name
+            stack.extend(reversed(self._children.get(name, [])))
+
+    def list_files(self, storage_path):
+        storage_path = str(storage_path).strip("/")
+        if storage_path not in self._children:
+            raise FileNotFoundError()
+        return [posixpath.basename(n) for n in self._children[storage_path]]
+
+    def list_paths(self, storage_path=""):
+        directory = str(storage_path).strip("/")
+        names = [directory] if directory in self._entries else []
+        names += list(self._walk(directory))
+        if not names:
+            raise FileNotFoundError()
+        return names
+
+    def unstore_file(self, storage_path, system_path):
+        self.unstore_directories([(storage_path, system_path)])
+
+    def unstore_directories(self, directories):
+        directories = [
+            (str(storage_path).strip("/"), str(system_path))
+            for storage_path, system_path in directories
+        ]
+        missing = [p for p, _ in directories if p not in self._entries]
+        directories = [(p, s) for p, s in directories if p not in missing]
+
+        for storage_path, system_path in directories:
+            names = [storage_path, *self._walk(storage_path)]
+            files = [
+                self._entries[n] for n in names if self._entries[n]["type"] == "file"
+            ]
+            size = sum(e["size"] for e in files)
+            if self.progress is not None:
+                self.progress.add_total(len(files), size)
+
+        for storage_path, system_path in directories:
+            self._restore(storage_path, system_path)
+        raise_missing(missing)
+
+    def _system_path(self, name, storage_root, system_root):
+        if name == storage_root:
+            return system_root
+        return os.path.join(system_root, name[len(storage_root) + 1 :])
+
+    def _restore(self, storage_root, system_root):
+        directories = []
+        real_root = os.path.realpath(system_root)
+        # parent directories known not to be symlinks leading elsewhere
+        checked = set()
+        names = [storage_root, *self._walk(storage_root)]
+
+        if self.sync is not None:
+            self.sync.delete_extra(
+                system_root, {n[len(storage_root) + 1 :] for n in names}
+            )
+
+        for name in names:
+            entry = self._entries[name]
+            path = self._system_path(name, storage_root, system_root)
+
+            parent = os.path.dirname(path)
+            if name != storage_root and parent not in checked:
+                if not is_inside(os.path.realpath(parent), real_root):
+                    raise Exception("chunked takeout escapes its directory: " + name)
+                checked.add(parent)
+
+            if entry["type"] == "dir":
+                os.makedirs(path, exist_ok=True)
+                directories.append((entry, path))
+                continue
+
+            if self._unchanged(entry, path):
+                self._set_attrs(entry, path)
+                if self.progress is not None and entry["type"] == "file":
+                    self.progress.add(1, entry["size"])
+                continue
+
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.unlink(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            if entry["type"] == "text":
+                with open(path, "w") as f:
+                    f.write(entry["text"])
+                continue
+            elif entry["type"] == "file":
+                with open(path, "wb") as f:
+                    for digest in entry["chunks"]:
+                        f.write(self.store.get(digest))
+                metrics.add("files")
+                metrics.add("bytes_written", entry["size"])
+                if self.progress is not None:
+                    self.progress.add(1, entry["size"])
+            elif entry["type"] == "symlink":
+                os.symlink(entry["target"], path)
+            elif entry["type"] == "hardlink":
+                if not is_inside(entry["target"], storage_root):
+                    raise Exception("hardlink leaves its directory: " + name)
+                os.link(
+                    self._system_path(entry["target"], storage_root, system_root), path
+                )
+                continue
+            self._set_attrs(entry, path)
+
+        # last, as restoring their contents changes their mtime
+        for entry, path in reversed(directories):
+            self._set_attrs(entry, path)
+
+    def _unchanged(self, entry, path):
+        if self.sync is None or entry["type"] not in ("file", "symlink"):
+            return False
+
+        def compare(path):
+            with open(path, "rb") as f:
+                digests = [hashlib.sha256(c).hexdigest() for c in chunks.split(f)]
+            return digests == entry["chunks"]
+
+        return self.sync.unchanged(
+            path,
+            entry["type"],
+            entry.get("size", 0),
+            entry["mtime"],
+            entry.get("target"),
+            compare,
+        )
+
+    def _set_attrs(self, entry, path):
+        if self.owners is not None:
+            tarinfo = tarfile.TarInfo(entry["path"])
+            for attr in ("uid", "gid", "uname", "gname"):
+                setattr(tarinfo, attr, entry[attr])
+            self.owners.chown(tarinfo, path)
+        if entry["type"] != "symlink":
+            os.chmod(path, entry["mode"])
+        os.utime(path, (entry["mtime"], entry["mtime"]), follow_symlinks=False)
+
+
 class LocalMoveStorage(Storage):
+    """
+    Moves files into a directory and back again. With copy, they are copied
+    instead (using reflinks where possible, see TreeCopier), so the source
+    stays intact. Moves across filesystems fall back to copying and removing.
+    """
+
+    def __init__(self, destination, mode, copy=False, jobs=4):
+        super().__init__(destination, mode)
+        self.copy = copy
+        self.copier = TreeCopier(jobs)
+        self.renamed = 0
+
     def __enter__(self):
         return self
 
@@ -220,11 +1579,130 @@ class LocalMoveStorage(Storage):
         if os.path.exists(storage_path):
             raise FileExistsError()
         self._mkdir_p(os.path.dirname(storage_path))
-        os.rename(system_path, storage_path)
+        self._transfer(system_path, storage_path)
 
     def unstore_file(self, storage_path, system_path):
         storage_path = self._storage_path(storage_path)
         if not os.path.exists(storage_path):
             raise FileNotFoundError()
         self._mkdir_p(os.path.dirname(system_path))
-        os.rename(storage_path, system_path)
+        self._transfer(storage_path, system_path)
+
+    def _transfer(self, source, target):
+        if not self.copy:
+            try:
+                os.rename(source, target)
+                self.renamed += 1
+                return
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+
+        # like rename, replace empty directories, e.g. those made by _mkdir_p
+        # for paths ending with a slash
+        target = str(target).rstrip("/")
+        if os.path.isdir(target) and not os.listdir(target):
+            os.rmdir(target)
+
+        self.copier.copy(str(source).rstrip("/"), target)
+        if not self.copy:
+            remove_path(str(source))
+
+    def stats(self):
+        stats = {"renamed": self.renamed}
+        for strategy, counters in self.copier.counters.items():
+            stats[strategy + "_files"] = counters["files"]
+            stats[strategy + "_bytes"] = counters["bytes"]
+        return stats
+
+
+class LockedStorage(Storage):
+    """
+    Wraps another storage, so items running in several threads can share it:
+    calls are serialized using a lock. Texts can be preloaded before, so
+    reading them later doesn't have to wait for a long running unstore_* call.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.destination = storage.destination
+        self.mode = storage.mode
+        self._lock = threading.RLock()
+        self._texts = {}
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+    def _call(self, name, *args):
+        with self._lock:
+            return getattr(self.storage, name)(*args)
+
+    def preload(self, storage_paths):
+        # errors are raised once an item actually asks for the path
+        for storage_path in storage_paths:
+            storage_path = str(storage_path).lstrip("/")
+
+            if not storage_path.endswith("/"):
+                try:
+                    self._texts[storage_path] = self._call("unstore_text", storage_path)
+                except (FileNotFoundError, UnicodeDecodeError):
+                    pass
+                continue
+
+            try:
+                self._files[storage_path] = self._call("list_files", storage_path)
+            except FileNotFoundError:
+                continue
+            self.preload(storage_path + f for f in self._files[storage_path])
+
+    def claim(self, storage_paths):
+        self._call("claim", storage_paths)
+
+    def item_done(self, name):
+        self._call("item_done", name)
+
+    def list_files(self, storage_path):
+        storage_path = str(storage_path).lstrip("/")
+        if storage_path in self._files:
+            return list(self._files[storage_path])
+        return self._call("list_files", storage_path)
+
+    def store_text(self, content, storage_path):
+        self._call("store_text", content, storage_path)
+
+    def unstore_text(self, storage_path):
+        storage_path = str(storage_path).lstrip("/")
+        if storage_path in self._texts:
+            return self._texts[storage_path]
+        return self._call("unstore_text", storage_path)
+
+    def store_file(self, system_path, storage_path):
+        self._call("store_file", system_path, storage_path)
+
+    def unstore_file(self, storage_path, system_path):
+        self._call("unstore_file", storage_path, system_path)
+
+    def store_directory(self, system_path, storage_path):
+        self._call("store_directory", system_path, storage_path)
+
+    def unstore_directory(self, storage_path, system_path):
+        self._call("unstore_directory", storage_path, system_path)
+
+    def unstore_directories(self, directories):
+        self._call("unstore_directories", directories)
+
+    def stats(self):
+        return self.storage.stats()
+
+
+def archive_class(path, stream=False):
+    # the storage to read the takeout at path with
+    if stream:
+        return TarStreamStorage
+    if ChunkStorage.is_archive(path):
+        return ChunkStorage
+    return TarStorage
@@ -0,0 +1,100 @@
+import os
+import stat
+import zlib
+
+from . import metrics
+from .manifest import remove_path
+
+# lstat() file types of the kinds of members
+KINDS = {
+    "file": stat.S_ISREG,
+    "dir": stat.S_ISDIR,
+    "symlink": stat.S_ISLNK,
+}
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def same_content(source, path):
+    # compares the file object source to the file at path
+    with open(path, "rb") as f:
+        while True:
+            expected = source.read(1024 * 1024)
+            if f.read(len(expected) or 1) != expected:
+                return False
+            if not expected:
+                return True
+
+
+class TreeSync:
+    """
+    Restores into a tree which might be there already, e.g. when a migration
+    is retried, like rsync does: files of the same size and mtime as in the
+    takeout (and, with checksum, the same content) are left alone, so only
+    what changed is written. With delete, everything in the tree which isn't
+    in the takeout is removed.
+    """
+
+    def __init__(self, checksum=False, delete=False):
+        self.checksum = checksum
+        self.delete = delete
+
+    def unchanged(self, path, kind, size=0, mtime=0, linkname=None, compare=None):
+        """
+        Whether path already is what a member of kind ("file", "dir",
+        "symlink", ...) would be restored as, so it can be skipped. Only files
+        and symlinks are ever skipped, anything of another kind in their place
+        is removed. compare(path) tells whether the contents are the same, for
+        checksum; without it, files are written again to be sure.
+        """
+        try:
+            stat_result = os.lstat(path)
+        except FileNotFoundError:
+            return False
+
+        is_kind = KINDS.get(kind)
+        if is_kind is not None and not is_kind(stat_result.st_mode):
+            remove_path(path)
+            return False
+
+        if kind == "symlink":
+            unchanged = os.readlink(path) == linkname
+        elif kind == "file":
+            unchanged = (
+                stat_result.st_size == size
+                and int(stat_result.st_mtime) == int(mtime)
+                and (not self.checksum or (compare is not None and compare(path)))
+            )
+        else:
+            unchanged = False
+
+        if unchanged and kind == "file":
+            metrics.add("files_skipped")
+            metrics.add("bytes_skipped", size)
+        return unchanged
+
+    def delete_extra(self, root, names):
+        """
+        Remove everything below root, which is not in names, the paths of the
+        members below it relative to root.
+        """
+        if not self.delete:
+            return
+
+        for directory, dirnames, filenames in os.walk(str(root)):
+            relative = os.path.relpath(directory, str(root))
+            prefix = "" if relative == "." else relative + "/"
+
+            for name in filenames + dirnames:
+                if prefix + name not in names:
+                    remove_path(os.path.join(directory, name))
+                    metrics.add("deleted")
+
+            # nothing to look at in what is gone
+            dirnames[:] = [d for d in dirnames if prefix + d in names]
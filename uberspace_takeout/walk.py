@@ -0,0 +1,122 @@
+import os
+import posixpath
+import stat
+import tarfile
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+
+class TreeWalker:
+    """
+    Walks a directory tree the way tarfile.TarFile.add() does, yielding
+    (path, tarinfo, stat_result) for everything in it: depth first, sorted by
+    name, directories before their contents.
+
+    Unlike add(), it lists directories using os.scandir(), passes the lstat()
+    result on, so nobody has to stat a file twice, and looks up user and group
+    names once per uid/gid instead of once per file. Those lookups go through
+    NSS, i.e. possibly sssd or LDAP. One walker can be used for several trees.
+    """
+
+    def __init__(self, inodes=None):
+        # (inode, device) => name of the first member, for hardlinks. Pass
+        # TarFile.inodes to share them with tarfile itself.
+        self.inodes = inodes if inodes is not None else {}
+        self._users = {}
+        self._groups = {}
+
+    def uname(self, uid):
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name if pwd else ""
+            except KeyError:
+                self._users[uid] = ""
+        return self._users[uid]
+
+    def gname(self, gid):
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name if grp else ""
+            except KeyError:
+                self._groups[gid] = ""
+        return self._groups[gid]
+
+    def tarinfo(self, path, arcname, stat_result):
+        """
+        Build the TarInfo tarfile.TarFile.gettarinfo() would, or return None for
+        types tar can't store, like sockets.
+        """
+        mode = stat_result.st_mode
+        linkname = ""
+
+        if stat.S_ISREG(mode):
+            inode = (stat_result.st_ino, stat_result.st_dev)
+            if (
+                stat_result.st_nlink > 1
+                and inode in self.inodes
+                and arcname != self.inodes[inode]
+            ):
+                type_ = tarfile.LNKTYPE
+                linkname = self.inodes[inode]
+            else:
+                type_ = tarfile.REGTYPE
+                if inode[0]:
+                    self.inodes[inode] = arcname
+        elif stat.S_ISDIR(mode):
+            type_ = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            type_ = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            type_ = tarfile.SYMTYPE
+            linkname = os.readlink(path)
+        elif stat.S_ISCHR(mode):
+            type_ = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            type_ = tarfile.BLKTYPE
+        else:
+            return None
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = mode
+        tarinfo.uid = stat_result.st_uid
+        tarinfo.gid = stat_result.st_gid
+        tarinfo.size = stat_result.st_size if type_ == tarfile.REGTYPE else 0
+        tarinfo.mtime = stat_result.st_mtime
+        tarinfo.type = type_
+        tarinfo.linkname = linkname
+        tarinfo.uname = self.uname(stat_result.st_uid)
+        tarinfo.gname = self.gname(stat_result.st_gid)
+
+        if type_ in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            tarinfo.devmajor = os.major(stat_result.st_rdev)
+            tarinfo.devminor = os.minor(stat_result.st_rdev)
+
+        return tarinfo
+
+    def walk(self, path, arcname):
+        path = str(path)
+        arcname = arcname.replace(os.sep, "/").lstrip("/")
+        return self._walk(path, arcname, os.lstat(path))
+
+    def _walk(self, path, arcname, stat_result):
+        tarinfo = self.tarinfo(path, arcname, stat_result)
+        if tarinfo is None:
+            return
+
+        yield path, tarinfo, stat_result
+
+        if tarinfo.isdir():
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+
+            for entry in entries:
+                yield from self._walk(
+                    entry.path,
+                    posixpath.join(arcname, entry.name),
+                    # lstat(), cached by the entry
+                    entry.stat(follow_symlinks=False),
+                )